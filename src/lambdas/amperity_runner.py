@@ -1,6 +1,14 @@
+import copy
+import functools
 import json
 import logging
 import os
+import queue
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -8,15 +16,34 @@ from urllib3 import Retry
 from requests.adapters import HTTPAdapter
 from requests.exceptions import RetryError
 
+from lambdas.bodies import JSONArrayBody, SizedJSONArrayBody
+from lambdas.checkpoints import make_checkpoint, safe_get_checkpoint_store, safe_load, safe_save
+from lambdas.concurrency import LANE_QUEUE_DEPTH, AIMDController, OffsetTracker, partition
+from lambdas.dedup import DEDUP_CAPACITY, DEDUP_ERROR_RATE, DEDUP_EXACT_LIMIT, Deduplicator
+from lambdas.errors import ErrorAggregator
 from lambdas.helpers import http_response, rate_limit
+from lambdas.parallel import ProcessMapper
+from lambdas.profiling import PROFILE_MODES, profile_call
+from lambdas.readers import get_reader
+from lambdas.records import to_builtins
+from lambdas.timeouts import HEDGE_PERCENTILE, LatencyWindow, call_with_timeout, get_timeouts, is_timeout
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.getLevelName(os.getenv('LOG_LEVEL', default='INFO')))
 
 
+def is_content_encoded(stream_resp):
+    return stream_resp.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+
+
 class AmperityRunner:
-    def __init__(self, payload, lambda_context, tenant_id, batch_size=500, batch_offset=0):
+    # Optional {field: type} schema, ie {'phone_number': 'str'}. Rows are decoded into compact records with only
+    # these fields instead of dicts. A 'schema' in the payload settings takes precedence.
+    record_schema = None
+
+    def __init__(self, payload, lambda_context, tenant_id, batch_size=500, batch_offset=0, reader=None,
+                 checkpoint_store=None, map_workers=0, dedup_keys=None):
         """
         payload : dict
             The body of the lambda event object
@@ -35,12 +62,27 @@ class AmperityRunner:
             Int representing how many records should go in a single outbound request
         batch_offset : int, optional
             If a single job cannot process all records this represents where the next job should pick up
+        reader : lambdas.readers.Reader, optional
+            How to decode the file at data_url. By default it is picked from the 'input_format' setting, the
+            Content-Type of the file or its extension and falls back to NDJSON. See lambdas.readers.
+        checkpoint_store : lambdas.checkpoints.CheckpointStore, optional
+            Where to commit progress after each batch so a retried lambda resumes instead of resending. By default
+            it is built from the 'checkpoint_store' setting or AMPERITY_CHECKPOINT_STORE. See lambdas.checkpoints.
+        map_workers : int, optional
+            Decode and prepare batches in this many worker processes while the main process sends them, for CPU
+            heavy custom_mapping on lambdas with more than one vCPU. Overridden by the 'map_workers' setting or
+            AMPERITY_MAP_WORKERS. Runners opt in by splitting runner_logic into prepare and send_prepared.
+        dedup_keys : list, optional
+            Fields identifying a row, ie ['cust_id']. Rows with a key seen earlier in the file are dropped before
+            runner_logic. Overridden by the 'dedup_keys' setting. See lambdas.dedup.
         """
         self.lambda_context = lambda_context
         self.batch_size = batch_size
         self.batch_offset = batch_offset
+        self.reader = reader
 
         self.tenant_id = tenant_id
+        self.webhook_id = payload.get('webhook_id')
         self.data_url = payload.get('data_url')
         self.settings = payload.get('settings')
         self.access_token = payload.get('access_token')
@@ -60,98 +102,335 @@ class AmperityRunner:
             'Authorization': f'Bearer {self.access_token}'
         })
 
-        self.errors = []
+        self.errors = ErrorAggregator()
+        # Figures about the run logged when it finishes, ie the decisions of the concurrency controller.
+        self.metrics = {}
         self.file_bytes = 0
         self.total_bytes = 0
 
+        settings = self.settings or {}
+        self.checkpoint_store = checkpoint_store or safe_get_checkpoint_store(
+            settings.get('checkpoint_store') or os.getenv('AMPERITY_CHECKPOINT_STORE'))
+        # Byte offset to open the file at when resuming from a checkpoint.
+        self.start_byte = 0
+        # File row number of each record handed to runner_logic when dedup dropped rows of the batch, see row_numbers.
+        self.batch_rows = None
+        self.map_workers = int(settings.get('map_workers') or os.getenv('AMPERITY_MAP_WORKERS') or map_workers)
+
+        dedup_keys = settings.get('dedup_keys') or dedup_keys
+        self.deduplicator = Deduplicator(
+            dedup_keys,
+            exact_limit=int(settings.get('dedup_exact_limit', DEDUP_EXACT_LIMIT)),
+            capacity=int(settings.get('dedup_capacity', DEDUP_CAPACITY)),
+            error_rate=float(settings.get('dedup_error_rate', DEDUP_ERROR_RATE)),
+        ) if dedup_keys else None
+
+        self.connect_timeout, self.read_timeout, self.request_timeout = get_timeouts(settings)
+
+        # Set 'profile' in settings or AMPERITY_PROFILE to 'cprofile' or 'sample' to profile a run.
+        self.profile_mode = settings.get('profile') or os.getenv('AMPERITY_PROFILE')
+
+        if self.profile_mode and self.profile_mode not in PROFILE_MODES:
+            # Profiling is a diagnostic, a typo in it shouldn't fail the run.
+            logging.error(f"Unknown profile mode {self.profile_mode!r}, use one of {', '.join(PROFILE_MODES)}. Running without profiling.")
+            self.profile_mode = None
+
+        self.profile_s3_uri = settings.get('profile_s3_uri') or os.getenv('AMPERITY_PROFILE_S3_URI')
+
     def report_status(self, state, progress=0.0, reason=''):
         """
         The orchestration in your Amperity tenant waits for status updates from the Lambda for 3 hours.
         This method executes these status updates ensuring the workflow in your tenant is accurate.
 
-        We expect some errors to occur and do not want to overwhelm the status display in your tenant and slice to
-        only 10 errors per batch. If the lambda fails the 'reason' field will display that information. We retry
-        all calls to your tenant webhook 3 times with rules defined above in the HTTPAdapter.
+        We expect some errors to occur and do not want to overwhelm the status display in your tenant. Errors are
+        aggregated for the whole run (see lambdas.errors) and every update sends the 10 largest groups with their
+        counts. If the lambda fails the 'reason' field will display that information. We retry all calls to your
+        tenant webhook 3 times with rules defined above in the HTTPAdapter.
         """
         res = None
         data = json.dumps({
             'state': state,
             'progress': progress,
-            'errors': self.errors[:10],
+            'errors': self.errors.report(),
             'reason': reason
         })
 
         logging.info(f'Reporting status to Amperity: {data}')
 
         try:
-            res = self.report_status_session.put(self.report_status_url, data=data)
+            res = self.call_with_timeout(
+                lambda: self.report_status_session.put(self.report_status_url, data=data, timeout=self.timeouts))
         except RetryError:
             logging.error('Exceeded retries trying to communicate with Amperity.')
-
-        self.errors = []
+        except requests.exceptions.Timeout as e:
+            logging.error(f'Timed out communicating with Amperity. {e}')
+            self.errors.append(f'Status update timed out. {e}', kind='Timeout')
 
         return res
 
+    @property
+    def timeouts(self):
+        """
+        (connect, read) timeout for requests calls.
+        """
+        return self.connect_timeout, self.read_timeout
+
+    def call_with_timeout(self, call):
+        """
+        Run a requests call with the overall request_timeout, retries included. See lambdas.timeouts.
+        """
+        if not self.request_timeout:
+            return call()
+
+        return call_with_timeout(call, self.request_timeout)[0]
+
     def runner_logic(self, data):
         pass
 
+    def row_numbers(self, data):
+        """
+        The row number in the file of each record of the batch runner_logic was handed. Rows dropped as duplicates
+        still count so a record keeps its number in a resumed run, which doesn't remember what it dropped.
+        """
+        if self.batch_rows is not None:
+            return self.batch_rows
+
+        return range(self.batch_offset, self.batch_offset + len(data))
+
+    def prepare(self, data):
+        """
+        The CPU bound part of runner_logic, ie mapping and serializing. With map_workers it runs in a worker process
+        so it must not send anything and its result must pickle. Errors it appends are passed back to the main process.
+        """
+        return data
+
+    def send_prepared(self, prepared):
+        """
+        The rest of runner_logic, run in the main process with the result of prepare.
+        """
+        self.runner_logic(prepared)
+
     def run(self):
         """
         Core logic method that manages the state of the lambda. First we tell Amperity that the Lambda
         has started and then begin streaming the file in. If either of these API calls fail we want
         the Lambda to fail fast and inform us.
+
+        When profiling is switched on the run is wrapped in a profiler, see lambdas.profiling.
         """
+        if self.profile_mode:
+            name = self.webhook_id or getattr(self.lambda_context, 'aws_request_id', None) or 'profile'
+            return profile_call(self.execute, self.profile_mode, name, self.profile_s3_uri)
+
+        return self.execute()
+
+    def execute(self):
         start_response = self.report_status('running')
 
         if not start_response:
             return http_response(500, 'error', 'Error reporting status to Amperity. Ending Lambda.')
 
-        with requests.get(self.data_url, stream=True) as stream_resp:
-            if stream_resp.status_code != 200:
-                logging.error('Failed to download file.')
-                self.report_status('failed', 0, reason='Failed to download file.')
+        checkpoint = self.load_checkpoint()
+
+        if checkpoint and checkpoint.get('state') == 'succeeded':
+            logging.info(f'Webhook {self.webhook_id} already succeeded, nothing to resend.')
+        else:
+            try:
+                with self.open_stream() as stream_resp:
+                    if stream_resp.status_code not in (200, 206):
+                        logging.error('Failed to download file.')
+                        self.report_status('failed', 0, reason='Failed to download file.')
+
+                        return http_response(500, 'failed', 'Failed to download file.')
+
+                    # A ranged response only has the rest of the file in its Content-Length.
+                    self.file_bytes = self.start_byte + int(stream_resp.headers.get('Content-Length'))
+                    self.process_stream(stream_resp)
+            except requests.exceptions.RequestException as e:
+                if not is_timeout(e):
+                    raise
+
+                # Committed batches are checkpointed so the retried lambda picks up from there.
+                logging.error(f'Timed out downloading file. {e}')
+                self.errors.append(e, kind='Timeout')
+                self.report_status('failed', round(self.total_bytes / (self.file_bytes or 1), 2), reason='Timed out downloading file.')
+
+                return http_response(500, 'failed', 'Timed out downloading file.')
+
+        return self.finish()
+
+    def finish(self):
+        # Duplicates are expected in an export with dedup_keys set so their count is a metric, not an error.
+        if self.deduplicator and self.deduplicator.suppressed:
+            self.metrics['dedup'] = {'keys': self.deduplicator.keys, 'suppressed': self.deduplicator.suppressed}
+            logging.info(f'Skipped {self.deduplicator.suppressed} rows with a duplicate {", ".join(self.deduplicator.keys)}.')
 
-                return http_response(500, 'failed', 'Failed to download file.')
+        # The status update only has room for one line per group, the metrics keep the counts and examples.
+        if self.errors:
+            self.metrics['errors'] = self.errors.summary()
 
-            self.file_bytes = int(stream_resp.headers.get('Content-Length'))
-            self.process_stream(stream_resp)
+        if self.metrics:
+            logging.info(f'Run metrics: {json.dumps(self.metrics)}')
 
+        self.save_checkpoint('succeeded')
         end_poll_response = self.report_status('succeeded', 1)
 
-        return http_response(end_poll_response.status_code, 'succeeded', self.errors)
+        return http_response(end_poll_response.status_code, 'succeeded', self.errors.report())
+
+    def load_checkpoint(self):
+        """
+        Move batch_offset up to the last committed row of a previous attempt. Offsets from the caller past the
+        checkpoint win since we can't tell what was sent after it.
+        """
+        if not self.checkpoint_store:
+            return None
+
+        checkpoint = safe_load(self.checkpoint_store, self.webhook_id)
+
+        if checkpoint and checkpoint['rows'] >= self.batch_offset:
+            logging.info(f'Resuming webhook {self.webhook_id} from checkpoint {checkpoint}')
+            self.batch_offset = checkpoint['rows']
+            self.start_byte = checkpoint.get('bytes') or 0
+        elif checkpoint:
+            checkpoint = None
+
+        return checkpoint
+
+    def save_checkpoint(self, state='running'):
+        if self.checkpoint_store:
+            checkpoint = make_checkpoint(self.batch_offset, self.start_byte or None, state)
+            safe_save(self.checkpoint_store, self.webhook_id, checkpoint)
+
+    def open_stream(self):
+        """
+        Open the data_url. When resuming with a byte offset ask for the rest of the file only, if the server ignores
+        the Range header or the format must be read from the start fall back to skipping rows.
+        """
+        if self.start_byte:
+            stream_resp = requests.get(self.data_url, stream=True, headers={'Range': f'bytes={self.start_byte}-'},
+                                       timeout=self.timeouts)
+
+            if stream_resp.status_code == 206 and self.get_reader(stream_resp).resumes_from_bytes:
+                return stream_resp
+
+            stream_resp.close()
+            self.start_byte = 0
+
+        return requests.get(self.data_url, stream=True, timeout=self.timeouts)
+
+    def get_reader(self, stream_resp):
+        if self.reader:
+            self.reader.start_byte = self.reader.bytes_read = self.start_byte
+            reader = self.reader
+        else:
+            schema = (self.settings or {}).get('schema') or self.record_schema
+            reader = get_reader(self.settings, stream_resp.headers.get('Content-Type'), self.data_url, schema, self.start_byte)
+
+        # Readers count decoded bytes, a Range into a gzip response would start at the wrong place in the encoded file.
+        if is_content_encoded(stream_resp):
+            reader.resumes_from_bytes = False
+
+        return reader
+
+    def read_position(self, reader, stream_resp):
+        """
+        How far into data_url reading got, comparable to its Content-Length. For a content-encoded response that is
+        the encoded bytes off the wire rather than the decoded bytes the reader counted.
+        """
+        if is_content_encoded(stream_resp):
+            return stream_resp.raw.tell()
+
+        return reader.bytes_read
 
     def process_stream(self, stream_resp):
         """
         Method that handles all batching logic. There is logic to account for catching up if a previous
         lamba has failed partly through executing. See our docs on how best to pass this into a lambda execution.
+
+        Decoding and batching is done by the reader so every input format hands runner_logic the same batches.
         """
-        data_batch = []
+        reader = self.get_reader(stream_resp)
+        # Resuming from a byte offset the rows before it were never downloaded so there is nothing to skip.
+        offset = 0 if self.start_byte else self.batch_offset
 
-        for i, row in enumerate(stream_resp.iter_lines()):
-            # We cannot stream to an offset so skip iterations while we are catching up.
-            if self.batch_offset and i < self.batch_offset:
-                continue
+        if self.map_workers > 1:
+            sent_batches = self.send_batches_in_processes(reader, stream_resp, offset)
+        else:
+            sent_batches = self.send_batches(reader, stream_resp, offset)
 
-            # The +1 is to account for newline characters which are removed b/c of .iter_lines()
-            self.total_bytes += len(row) + 1
-            data = json.loads(row)
+        for rows in sent_batches:
+            self.batch_offset += rows
 
-            if len(data_batch) < self.batch_size:
-                data_batch.append(data)
-            else:
-                self.runner_logic(data_batch)
-                data_batch = [data]
-                self.batch_offset += self.batch_size
+            if reader.resumes_from_bytes:
+                self.start_byte = self.total_bytes
+            self.save_checkpoint()
 
+            # The final status update reports completion so only report progress while there is more to read.
+            if self.total_bytes < self.file_bytes:
                 self.report_status('running', round(self.total_bytes / self.file_bytes, 2))
 
-        if len(data_batch) > 0:
-            self.runner_logic(data_batch)
+    def send_batches(self, reader, stream_resp, offset):
+        """
+        Run runner_logic on every batch, yielding the number of rows sent after each.
+        """
+        for data_batch in reader.iter_batches(stream_resp, self.batch_size, offset):
+            self.total_bytes = self.read_position(reader, stream_resp)
+            rows = len(data_batch)
+
+            if self.deduplicator:
+                data_batch, self.batch_rows = self.deduplicator.filter_rows(data_batch, self.batch_offset)
+
+            if data_batch:
+                self.runner_logic(data_batch)
+
+            yield rows
+
+    def send_batches_in_processes(self, reader, stream_resp, offset):
+        """
+        Same as send_batches but batches are decoded and prepared in map_workers processes. The main process keeps
+        reading the file and sends the prepared batches in file order.
+        """
+        def raw_batches():
+            start = self.batch_offset
+
+            # Dedup needs every key in one place so rows are decoded here and only prepared in the workers.
+            if self.deduplicator:
+                for data_batch in reader.iter_batches(stream_resp, self.batch_size, offset):
+                    unique, rows = self.deduplicator.filter_rows(data_batch, start)
+                    yield start, len(data_batch), unique, rows, self.read_position(reader, stream_resp)
+                    start += len(data_batch)
+                return
+
+            for raw_batch in reader.raw_batches(stream_resp, self.batch_size, offset):
+                yield start, len(raw_batch), raw_batch, None, self.read_position(reader, stream_resp)
+                start += len(raw_batch)
+
+        with ProcessMapper(functools.partial(self.prepare_in_worker, reader), self.map_workers) as mapper:
+            for rows, prepared, errors, bytes_read in mapper.imap(raw_batches()):
+                self.errors.extend(errors)
+                self.total_bytes = bytes_read
+
+                if prepared is not None:
+                    self.send_prepared(prepared)
+
+                yield rows
+
+    def prepare_in_worker(self, reader, item):
+        # batch_rows is only set for batches the main process decoded and deduplicated.
+        start, rows, batch, batch_rows, bytes_read = item
+        # This is a forked copy of the runner so its state can be set for the batch without locking.
+        self.batch_offset = start
+        self.batch_rows = batch_rows
+        self.errors = ErrorAggregator()
+        prepared = self.prepare(batch if batch_rows is not None else reader.decode_batch(batch)) if batch else None
+
+        return rows, prepared, self.errors, bytes_read
 
 
 class AmperityAPIRunner(AmperityRunner):
     def __init__(self, *args, destination_url=None, destination_session=None, req_per_min=0, custom_mapping=None,
-                 data_key=None, **kwargs):
+                 data_key=None, max_payload_bytes=None, message_id_key=None, max_concurrency=1, hedge=False,
+                 stream_body=None, partition_key=None, lanes=4, **kwargs):
         """
         Extension of the base AmperityRunner class designed to easily send data to an API endpoint.
 
@@ -165,6 +444,36 @@ class AmperityAPIRunner(AmperityRunner):
             A custom function that does some data manipulation. It should return a dict
         data_key : str, optional
             If your endpoint has a specific key that data needs to stored in.
+        max_payload_bytes : int, optional
+            Largest request body the endpoint accepts. When set each batch is packed into as few requests as fit
+            under the limit, measured on the serialized body. custom_mapping must return a list in this mode.
+        message_id_key : str, optional
+            Key to stamp a stable per-record id into (ie 'messageId'). The id is derived from the webhook_id and
+            the row number in the file, counting rows dropped by dedup, so a retried batch sends the same ids and the
+            endpoint can drop the duplicates.
+        max_concurrency : int, optional
+            Upper bound on requests in flight. Above 1 requests are sent from a thread pool and an AIMD controller
+            finds the concurrency the endpoint handles, growing it while responses are fast and cutting it on 429s,
+            5xx or rising latency. Overridden by the 'max_concurrency' setting or AMPERITY_MAX_CONCURRENCY. See
+            lambdas.concurrency.
+        hedge : bool, optional
+            Send a duplicate of a request that takes longer than the p95 of recent requests and use whichever
+            answers first. Only for endpoints that can take the same body twice, ie upserts or with message_id_key.
+            Not allowed with partition_key, the losing request can land after the lane's next one. Overridden by the
+            'hedge' setting. See lambdas.timeouts.
+        stream_body : str, optional
+            'chunked' to send each request with chunked transfer encoding, encoding records as they are written
+            instead of building the whole body in memory first. 'sized' does the same with a Content-Length for
+            endpoints that don't take chunked bodies, at the cost of encoding every record twice. Overridden by the
+            'stream_body' setting. Ignored with max_payload_bytes. See lambdas.bodies.
+        partition_key : str, optional
+            Record field whose events must arrive in order, ie 'cust_id' for the userId of Rudderstack events.
+            Records are hashed by it into lanes, each lane sends its requests one after another and the lanes run
+            at once. With max_concurrency the AIMD controller limits how many lanes send at a time. A request
+            abandoned at the overall request_timeout may still arrive after the lane's next one, turn request_timeout
+            off when order must hold even then. Overridden by the 'partition_key' setting.
+        lanes : int, optional
+            How many lanes to hash records into. Overridden by the 'lanes' setting.
         """
         super().__init__(*args, **kwargs)
 
@@ -173,6 +482,8 @@ class AmperityAPIRunner(AmperityRunner):
         self.req_per_min = req_per_min
         self.custom_mapping = custom_mapping
         self.data_key = data_key
+        self.max_payload_bytes = max_payload_bytes
+        self.message_id_key = message_id_key
         # NOTE - testing locally you will need to add a mount for 'http://'
         self.destination_session.mount('https://', HTTPAdapter(max_retries=Retry(
             total=3,
@@ -183,25 +494,289 @@ class AmperityAPIRunner(AmperityRunner):
 
         self.num_requests = 0
         self.rate_limit_time_start = None
+        self.rate_limit_lock = threading.Lock()
+
+        settings = self.settings or {}
+        self.max_concurrency = int(settings.get('max_concurrency') or os.getenv('AMPERITY_MAX_CONCURRENCY') or max_concurrency)
+        self.concurrency = AIMDController(self.max_concurrency) if self.max_concurrency > 1 else None
+        self.in_flight = OffsetTracker()
+        self.dispatch_pool = None
+        self.dispatch_error = None
+
+        self.partition_key = settings.get('partition_key') or partition_key
+        self.lanes = int(settings.get('lanes') or lanes) if self.partition_key else 0
+        self.lane_queues = None
+
+        self.hedge = bool(settings.get('hedge', hedge))
+        self.stream_body = settings.get('stream_body', stream_body)
+
+        if self.stream_body not in (None, 'chunked', 'sized'):
+            raise ValueError(f"stream_body must be 'chunked' or 'sized', got {self.stream_body!r}.")
+        if self.hedge and self.partition_key:
+            raise ValueError('hedge can reorder the requests of a lane, it is not supported with partition_key.')
+
+        self.latencies = LatencyWindow()
+        self.hedge_lock = threading.Lock()
 
-    @rate_limit
     def runner_logic(self, data):
+        self.send_prepared(self.prepare(data))
+
+    def send_prepared(self, prepared):
+        if self.lanes:
+            return self.send_to_lanes(prepared)
+
+        # Sinks of a fan-out runner are handed batches without reading the file so they send them in order.
+        if not self.dispatch_pool:
+            for output_data in prepared:
+                self.send_request(output_data)
+            return
+
+        batch = self.in_flight.start(len(prepared))
+
+        for output_data in prepared:
+            sent_at = self.concurrency.acquire()
+            self.dispatch_pool.submit(self.dispatch, output_data, sent_at, batch)
+
+        if self.dispatch_error:
+            raise self.dispatch_error
+
+    def dispatch(self, output_data, sent_at, batch):
+        """
+        Send one request from the pool and feed its outcome to the concurrency controller.
+        """
+        resp = None
+
+        try:
+            resp = self.send_request(output_data)
+        except Exception as e:
+            # Raised in the main thread on the next batch like it would have been without the pool.
+            self.dispatch_error = self.dispatch_error or e
+        finally:
+            self.concurrency.release(sent_at, resp.status_code if resp is not None else None)
+            self.in_flight.finish(batch)
+
+    def send_to_lanes(self, prepared):
+        """
+        prepared is a list of (lane, request bodies). Without lane threads, ie as a fan-out sink, they are sent in
+        order here.
+        """
+        if not self.lane_queues:
+            for _, bodies in prepared:
+                for output_data in bodies:
+                    self.send_request(output_data)
+            return
+
+        batch = self.in_flight.start(sum(len(bodies) for _, bodies in prepared))
+
+        for lane, bodies in prepared:
+            for output_data in bodies:
+                # Lane queues are bounded so reading waits for the slowest lane instead of buffering the file.
+                self.lane_queues[lane].put((output_data, batch))
+
+        if self.dispatch_error:
+            raise self.dispatch_error
+
+    def drain_lane(self, lane_queue):
+        """
+        Send the requests of one lane in the order they were queued. A request abandoned at the overall
+        request_timeout keeps running in its own thread and can still land after the next one.
+        """
+        while True:
+            item = lane_queue.get()
+
+            if item is None:
+                return
+
+            output_data, batch = item
+            sent_at = self.concurrency.acquire() if self.concurrency else None
+            resp = None
+
+            try:
+                resp = self.send_request(output_data)
+            except Exception as e:
+                self.dispatch_error = self.dispatch_error or e
+            finally:
+                if self.concurrency:
+                    self.concurrency.release(sent_at, resp.status_code if resp is not None else None)
+                self.in_flight.finish(batch)
+
+    def process_stream(self, stream_resp):
+        if self.lanes:
+            return self.process_stream_in_lanes(stream_resp)
+
+        if not self.concurrency:
+            return super().process_stream(stream_resp)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as self.dispatch_pool:
+            super().process_stream(stream_resp)
+
+        self.dispatch_pool = None
+        self.metrics['concurrency'] = self.concurrency.summary()
+
+        if self.dispatch_error:
+            raise self.dispatch_error
+
+        # Commit the batches that were still in flight after the last one was read.
+        self.save_checkpoint()
+
+    def process_stream_in_lanes(self, stream_resp):
+        self.lane_queues = [queue.Queue(maxsize=LANE_QUEUE_DEPTH) for _ in range(self.lanes)]
+        threads = [threading.Thread(target=self.drain_lane, args=(lane_queue,), daemon=True) for lane_queue in self.lane_queues]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            super().process_stream(stream_resp)
+        finally:
+            for lane_queue in self.lane_queues:
+                lane_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+            self.lane_queues = None
+
+        if self.concurrency:
+            self.metrics['concurrency'] = self.concurrency.summary()
+
+        if self.dispatch_error:
+            raise self.dispatch_error
+
+        self.save_checkpoint()
+
+    def sends_in_background(self):
+        """
+        Whether requests of a batch can still be in flight when send_prepared returns.
+        """
+        return bool(self.concurrency or self.lanes)
+
+    def save_checkpoint(self, state='running'):
+        """
+        With requests in flight a checkpoint only covers the batches that are fully sent, in lane mode by every
+        lane. See OffsetTracker.
+        """
+        if not self.sends_in_background():
+            return super().save_checkpoint(state)
+
+        self.in_flight.end((self.batch_offset, self.start_byte))
+        committed = self.in_flight.commit()
+
+        if self.checkpoint_store and committed:
+            rows, byte_offset = committed
+            safe_save(self.checkpoint_store, self.webhook_id, make_checkpoint(rows, byte_offset or None, state))
+
+    def prepare(self, data):
+        """
+        Map a batch of records and serialize it into the request bodies to send.
+        """
+        if self.message_id_key:
+            for row, record in zip(self.row_numbers(data), data):
+                if record.get(self.message_id_key) is None:
+                    record[self.message_id_key] = str(uuid.uuid5(uuid.NAMESPACE_URL, f'{self.webhook_id}:{row}'))
+
+        if self.lanes:
+            return [(lane, self.serialize(records)) for lane, records in partition(data, self.partition_key, self.lanes)]
+
+        return self.serialize(data)
+
+    def serialize(self, data):
+        """
+        Map records and turn them into request bodies.
+        """
         mapped_data = self.custom_mapping(data) if self.custom_mapping else data
-        output_data = json.dumps({self.data_key: mapped_data}) if self.data_key else json.dumps(mapped_data)
 
+        if self.max_payload_bytes:
+            return self.pack_payloads(mapped_data)
+
+        # A custom_mapping returning a single object is small enough to serialize at once.
+        if self.stream_body and isinstance(mapped_data, list):
+            body_type = SizedJSONArrayBody if self.stream_body == 'sized' else JSONArrayBody
+            return [body_type(mapped_data, self.data_key)]
+
+        output_data = {self.data_key: mapped_data} if self.data_key else mapped_data
+
+        return [json.dumps(output_data, default=to_builtins)]
+
+    def pack_payloads(self, records):
+        """
+        Greedily pack serialized records into bodies no larger than max_payload_bytes. Each record is serialized
+        once and the bodies are joined the same way json.dumps would have written them.
+        """
+        prefix = f'{{{json.dumps(self.data_key)}: [' if self.data_key else '['
+        suffix = ']}' if self.data_key else ']'
+        payloads = []
+        chunk = []
+        # json.dumps escapes non-ascii characters by default so string length is the size in bytes.
+        size = len(prefix) + len(suffix)
+
+        for record in records:
+            encoded = json.dumps(record, default=to_builtins)
+
+            if len(prefix) + len(encoded) + len(suffix) > self.max_payload_bytes:
+                self.errors.append(f'Record of {len(encoded)} bytes exceeds the {self.max_payload_bytes} byte request limit.')
+                continue
+
+            separator = 2 if chunk else 0
+
+            if size + separator + len(encoded) > self.max_payload_bytes:
+                payloads.append(prefix + ', '.join(chunk) + suffix)
+                chunk = []
+                size = len(prefix) + len(suffix)
+                separator = 0
+
+            chunk.append(encoded)
+            size += separator + len(encoded)
+
+        if chunk:
+            payloads.append(prefix + ', '.join(chunk) + suffix)
+
+        return payloads
+
+    def send_with_hedge(self, call):
+        """
+        Same as call_with_timeout but hedged past the p95 latency of destination requests when hedge is on. Only
+        for destination requests, status updates are never hedged and don't count towards the p95.
+        """
+        hedge_after = self.latencies.percentile(HEDGE_PERCENTILE) if self.hedge else None
+
+        start = time.monotonic()
+
+        if self.request_timeout or hedge_after is not None:
+            resp, attempts, hedged = call_with_timeout(call, self.request_timeout, hedge_after)
+        else:
+            resp, attempts, hedged = call(), 1, False
+
+        if self.hedge:
+            self.latencies.add(time.monotonic() - start)
+
+        if attempts > 1:
+            with self.hedge_lock:
+                hedging = self.metrics.setdefault('hedging', {'sent': 0, 'won': 0})
+                hedging['sent'] += 1
+                hedging['won'] += hedged
+                hedging['p95_ms'] = round(hedge_after * 1000, 1)
+
+        return resp
+
+    @rate_limit
+    def send_request(self, output_data):
         try:
-            resp = self.destination_session.post(
+            resp = self.send_with_hedge(lambda: self.destination_session.post(
                 url=self.destination_url,
-                data=output_data
-            )
+                data=output_data,
+                timeout=self.timeouts,
+            ))
 
             if not resp.ok:
-                self.errors.append(resp.text)
+                self.errors.append(resp.text, status=resp.status_code)
+
+            return resp
         except RetryError as e:
             logging.error(f'Exceeded retries trying to communicate with destination. {self.destination_url}')
-            self.errors.append(str(e))
-
-        self.num_requests += len(output_data)
+            self.errors.append(e)
+        except requests.exceptions.Timeout as e:
+            logging.error(f'Timed out sending to destination. {self.destination_url}')
+            self.errors.append(e, kind='Timeout')
 
 
 class AmperityBotoRunner(AmperityRunner):
@@ -221,3 +796,162 @@ class AmperityBotoRunner(AmperityRunner):
 
     def runner_logic(self, data):
         raise NotImplementedError('Please implement your boto runnder logic.')
+
+
+class AmperityFanOutRunner(AmperityRunner):
+    def __init__(self, *args, sinks=None, queue_depth=4, **kwargs):
+        """
+        Extension of the base AmperityRunner class that reads and decodes data_url once and sends every batch to
+        several runners, ie Redshift and Rudderstack from a single lambda. Each sink sends on its own thread with its
+        own rate limiting, errors and row offset. Errors and progress are combined into one status for Amperity.
+
+        sinks : dict
+            Runner instances by name, ie {'redshift': AmperityRedshiftRunner(...), 'rudderstack': AmperityAPIRunner(...)}.
+            Only their runner_logic and batch_size are used, rows are regrouped into each sink's batch_size.
+        queue_depth : int, optional
+            How many batches a slow sink can fall behind before reading the file pauses.
+
+        map_workers and dedup_keys are not applied, sinks resume by row number so every row is handed to them.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.sinks = sinks or {}
+        self.queue_depth = queue_depth
+        # Rows each sink has sent, a sink that failed keeps the offset it reached.
+        self.sink_offsets = {}
+        self.failed_sinks = {}
+        # (row, bytes) at each batch boundary read so far, used to map committed rows back to a byte offset.
+        self.batch_ends = []
+        self.resumes_from_bytes = False
+        self.lock = threading.Lock()
+
+    def report_status(self, *args, **kwargs):
+        # Sinks add their errors from their own threads.
+        with self.lock:
+            return super().report_status(*args, **kwargs)
+
+    def load_checkpoint(self):
+        checkpoint = super().load_checkpoint()
+        sink_offsets = (checkpoint or {}).get('sinks', {})
+        self.sink_offsets = {name: max(sink_offsets.get(name, 0), self.batch_offset) for name in self.sinks}
+
+        return checkpoint
+
+    def committed(self, sinks):
+        """
+        The last batch boundary every one of sinks has sent past, as (row, bytes).
+        """
+        rows = min((self.sink_offsets[name] for name in sinks), default=self.batch_offset)
+
+        return next(((row, byte_offset) for row, byte_offset in reversed(self.batch_ends) if row <= rows),
+                    (self.batch_offset, self.start_byte))
+
+    def save_checkpoint(self, state='running'):
+        if not self.checkpoint_store:
+            return
+
+        with self.lock:
+            rows, byte_offset = self.committed(self.sinks)
+            checkpoint = make_checkpoint(rows, byte_offset if self.resumes_from_bytes else None, state,
+                                         sinks=dict(self.sink_offsets))
+
+        safe_save(self.checkpoint_store, self.webhook_id, checkpoint)
+
+    def progress(self):
+        with self.lock:
+            _, byte_offset = self.committed([name for name in self.sinks if name not in self.failed_sinks])
+
+        return round(byte_offset / self.file_bytes, 2) if self.file_bytes else 0
+
+    def process_stream(self, stream_resp):
+        reader = self.get_reader(stream_resp)
+        offset = 0 if self.start_byte else self.batch_offset
+        row = self.batch_offset
+
+        self.resumes_from_bytes = reader.resumes_from_bytes
+        self.batch_ends = [(row, self.start_byte)]
+
+        batches = {name: queue.Queue(self.queue_depth) for name in self.sinks}
+        threads = [
+            threading.Thread(target=self.drain, args=(name, sink, batches[name]), daemon=True)
+            for name, sink in self.sinks.items()
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for data_batch in reader.iter_batches(stream_resp, self.batch_size, offset):
+                for sink_batches in batches.values():
+                    sink_batches.put((row, data_batch))
+
+                row += len(data_batch)
+                self.total_bytes = self.read_position(reader, stream_resp)
+
+                with self.lock:
+                    self.batch_ends.append((row, self.total_bytes))
+
+                self.save_checkpoint()
+
+                if self.total_bytes < self.file_bytes:
+                    self.report_status('running', self.progress())
+        finally:
+            for sink_batches in batches.values():
+                sink_batches.put(None)
+            for thread in threads:
+                thread.join()
+
+        self.batch_offset = row
+
+    def drain(self, name, sink, batches):
+        """
+        Sink thread. Regroups batches into the sink's batch_size and skips rows it sent in an earlier attempt.
+        """
+        buffer = []
+
+        while True:
+            item = batches.get()
+
+            if item is None:
+                break
+
+            # Keep taking batches after a failure so the reader is never blocked on this sink.
+            if name in self.failed_sinks:
+                continue
+
+            start, data_batch = item
+            skip = max(self.sink_offsets[name] + len(buffer) - start, 0)
+            # Sinks may change records in place (custom_mapping, message ids) so each gets its own copy.
+            buffer.extend(copy.copy(record) for record in data_batch[skip:])
+
+            while len(buffer) >= sink.batch_size and name not in self.failed_sinks:
+                self.send_to_sink(name, sink, buffer[:sink.batch_size])
+                buffer = buffer[sink.batch_size:]
+
+        if buffer and name not in self.failed_sinks:
+            self.send_to_sink(name, sink, buffer)
+
+    def send_to_sink(self, name, sink, data):
+        sink.batch_offset = self.sink_offsets[name]
+
+        try:
+            sink.runner_logic(data)
+            sent = len(data)
+        except Exception as e:
+            logging.exception(f'Sink {name} failed, it will not be sent the rest of the file.')
+            self.failed_sinks[name] = str(e)
+            sent = 0
+
+        with self.lock:
+            self.sink_offsets[name] += sent
+            self.errors.extend(sink.errors, prefix=f'{name}: ')
+            sink.errors = ErrorAggregator()
+
+    def finish(self):
+        if not self.failed_sinks:
+            return super().finish()
+
+        self.save_checkpoint()
+        reason = ' '.join(f'{name} failed: {error}.' for name, error in self.failed_sinks.items())
+        self.report_status('failed', self.progress(), reason=reason)
+
+        return http_response(500, 'failed', reason)
@@ -0,0 +1,291 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from lambdas.amperity_runner import AmperityBotoRunner
+from lambdas.concurrency import partition
+from lambdas.records import to_builtins
+
+
+"""
+Runners that write every record as a message to an AWS stream: SQS queues, Kinesis data streams and Firehose
+delivery streams. Records are packed into the largest batches the service's batch API takes, several batch calls
+run at once and only the entries a partial failure response marks as failed are retried.
+
+SQS FIFO message groups and Kinesis partition keys promise order per key, so with a key set every key is sent from
+one worker, one batch at a time, and a batch never holds two records of the same key. A failed entry is then retried
+before any later record of its key is sent.
+"""
+
+
+STREAM_MAX_WORKERS = int(os.getenv('AWS_STREAM_MAX_WORKERS', 4))
+STREAM_MAX_RETRIES = int(os.getenv('AWS_STREAM_MAX_RETRIES', 5))
+STREAM_BACKOFF_SECONDS = float(os.getenv('AWS_STREAM_BACKOFF_SECONDS', 0.1))
+
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'ServiceUnavailableException',
+    'ServiceUnavailable',
+    'InternalFailure',
+    'InternalError',
+    'RequestThrottled',
+}
+
+
+class AmperityStreamRunner(AmperityBotoRunner):
+    # Limits of the service's batch API, set by subclasses.
+    max_entries = None
+    max_batch_bytes = None
+    max_entry_bytes = None
+    # Record field whose records must arrive in order, set by subclasses.
+    ordering_key = None
+
+    def __init__(self, *args, custom_mapping=None, max_workers=STREAM_MAX_WORKERS, max_retries=STREAM_MAX_RETRIES, **kwargs):
+        """
+        Extension of AmperityBotoRunner that sends each record as one message.
+
+        custom_mapping : func, optional
+            Maps a single record to the message to send, it should return a json serializable value.
+        max_workers : int, optional
+            How many batch calls run at once.
+        max_retries : int, optional
+            How many times failed entries are retried before they are recorded as errors.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.custom_mapping = custom_mapping
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+    def runner_logic(self, data):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            if not self.ordering_key:
+                list(pool.map(self.send_chunk, self.pack(data)))
+                return
+
+            lanes = partition(data, self.ordering_key, self.max_workers)
+            list(pool.map(self.send_lane, [self.pack(records) for _, records in lanes]))
+
+    def send_lane(self, chunks):
+        for chunk in chunks:
+            self.send_chunk(chunk)
+
+    def encode(self, record):
+        message = self.custom_mapping(record) if self.custom_mapping else record
+
+        return json.dumps(message, default=to_builtins).encode('utf-8')
+
+    def pack(self, data):
+        """
+        Greedily pack entries into chunks under the entry count and byte limits of the batch API. With an
+        ordering_key a record goes in the first chunk with room after the last one holding its key, so each chunk
+        has at most one record per key and the records of a key keep their order across chunks.
+        """
+        chunks = []
+        sizes = []
+        last_chunk = {}
+        first_open = 0
+
+        for record in data:
+            entry, entry_bytes = self.make_entry(record)
+
+            if entry_bytes > self.max_entry_bytes:
+                self.errors.append(f'Record of {entry_bytes} bytes exceeds the {self.max_entry_bytes} byte message limit.')
+                continue
+
+            key = record.get(self.ordering_key) if self.ordering_key else None
+
+            if key is None:
+                # Only the last chunk is open, same as packing without a key.
+                start = max(len(chunks) - 1, 0)
+            else:
+                start = max(last_chunk.get(key, -1) + 1, first_open)
+
+            i = start
+            while i < len(chunks) and (len(chunks[i]) == self.max_entries or sizes[i] + entry_bytes > self.max_batch_bytes):
+                i += 1
+
+            if i == len(chunks):
+                chunks.append([])
+                sizes.append(0)
+
+            chunks[i].append(entry)
+            sizes[i] += entry_bytes
+            last_chunk[key] = i
+
+            while first_open < len(chunks) and len(chunks[first_open]) == self.max_entries:
+                first_open += 1
+
+        return chunks
+
+    def send_chunk(self, entries):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Full jitter so concurrent chunks don't retry in lockstep.
+                time.sleep(random.uniform(0, STREAM_BACKOFF_SECONDS * 2 ** attempt))
+
+            try:
+                entries = self.put_entries(entries)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERROR_CODES:
+                    self.errors.append(e, kind=e.response['Error']['Code'])
+                    return
+
+                logging.info(f'{e.response["Error"]["Code"]} sending {len(entries)} entries, retrying.')
+                continue
+
+            if not entries:
+                return
+
+            logging.info(f'{len(entries)} entries failed, retrying them.')
+
+        self.errors.append(f'Exceeded retries for {len(entries)} entries.', kind='RetriesExceeded')
+
+    def make_entry(self, record):
+        """
+        Return (entry, size in bytes counted against the batch limit).
+        """
+        raise NotImplementedError('Please implement make_entry for your stream runner.')
+
+    def put_entries(self, entries):
+        """
+        Send one batch and return the entries to retry. Entries that failed for good are added to errors.
+        """
+        raise NotImplementedError('Please implement put_entries for your stream runner.')
+
+    def retry_failed(self, entries, results):
+        """
+        Kinesis and Firehose return one result per entry in order, failed ones have an ErrorCode.
+        """
+        retry = []
+
+        for entry, result in zip(entries, results):
+            if 'ErrorCode' not in result:
+                continue
+
+            if result['ErrorCode'] in RETRYABLE_ERROR_CODES:
+                retry.append(entry)
+            else:
+                self.errors.append(result.get('ErrorMessage', result['ErrorCode']), kind=result['ErrorCode'])
+
+        return retry
+
+
+class AmperitySQSRunner(AmperityStreamRunner):
+    """
+    send_message_batch takes 10 messages of up to 256 KiB in total.
+    """
+    max_entries = 10
+    max_batch_bytes = 262144
+    max_entry_bytes = 262144
+
+    def __init__(self, *args, queue_url=None, message_group_key=None, **kwargs):
+        """
+        queue_url : str
+        message_group_key : str, optional
+            For FIFO queues, the record field to use as MessageGroupId. MessageDeduplicationId is a hash of the body.
+            Messages of a group are sent in order, see the module docstring.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.queue_url = queue_url
+        self.message_group_key = message_group_key
+        self.ordering_key = message_group_key
+
+    def make_entry(self, record):
+        body = self.encode(record)
+        entry = {'MessageBody': body.decode('utf-8')}
+
+        if self.message_group_key:
+            entry['MessageGroupId'] = str(record.get(self.message_group_key))
+            entry['MessageDeduplicationId'] = hashlib.sha256(body).hexdigest()
+
+        return entry, len(body)
+
+    def put_entries(self, entries):
+        # Ids only need to be unique within a call, failures are matched back to entries by position.
+        resp = self.boto_client.send_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[dict(entry, Id=str(i)) for i, entry in enumerate(entries)],
+        )
+        retry = []
+
+        for failure in resp.get('Failed', []):
+            # SenderFault means the message itself is invalid, sending it again won't help.
+            if failure['SenderFault']:
+                self.errors.append(failure.get('Message', failure['Code']), kind=failure['Code'])
+            else:
+                retry.append(entries[int(failure['Id'])])
+
+        return retry
+
+
+class AmperityKinesisRunner(AmperityStreamRunner):
+    """
+    put_records takes 500 records of up to 1 MiB each and 5 MiB in total, partition keys included.
+    """
+    max_entries = 500
+    max_batch_bytes = 5242880
+    max_entry_bytes = 1048576
+
+    def __init__(self, *args, stream_name=None, partition_key=None, **kwargs):
+        """
+        stream_name : str
+        partition_key : str, optional
+            Record field to partition by, ie 'amperity_id' to keep one customer's records in order on one shard.
+            Records of a key are sent in order, see the module docstring. Without it records are spread over shards
+            by a hash of their data.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.stream_name = stream_name
+        self.partition_key = partition_key
+        self.ordering_key = partition_key
+
+    def make_entry(self, record):
+        data = self.encode(record)
+
+        if self.partition_key and record.get(self.partition_key) is not None:
+            key = str(record.get(self.partition_key))
+        else:
+            key = hashlib.md5(data).hexdigest()
+
+        return {'Data': data, 'PartitionKey': key}, len(data) + len(key.encode('utf-8'))
+
+    def put_entries(self, entries):
+        resp = self.boto_client.put_records(StreamName=self.stream_name, Records=entries)
+
+        return self.retry_failed(entries, resp['Records']) if resp.get('FailedRecordCount') else []
+
+
+class AmperityFirehoseRunner(AmperityStreamRunner):
+    """
+    put_record_batch takes 500 records of up to 1,000 KiB each and 4 MiB in total. Records are newline delimited
+    so the objects Firehose writes to S3 are NDJSON.
+    """
+    max_entries = 500
+    max_batch_bytes = 4194304
+    max_entry_bytes = 1024000
+
+    def __init__(self, *args, delivery_stream_name=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.delivery_stream_name = delivery_stream_name
+
+    def make_entry(self, record):
+        data = self.encode(record) + b'\n'
+
+        return {'Data': data}, len(data)
+
+    def put_entries(self, entries):
+        resp = self.boto_client.put_record_batch(DeliveryStreamName=self.delivery_stream_name, Records=entries)
+
+        return self.retry_failed(entries, resp['RequestResponses']) if resp.get('FailedPutCount') else []
@@ -0,0 +1,71 @@
+import json
+import os
+
+from lambdas.records import to_builtins
+
+
+"""
+Request bodies that encode records while they are sent. json.dumps of a whole batch holds the mapped records, the
+serialized string and the copy requests encodes to bytes at once. A JSONArrayBody only keeps the records, each is
+serialized when the connection asks for the next chunk so the extra memory is one chunk whatever the batch size.
+
+requests sends an iterable body with chunked transfer encoding, or with a Content-Length when it has a length.
+Every iteration starts over so urllib3 retries and hedged requests send the whole body again.
+"""
+
+
+BODY_CHUNK_SIZE = int(os.getenv('AMPERITY_BODY_CHUNK_SIZE', 65536))
+
+
+class JSONArrayBody:
+    def __init__(self, records, data_key=None, chunk_size=BODY_CHUNK_SIZE):
+        """
+        records : list
+            The mapped records, sent as a json array.
+        data_key : str, optional
+            Nest the array under this key, ie {"data": [...]}.
+        chunk_size : int, optional
+            Encoded records are buffered into chunks of about this many bytes before they are written.
+        """
+        self.records = records
+        self.prefix = f'{{{json.dumps(data_key)}: ['.encode('utf-8') if data_key else b'['
+        self.suffix = b']}' if data_key else b']'
+        self.chunk_size = chunk_size
+
+    def encode(self, record):
+        return json.dumps(record, default=to_builtins).encode('utf-8')
+
+    def __iter__(self):
+        # Separators match json.dumps so the body is the same as the one built in memory.
+        chunk = [self.prefix]
+        size = len(self.prefix)
+
+        for i, record in enumerate(self.records):
+            encoded = self.encode(record)
+
+            if i:
+                chunk.append(b', ')
+                size += 2
+
+            chunk.append(encoded)
+            size += len(encoded)
+
+            if size >= self.chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+
+        chunk.append(self.suffix)
+        yield b''.join(chunk)
+
+
+class SizedJSONArrayBody(JSONArrayBody):
+    """
+    A JSONArrayBody with a length so requests sends a Content-Length, for endpoints that don't take chunked
+    bodies. The records are encoded once more to count the bytes, which costs CPU but no memory.
+    """
+    def __len__(self):
+        if not hasattr(self, 'length'):
+            self.length = sum(len(chunk) for chunk in self)
+
+        return self.length
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import time
+
+from urllib.parse import urlparse
+
+
+"""
+Checkpoint stores remember how far a run got so a retried lambda (timeout, out of memory, async retry) resumes
+where the last one stopped instead of resending everything. Checkpoints are keyed by webhook_id and look like:
+
+    {'rows': 1500, 'bytes': 734003, 'state': 'running', 'updated_at': 1700000000}
+
+'bytes' is the offset just past the last committed row, or None when the input format can't be resumed by byte.
+Pick a store with a URI in the 'checkpoint_store' setting or AMPERITY_CHECKPOINT_STORE:
+
+    file:///tmp/checkpoints, s3://my-bucket/checkpoints or dynamodb://my-table
+
+The DynamoDB table needs a 'webhook_id' string partition key.
+"""
+
+
+class CheckpointStore:
+    def load(self, key):
+        """
+        Return the checkpoint dict saved for key, or None.
+        """
+        raise NotImplementedError('Please implement load for your checkpoint store.')
+
+    def save(self, key, checkpoint):
+        raise NotImplementedError('Please implement save for your checkpoint store.')
+
+
+class LocalCheckpointStore(CheckpointStore):
+    """
+    One json file per webhook in a directory. Lambda only keeps /tmp for a warm container so this is mostly for
+    local development and tests, use S3 or DynamoDB for a deployed lambda.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def load(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, checkpoint):
+        # Write then rename so a process killed mid write never leaves a partial checkpoint.
+        tmp_path = f'{self.path(key)}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+
+        os.replace(tmp_path, self.path(key))
+
+
+class S3CheckpointStore(CheckpointStore):
+    def __init__(self, bucket, prefix='', client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = client or boto3_client('s3')
+
+    def object_key(self, key):
+        return f'{self.prefix}/{key}.json' if self.prefix else f'{key}.json'
+
+    def load(self, key):
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+        return json.loads(obj['Body'].read())
+
+    def save(self, key, checkpoint):
+        self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=json.dumps(checkpoint))
+
+
+class DynamoDBCheckpointStore(CheckpointStore):
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client or boto3_client('dynamodb')
+
+    def load(self, key):
+        item = self.client.get_item(TableName=self.table, Key={'webhook_id': {'S': key}}, ConsistentRead=True).get('Item')
+
+        return json.loads(item['checkpoint']['S']) if item else None
+
+    def save(self, key, checkpoint):
+        self.client.put_item(TableName=self.table, Item={
+            'webhook_id': {'S': key},
+            'checkpoint': {'S': json.dumps(checkpoint)},
+        })
+
+
+def boto3_client(service):
+    # boto3 is always available in the lambda runtime but is not a dependency of the runner itself.
+    import boto3
+
+    return boto3.client(service)
+
+
+def get_checkpoint_store(uri):
+    """
+    Build a store from a URI, see the module docstring. Returns None when uri is empty so checkpointing is off.
+    """
+    if not uri:
+        return None
+
+    parsed = urlparse(uri)
+
+    if parsed.scheme == 's3':
+        return S3CheckpointStore(parsed.netloc, parsed.path)
+    if parsed.scheme == 'dynamodb':
+        return DynamoDBCheckpointStore(parsed.netloc)
+    if parsed.scheme in ('', 'file'):
+        return LocalCheckpointStore(parsed.path)
+
+    raise ValueError(f'Unknown checkpoint store {uri}. Use a file://, s3:// or dynamodb:// URI.')
+
+
+def make_checkpoint(rows, byte_offset=None, state='running', **extra):
+    return dict(extra, rows=rows, bytes=byte_offset, state=state, updated_at=int(time.time()))
+
+
+def safe_get_checkpoint_store(uri):
+    """
+    Same as get_checkpoint_store but a bad URI or a store that can't be set up only turns checkpointing off, the
+    lambda still runs and reports its status to Amperity.
+    """
+    try:
+        return get_checkpoint_store(uri)
+    except Exception as e:
+        logging.error(f'Running without checkpoints, failed to set up checkpoint store {uri}. {e}')
+
+
+def safe_load(store, key):
+    """
+    A checkpoint store being unavailable should not stop a run, it starts from the requested offset instead.
+    """
+    try:
+        return store.load(key)
+    except Exception as e:
+        logging.error(f'Failed to load checkpoint for {key}. {e}')
+
+
+def safe_save(store, key, checkpoint):
+    try:
+        store.save(key, checkpoint)
+    except Exception as e:
+        logging.error(f'Failed to save checkpoint for {key}. {e}')
@@ -0,0 +1,229 @@
+import collections
+import logging
+import os
+import threading
+import time
+import zlib
+
+
+"""
+Adaptive concurrency for sending to a destination. A fixed number of requests in flight is either too low (the
+lambda waits on the network) or too high (the destination throttles us), and which one depends on the destination
+and the time of day. AIMDController is the same additive increase, multiplicative decrease scheme TCP uses: while
+responses are healthy the limit grows by one per round of requests, a throttle (429), a server error or latency
+well above the fastest seen so far cuts it by BACKOFF.
+
+OffsetTracker keeps checkpoints honest while batches are still in flight, a checkpoint only moves past a batch
+once every request of it and of the batches before it finished.
+
+For destinations that need one customer's events in order, partition splits a batch into lanes by a hash of a key.
+Each lane is sent in order by its own thread so requests run in parallel across keys but never within one.
+"""
+
+
+MIN_CONCURRENCY = int(os.getenv('AMPERITY_MIN_CONCURRENCY', 1))
+BACKOFF = float(os.getenv('AMPERITY_CONCURRENCY_BACKOFF', 0.5))
+# How many times slower than the fastest response recent responses may get before it counts as congestion.
+LATENCY_TOLERANCE = float(os.getenv('AMPERITY_LATENCY_TOLERANCE', 2.0))
+# Seconds of extra latency always tolerated so jitter on a very fast destination isn't taken for congestion.
+LATENCY_SLACK = 0.01
+# Weight of the newest response in the recent latency average.
+LATENCY_SMOOTHING = 0.2
+# Decisions kept for the run metrics.
+MAX_DECISIONS = 50
+# Requests queued per lane before reading the file waits for the lane to catch up.
+LANE_QUEUE_DEPTH = int(os.getenv('AMPERITY_LANE_QUEUE_DEPTH', 4))
+
+
+def is_congested(status):
+    """
+    No response (connection error or exceeded retries), a throttle or a server error.
+    """
+    return status is None or status == 429 or status >= 500
+
+
+def partition(data, key, lanes):
+    """
+    Split records into (lane, records) by a hash of record[key], keeping their order within each lane. The hash is
+    stable across runs so a retried lambda puts a key in the same lane. Records without the key have no order to
+    keep and are spread evenly.
+    """
+    split = collections.defaultdict(list)
+
+    for i, record in enumerate(data):
+        value = record.get(key)
+        lane = i % lanes if value is None else zlib.crc32(str(value).encode('utf-8')) % lanes
+        split[lane].append(record)
+
+    return sorted(split.items())
+
+
+class AIMDController:
+    def __init__(self, max_limit, min_limit=MIN_CONCURRENCY, backoff=BACKOFF, latency_tolerance=LATENCY_TOLERANCE):
+        """
+        max_limit : int
+            Most requests in flight at once, the limit never grows past it.
+        min_limit : int, optional
+            Fewest requests in flight, the limit is never cut below it. Also where the limit starts.
+        backoff : float, optional
+            Share of the limit kept when congestion is seen.
+        latency_tolerance : float, optional
+            Recent latency over this multiple of the fastest response counts as congestion.
+        """
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+
+        self.limit = float(self.min_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+        self.start = time.monotonic()
+        self.min_latency = None
+        self.latency = None
+        # Responses to requests sent before the last cut are from the old limit and don't cut it again.
+        self.last_decrease = self.start
+
+        self.increases = 0
+        self.decreases = 0
+        self.peak = self.min_limit
+        self.decisions = collections.deque(maxlen=MAX_DECISIONS)
+
+    def acquire(self):
+        """
+        Wait for a free slot. Returns the send time to hand back to release.
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+
+            self.in_flight += 1
+
+        return time.monotonic()
+
+    def release(self, sent_at, status):
+        """
+        sent_at : float
+            What acquire returned.
+        status : int or None
+            Status code of the response, None if there was none.
+        """
+        now = time.monotonic()
+        latency = now - sent_at
+
+        with self.condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+
+            if is_congested(status):
+                self.decrease(sent_at, now, f'status {status}' if status else 'no response')
+            else:
+                self.observe(latency)
+
+                if self.latency > self.min_latency * self.latency_tolerance + LATENCY_SLACK:
+                    self.decrease(sent_at, now, f'latency {self.latency * 1000:.0f}ms')
+                elif saturated:
+                    # Only grow while the limit is what holds us back, not when we can't produce requests fast enough.
+                    self.increase(now)
+
+            self.condition.notify_all()
+
+    def observe(self, latency):
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        self.latency = latency if self.latency is None else (
+            LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency)
+
+    def increase(self, now):
+        before = int(self.limit)
+        # One more slot per round of requests at the current limit.
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+        if int(self.limit) > before:
+            self.increases += 1
+            self.peak = max(self.peak, int(self.limit))
+            self.record(now, 'increase', before, 'healthy')
+
+    def decrease(self, sent_at, now, reason):
+        if sent_at < self.last_decrease:
+            return
+
+        before = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.last_decrease = now
+        # The latency baseline starts over at the new limit, otherwise one slow spell keeps cutting it.
+        self.latency = None
+
+        if int(self.limit) < before:
+            self.decreases += 1
+            self.record(now, 'decrease', before, reason)
+            logging.info(f'Concurrency cut from {before} to {int(self.limit)} on {reason}.')
+
+    def record(self, now, action, before, reason):
+        self.decisions.append({
+            'seconds': round(now - self.start, 3),
+            'action': action,
+            'from': before,
+            'to': int(self.limit),
+            'reason': reason,
+        })
+
+    def summary(self):
+        return {
+            'limit': int(self.limit),
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'peak': self.peak,
+            'increases': self.increases,
+            'decreases': self.decreases,
+            'min_latency_ms': round(self.min_latency * 1000, 1) if self.min_latency is not None else None,
+            'decisions': list(self.decisions),
+        }
+
+
+class OffsetTracker:
+    """
+    Batches in file order with the requests of each still in flight.
+
+        batch = tracker.start(requests=3)
+        ...every request finished: tracker.finish(batch)
+        tracker.end((rows, bytes))  # offsets just past every batch started so far
+        tracker.commit()            # offsets of the last batch that finished along with all before it
+    """
+    def __init__(self):
+        self.batches = collections.deque()
+        self.committed = None
+        self.lock = threading.Lock()
+
+    def start(self, requests):
+        batch = {'pending': requests, 'end': None}
+
+        with self.lock:
+            self.batches.append(batch)
+
+        return batch
+
+    def finish(self, batch):
+        with self.lock:
+            batch['pending'] -= 1
+
+    def end(self, offsets):
+        """
+        Set the offsets reached once the batches started since the last call are sent.
+        """
+        with self.lock:
+            if not self.batches or self.batches[-1]['end'] is not None:
+                # Nothing was sent for this stretch of the file, ie every row was a duplicate.
+                self.batches.append({'pending': 0, 'end': None})
+
+            for batch in reversed(self.batches):
+                if batch['end'] is not None:
+                    break
+                batch['end'] = offsets
+
+    def commit(self):
+        with self.lock:
+            while self.batches and not self.batches[0]['pending'] and self.batches[0]['end'] is not None:
+                self.committed = self.batches.popleft()['end']
+
+            return self.committed
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import math
+import os
+
+
+"""
+Drop rows whose key was already seen earlier in the file, ie one row per order when the destination only needs one
+per cust_id. Keys are kept as 16 byte digests in a set until DEDUP_EXACT_LIMIT, after that they move to a Bloom
+filter so memory stays bounded on any file size. A Bloom filter can report a key it never saw (at most
+DEDUP_ERROR_RATE of the time while under DEDUP_CAPACITY keys) so a small share of unique rows may be dropped once
+it is in use, it never lets a duplicate through.
+"""
+
+
+DEDUP_EXACT_LIMIT = int(os.getenv('AMPERITY_DEDUP_EXACT_LIMIT', 100000))
+DEDUP_CAPACITY = int(os.getenv('AMPERITY_DEDUP_CAPACITY', 10000000))
+DEDUP_ERROR_RATE = float(os.getenv('AMPERITY_DEDUP_ERROR_RATE', 0.001))
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, digest):
+        # Double hashing, the k bit positions are derived from two halves of one 16 byte digest.
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+
+        for i in range(self.hashes):
+            index = (h1 + i * h2) % self.size
+            yield index >> 3, 1 << (index & 7)
+
+    def __contains__(self, digest):
+        return all(self.bits[byte] & mask for byte, mask in self.positions(digest))
+
+    def add(self, digest):
+        """
+        Add a digest, returns True if it was (probably) already in the filter.
+        """
+        present = True
+
+        for byte, mask in self.positions(digest):
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+
+        if not present:
+            self.count += 1
+
+            if self.count == self.capacity:
+                logging.warning(f'Dedup filter is full at {self.capacity} keys, false positives will rise from here.')
+
+        return present
+
+
+class SeenKeys:
+    """
+    Exact set of digests up to exact_limit, then a Bloom filter.
+    """
+    def __init__(self, exact_limit=DEDUP_EXACT_LIMIT, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE):
+        self.exact_limit = exact_limit
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.exact = set()
+        self.bloom = None
+
+    def add(self, digest):
+        if self.bloom:
+            return self.bloom.add(digest)
+
+        if digest in self.exact:
+            return True
+
+        self.exact.add(digest)
+
+        if len(self.exact) > self.exact_limit:
+            logging.info(f'More than {self.exact_limit} keys, moving dedup to a Bloom filter.')
+            self.bloom = BloomFilter(max(self.capacity, len(self.exact)), self.error_rate)
+
+            for seen in self.exact:
+                self.bloom.add(seen)
+
+            self.exact = set()
+
+        return False
+
+
+class Deduplicator:
+    def __init__(self, keys, exact_limit=DEDUP_EXACT_LIMIT, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR_RATE):
+        """
+        keys : list
+            Fields that identify a row, ie ['cust_id']. A single field can be given as a string. Rows missing every
+            key field are always kept.
+        """
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.seen = SeenKeys(exact_limit, capacity, error_rate)
+        self.suppressed = 0
+
+    def digest(self, record):
+        values = [record.get(key) for key in self.keys]
+
+        if all(value is None for value in values):
+            return None
+
+        return hashlib.blake2b(json.dumps(values, default=str).encode('utf-8'), digest_size=16).digest()
+
+    def filter(self, data):
+        """
+        Return the rows of data whose key hasn't been seen before.
+        """
+        return self.filter_rows(data, 0)[0]
+
+    def filter_rows(self, data, start):
+        """
+        Same as filter, also returning the row number of each kept row when data starts at row start.
+        """
+        unique = []
+        rows = []
+
+        for row, record in enumerate(data, start):
+            digest = self.digest(record)
+
+            if digest is not None and self.seen.add(digest):
+                self.suppressed += 1
+            else:
+                unique.append(record)
+                rows.append(row)
+
+        return unique, rows
@@ -0,0 +1,158 @@
+import random
+import re
+import threading
+
+
+"""
+Bounded error accounting for a run. Against a failing destination every record can error, so instead of keeping
+every message errors are grouped by kind (exception type, 'HTTP' for a response) and status code with a count and a
+small reservoir sample of example messages per group. Memory stays the same however many errors occur.
+
+ErrorAggregator keeps the list API runners already use (self.errors.append(message)), append also takes an
+exception or a status code.
+"""
+
+
+MAX_GROUPS = 100
+EXAMPLES_PER_GROUP = 3
+MAX_MESSAGE_LENGTH = 500
+# Errors shown in a status update, Amperity only displays a handful.
+MAX_REPORTED = 10
+
+DIGITS = re.compile(r'\d+')
+
+
+def truncate(message, length=MAX_MESSAGE_LENGTH):
+    return message if len(message) <= length else f'{message[:length]}... ({len(message)} characters)'
+
+
+def status_of(error):
+    """
+    Status code of a requests or botocore exception, if it has one.
+    """
+    response = getattr(error, 'response', None)
+
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+    return getattr(response, 'status_code', None)
+
+
+class ErrorGroup:
+    def __init__(self, kind, status):
+        self.kind = kind
+        self.status = status
+        self.count = 0
+        self.examples = []
+
+    @property
+    def label(self):
+        return f'{self.kind} {self.status}' if self.status else self.kind
+
+    def add(self, message):
+        self.count += 1
+
+        # Reservoir sampling so examples are a uniform sample of every error in the group, not just the first ones.
+        if len(self.examples) < EXAMPLES_PER_GROUP:
+            self.examples.append(message)
+        else:
+            index = random.randrange(self.count)
+            if index < EXAMPLES_PER_GROUP:
+                self.examples[index] = message
+
+    def describe(self):
+        return self.examples[0] if self.count == 1 else f'{self.count}x {self.label}: {self.examples[0]}'
+
+
+class ErrorAggregator:
+    def __init__(self):
+        self.groups = {}
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Aggregators are sent back from worker processes, see lambdas.parallel.
+        return {'groups': self.groups, 'total': self.total}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return iter(self.report(len(self.groups)))
+
+    def append(self, error, status=None, kind=None):
+        """
+        error : str or Exception
+            The message, or an exception whose type becomes the kind and message its str.
+        status : int, optional
+            HTTP status code, taken from the exception's response when not given.
+        kind : str, optional
+            Overrides the kind, defaults to the exception type, 'HTTP' with a status or 'Error'.
+        """
+        if isinstance(error, Exception):
+            status = status or status_of(error)
+            kind = kind or type(error).__name__
+
+        message = truncate(str(error))
+        kind = kind or ('HTTP' if status else 'Error')
+        # Free text messages are grouped by their start with numbers masked, ie one group for every
+        # "Couldn't send message to <phone number>".
+        signature = DIGITS.sub('#', message[:80]) if kind == 'Error' else None
+
+        self.add(kind, status, signature, message)
+
+    def group(self, kind, status, signature):
+        key = (kind, status, signature)
+
+        if key not in self.groups and len(self.groups) >= MAX_GROUPS:
+            key = ('Other', None, None)
+
+        if key not in self.groups:
+            self.groups[key] = ErrorGroup(*key[:2])
+
+        return self.groups[key]
+
+    def add(self, kind, status, signature, message):
+        with self.lock:
+            self.group(kind, status, signature).add(message)
+            self.total += 1
+
+    def extend(self, errors, prefix=''):
+        """
+        Add a list of messages or merge another aggregator, ie the errors of a sink (with its name as prefix) or of a
+        worker process.
+        """
+        if not isinstance(errors, ErrorAggregator):
+            for error in errors:
+                self.append(f'{prefix}{error}')
+            return
+
+        with self.lock:
+            for (kind, status, signature), other in errors.groups.items():
+                group = self.group(kind, status, f'{prefix}{signature or ""}' if prefix else signature)
+
+                for example in other.examples:
+                    group.add(f'{prefix}{example}')
+
+                group.count += other.count - len(other.examples)
+                self.total += other.count
+
+    def report(self, limit=MAX_REPORTED):
+        """
+        One line per group, largest first, for the status update.
+        """
+        groups = sorted(self.groups.values(), key=lambda group: group.count, reverse=True)
+
+        return [group.describe() for group in groups[:limit]]
+
+    def summary(self):
+        return {
+            'total': self.total,
+            'groups': [
+                {'kind': group.kind, 'status': group.status, 'count': group.count, 'examples': group.examples}
+                for group in sorted(self.groups.values(), key=lambda group: group.count, reverse=True)
+            ],
+        }
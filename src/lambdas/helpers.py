@@ -1,11 +1,20 @@
 import functools
 import json
 import logging
+import os
 
 from datetime import datetime
 from time import sleep
 
 
+# Set AMPERITY_ASYNC_INVOKE=true to answer API Gateway right away and process the file in a second invocation.
+ASYNC_INVOKE = os.getenv('AMPERITY_ASYNC_INVOKE', 'false').lower() == 'true'
+# Lambda API endpoint for the self invocation, ie http://localhost:5555 for the local lambda gateway.
+LAMBDA_ENDPOINT = os.getenv('AMPERITY_LAMBDA_ENDPOINT')
+ASYNC_EVENT_KEY = 'amperity_async_event'
+REQUIRED_KEYS = ('data_url', 'callback_url', 'webhook_id')
+
+
 def http_response(status_code, status, message):
     body = {
         "status": status,
@@ -24,29 +33,85 @@ def rate_limit(f):
 
     In the destination request we keep track of requests per minute. If we exceed
         the requests allowed per minute we pause the remaining time in the minute.
+    Wrap the method that makes a single request, one call is counted as one request.
+
+    Requests sent from several threads (max_concurrency, lanes) share the count under self.rate_limit_lock. The lock
+    is held while sleeping so every thread waits for the new minute instead of each sleeping and resetting it.
     """
     @functools.wraps(f)
     def rate_limit_wrapper(self, *args, **kwargs):
         if not self.req_per_min:
             return f(self, *args, **kwargs)
 
-        if not self.rate_limit_time_start:
-            self.rate_limit_time_start = datetime.now()
+        with self.rate_limit_lock:
+            if not self.rate_limit_time_start:
+                self.rate_limit_time_start = datetime.now()
 
-        seconds_remaining = (datetime.now() - self.rate_limit_time_start).seconds
+            seconds_remaining = (datetime.now() - self.rate_limit_time_start).seconds
 
-        if seconds_remaining <= 60 and self.num_requests > self.req_per_min:
-            timeout = 60 - seconds_remaining
+            if seconds_remaining <= 60 and self.num_requests >= self.req_per_min:
+                timeout = 60 - seconds_remaining
 
-            logging.info(f'Exceeded requests per minute. Sleeping: {timeout}')
-            sleep(timeout)
+                logging.info(f'Exceeded requests per minute. Sleeping: {timeout}')
+                sleep(timeout)
 
-        elif seconds_remaining > 60:
-            self.rate_limit_time_start = datetime.now()
-            self.num_requests = 0
+                self.rate_limit_time_start = datetime.now()
+                self.num_requests = 0
 
-        self.num_requests += 1
+            elif seconds_remaining > 60:
+                self.rate_limit_time_start = datetime.now()
+                self.num_requests = 0
+
+            self.num_requests += 1
 
         return f(self, *args, **kwargs)
 
     return rate_limit_wrapper
+
+
+def accept_async(handler):
+    """
+    Decorator for a lambda_handler that lets it answer API Gateway before its 29 second timeout.
+
+    With ASYNC_INVOKE on the payload is validated, the function invokes itself asynchronously (InvocationType
+    'Event') with the same event and returns a 202. The second invocation runs the handler as usual and reports its
+    progress and result to the callback_url which Amperity is already waiting on. With it off the handler runs as is.
+    """
+    @functools.wraps(handler)
+    def accept_async_wrapper(event, context):
+        if ASYNC_EVENT_KEY in event:
+            return handler(event[ASYNC_EVENT_KEY], context)
+
+        if not ASYNC_INVOKE:
+            return handler(event, context)
+
+        try:
+            payload = json.loads(event['body']) if isinstance(event['body'], str) else event['body']
+        except (KeyError, TypeError, ValueError):
+            return http_response(400, 'failed', 'Request body must be a json object.')
+
+        missing = [key for key in REQUIRED_KEYS if not (payload or {}).get(key)]
+
+        if missing:
+            return http_response(400, 'failed', f'Missing required keys: {", ".join(missing)}.')
+
+        # boto3 is always available in the lambda runtime but is not a dependency of the runner itself.
+        import boto3
+
+        function_name = getattr(context, 'invoked_function_arn', None) or context.function_name
+
+        try:
+            boto3.client('lambda', endpoint_url=LAMBDA_ENDPOINT).invoke(
+                FunctionName=function_name,
+                InvocationType='Event',
+                Payload=json.dumps({ASYNC_EVENT_KEY: event}),
+            )
+        except Exception as e:
+            logging.error(f'Failed to invoke {function_name} asynchronously. {e}')
+            return http_response(500, 'failed', 'Failed to start processing.')
+
+        logging.info(f'Accepted webhook {payload["webhook_id"]}, processing asynchronously.')
+
+        return http_response(202, 'accepted', f'Processing {payload["webhook_id"]}, status updates go to the callback_url.')
+
+    return accept_async_wrapper
@@ -4,6 +4,7 @@ import os
 from datetime import datetime
 
 from lambdas.amperity_runner import AmperityBotoRunner
+from lambdas.helpers import accept_async
 
 PINPOINT_REGION = os.getenv("PINPOINT_REGION")
 PINPOINT_APP_ID = os.getenv("PINPOINT_APP_ID")  # Also known as Project ID
@@ -12,6 +13,8 @@ PINPOINT_CLIENT = boto3.client("pinpoint", region_name=PINPOINT_REGION)
 
 
 class AmperityPinpointRunner(AmperityBotoRunner):
+    # Only these two fields are read, everything else in the export is dropped while decoding.
+    record_schema = {"phone_number": "str", "message": "str"}
 
     def validate_phone_number(self, phone_number):
         """
@@ -57,11 +60,12 @@ class AmperityPinpointRunner(AmperityBotoRunner):
                 if message_id:
                     print(f"Message '{message}' sent to {phone_number}! Message ID: {message_id}. {str(datetime.now())}")
                 else:
-                    self.errors.append(item)
+                    self.errors.append(f"Couldn't send message to {phone_number}")
             else:
                 self.errors.append(f"Couldn't validate phone number {phone_number}")
 
 
+@accept_async
 def lambda_handler(event, context):
     payload = json.loads(event['body'])
     amperity_tenant_id = payload.get("tenant_id")
@@ -5,8 +5,10 @@ from enum import Enum
 import json
 import logging
 import os
+import re
 
 from lambdas.amperity_runner import AmperityBotoRunner
+from lambdas.helpers import accept_async, http_response
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +19,16 @@ REDSHIFT_DB_NAME = os.getenv("REDSHIFT_DB_NAME")
 REDSHIFT_DB_USER = os.getenv("REDSHIFT_DB_USER")
 REDSHIFT_IAM_ROLE = os.getenv("REDSHIFT_IAM_ROLE")
 REDSHIFT_TABLE_NAME = os.getenv("REDSHIFT_TABLE_NAME")
+# 'append' COPYs straight into the table, 'upsert' stages the batch and replaces rows matching REDSHIFT_UPSERT_KEYS
+REDSHIFT_WRITE_MODE = os.getenv("REDSHIFT_WRITE_MODE", "append")
+REDSHIFT_UPSERT_KEYS = os.getenv("REDSHIFT_UPSERT_KEYS", "")
+# 'merge' uses Redshift's MERGE ... REMOVE DUPLICATES, 'delete_insert' is for clusters without MERGE support
+REDSHIFT_UPSERT_STRATEGY = os.getenv("REDSHIFT_UPSERT_STRATEGY", "merge")
 S3_BUCKET = os.getenv("S3_BUCKET")
 
+# Upsert keys are written into the MERGE/DELETE statements so they must be plain column names.
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
 
 class WaitState(Enum):
     SUCCESS = 'success'
@@ -191,7 +201,54 @@ class S3_Uploader:
             return False
 
 
+def parse_upsert_keys(keys):
+    """
+    Upsert keys as a list of column names from a list or a comma separated string. Raises ValueError for anything
+    that isn't a plain identifier.
+    """
+    if isinstance(keys, str):
+        keys = [key.strip() for key in keys.split(",") if key.strip()]
+
+    if not isinstance(keys, list) or not keys:
+        raise ValueError("Upsert mode requires at least one key column. Set REDSHIFT_UPSERT_KEYS.")
+
+    invalid = [key for key in keys if not isinstance(key, str) or not IDENTIFIER.match(key)]
+
+    if invalid:
+        raise ValueError(f"Invalid upsert key column(s) {invalid}. Keys must be plain column names.")
+
+    return keys
+
+
 class AmperityRedshiftRunner(AmperityBotoRunner):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        settings = self.settings or {}
+        self.write_mode = settings.get("write_mode", REDSHIFT_WRITE_MODE)
+        self.upsert_keys = None
+        self.upsert_strategy = settings.get("upsert_strategy", REDSHIFT_UPSERT_STRATEGY)
+        # Checked once up front so a misconfigured run fails before any batch is uploaded to S3.
+        self.config_error = None
+
+        if self.write_mode == "upsert":
+            try:
+                self.upsert_keys = parse_upsert_keys(settings.get("upsert_keys") or REDSHIFT_UPSERT_KEYS)
+            except ValueError as e:
+                self.config_error = str(e)
+
+            if self.upsert_strategy not in ("merge", "delete_insert"):
+                self.config_error = f"Unknown upsert strategy '{self.upsert_strategy}'. Use 'merge' or 'delete_insert'."
+
+    def run(self):
+        if self.config_error:
+            logger.error(self.config_error)
+            self.report_status("failed", 0, reason=self.config_error)
+
+            return http_response(400, "failed", self.config_error)
+
+        return super().run()
+
     def table_exists(self, table_name):
         result = self.boto_client.list_tables(
             ClusterIdentifier=REDSHIFT_CLUSTER_ID,
@@ -271,17 +328,78 @@ class AmperityRedshiftRunner(AmperityBotoRunner):
             success_message = f"INSERTED {additional_rows} ROWS"
             print(success_message)
 
-    def runner_logic(self, data):
+    def upsert_statements(self, table_name, staging_table, s3_url, iam_role, keys, strategy):
+        """
+        Build the statements for a staged upsert. They are executed through batch_execute_statement which runs
+        them in a single transaction, so readers never see the table with rows deleted but not yet re-inserted.
+        """
+        join_condition = " and ".join(f"{table_name}.{key} = {staging_table}.{key}" for key in keys)
+
+        statements = [
+            f"create temp table {staging_table} (like {table_name});",
+            f"""copy {staging_table}
+                from '{s3_url}'
+                iam_role '{iam_role}'
+                json 'auto';""",
+        ]
+
+        if strategy == "merge":
+            statements.append(f"merge into {table_name} using {staging_table} on {join_condition} remove duplicates;")
+        else:
+            statements.append(f"delete from {table_name} using {staging_table} where {join_condition};")
+            statements.append(f"insert into {table_name} select * from {staging_table};")
 
+        statements.append(f"drop table {staging_table};")
+
+        return statements
+
+    def upsert_to_table(self, table_name, s3_url, iam_role, keys, strategy):
+        if not self.table_exists(table_name):
+            self.errors.append("Table does not exist. Please create table in Redshift.")
+            return
+
+        # Temp tables live in the session of the batch statement so the name can't collide with other runs.
+        staging_table = "amperity_upsert_staging"
+        statements = self.upsert_statements(table_name, staging_table, s3_url, iam_role, keys, strategy)
+
+        custom_waiter = ExecuteStatementWaiter(self.boto_client)
+        response = self.boto_client.batch_execute_statement(
+            ClusterIdentifier=REDSHIFT_CLUSTER_ID,
+            Database=REDSHIFT_DB_NAME,
+            DbUser=REDSHIFT_DB_USER,
+            Sqls=statements
+            )
+        id = response["Id"]
+
+        try:
+            print("Waiting for upsert transaction...", statements)
+            custom_waiter.wait(query_id=id)
+
+        except Exception as e:
+            message = "Error waiting for upsert transaction." + str(e)
+            self.errors.append(message)
+
+        else:
+            # The COPY is the second sub statement, its ResultRows is the number of rows staged for the upsert.
+            result = self.boto_client.describe_statement(Id=id)
+            staged_rows = result["SubStatements"][1].get("ResultRows", 0)
+
+            print(f"UPSERTED {staged_rows} ROWS ON {', '.join(keys)}")
+
+    def runner_logic(self, data):
         s3_upload = S3_Uploader(bucket=S3_BUCKET)
         s3_url = s3_upload.upload_data(data)
 
         if not s3_url:
             return
 
-        self.copy_to_table(REDSHIFT_TABLE_NAME, s3_url, REDSHIFT_IAM_ROLE)
+        if self.write_mode == "upsert":
+            self.upsert_to_table(REDSHIFT_TABLE_NAME, s3_url, REDSHIFT_IAM_ROLE, self.upsert_keys, self.upsert_strategy)
+        else:
+            self.copy_to_table(REDSHIFT_TABLE_NAME, s3_url, REDSHIFT_IAM_ROLE)
 
 
+@accept_async
 def lambda_handler(event, context):
     payload = json.loads(event['body'])
     amperity_tenant_id = payload.get("tenant_id")
@@ -1,8 +1,19 @@
+import hashlib
 import json
+import logging
+import os
+import threading
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
 
 import boto3
 
+from botocore.exceptions import ClientError
+
 from lambdas.amperity_runner import AmperityBotoRunner
+from lambdas.helpers import accept_async
 
 """
 Notes on AWS Connect workflow/behavior
@@ -13,8 +24,9 @@ the customer/profile data. For that you need the 'CustomerProfiles' set of docum
 The code below uses the API methods in CustomerProfiles to demonstrate how to upload exported data from Amperity
 to a Connect instance. Most of the field naming was done in the SQL query that is run in the orchestration job
 but address data needs to be reshaped into a dict. Otherwise the workflow is straightforward and requires little
-work. Throughout the code I left comments for improvements/next steps but generally the only other work that might
-need to happen is implementing a truncate and load functionality.
+work. Throughout the code I left comments for improvements/next steps. Re-sending an audience creates duplicate
+profiles unless the runner is in 'upsert' mode (CONNECT_WRITE_MODE or the 'write_mode' setting) which matches records
+to existing profiles by key and only updates the ones that changed.
 
 How to add permissions to the lambda in AWS:
 In AWS lambda go to 'Configuration -> Permissions' and click on the role associated with the lambda. Click the
@@ -37,6 +49,80 @@ CONNECT_CLIENT = boto3.client(
     'customer-profiles',
     region_name='us-east-1',
 )
+# Upper bound on concurrent Customer Profiles calls. Concurrency starts here and is halved whenever we get throttled.
+CONNECT_MAX_WORKERS = int(os.getenv('CONNECT_MAX_WORKERS', '8'))
+# How many times a single record is retried after a ThrottlingException before it is counted as an error.
+CONNECT_MAX_THROTTLE_RETRIES = int(os.getenv('CONNECT_MAX_THROTTLE_RETRIES', '5'))
+# Log every Nth record at debug level instead of printing all of them.
+CONNECT_LOG_SAMPLE_RATE = int(os.getenv('CONNECT_LOG_SAMPLE_RATE', '1000'))
+# 'create' always creates a new profile, 'upsert' updates the profile matching CONNECT_PROFILE_KEY_FIELD if one exists.
+CONNECT_WRITE_MODE = os.getenv('CONNECT_WRITE_MODE', 'create')
+# The search key (see SearchProfiles KeyName) and the record field holding its value, ie '_account' & 'AccountNumber'.
+CONNECT_PROFILE_KEY_NAME = os.getenv('CONNECT_PROFILE_KEY_NAME', '_account')
+CONNECT_PROFILE_KEY_FIELD = os.getenv('CONNECT_PROFILE_KEY_FIELD', 'AccountNumber')
+CONNECT_PROFILE_INDEX_SIZE = int(os.getenv('CONNECT_PROFILE_INDEX_SIZE', '1000000'))
+# Profile attribute used to store the hash of what we last wrote so unchanged records can be skipped.
+CONTENT_HASH_ATTRIBUTE = 'amperity_content_hash'
+
+ADDRESS_FIELDS = {
+    'address': 'Address1',
+    'city': 'City',
+    'state': 'State',
+    'postal': 'PostalCode',
+    'country': 'Country'
+}
+
+logger = logging.getLogger(__name__)
+
+# Maps the profile key to (ProfileId, content hash). Lives at module level so it survives across batches and warm
+# invocations of the same Lambda container. Bounded as an LRU by CONNECT_PROFILE_INDEX_SIZE.
+PROFILE_INDEX = OrderedDict()
+PROFILE_INDEX_LOCK = threading.Lock()
+
+
+def content_hash(profile):
+    return hashlib.sha256(json.dumps(profile, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def index_get(key):
+    with PROFILE_INDEX_LOCK:
+        if key not in PROFILE_INDEX:
+            return None
+
+        PROFILE_INDEX.move_to_end(key)
+
+        return PROFILE_INDEX[key]
+
+
+def index_put(key, profile_id, profile_hash):
+    with PROFILE_INDEX_LOCK:
+        PROFILE_INDEX[key] = (profile_id, profile_hash)
+        PROFILE_INDEX.move_to_end(key)
+
+        while len(PROFILE_INDEX) > CONNECT_PROFILE_INDEX_SIZE:
+            PROFILE_INDEX.popitem(last=False)
+
+
+def format_profile(record):
+    """
+    Reshape a flat Amperity record into CreateProfile kwargs. Address fields are nested under 'Address'.
+    """
+    address_val = {}
+    row_val = {}
+
+    for key, val in record.items():
+        # Connect doesn't support NoneTypes skip any missing values
+        if not val:
+            continue
+
+        if key in ADDRESS_FIELDS:
+            address_val[ADDRESS_FIELDS[key]] = val
+        else:
+            row_val[key] = val
+
+    row_val['Address'] = address_val
+
+    return row_val
 
 
 class AmperityConnectRunner(AmperityBotoRunner):
@@ -46,43 +132,163 @@ class AmperityConnectRunner(AmperityBotoRunner):
     (ie connect_runner.runner_logic = callback)
     Currently not super opinionated on which approach you take.
 
-    This implementation is inefficient b/c runner_logic is invoked with a list of records. Then we parse each record
-    individually again. Not a huge deal for a demo but if this ever needs to go to prod we should rewrite.
+    Customer Profiles has no batch write API so each record is its own call. We fan those calls out over a bounded
+    thread pool and adapt how many are in flight: every window that gets throttled halves the concurrency and
+    re-queues the throttled records, every clean window adds one back up to max_workers.
 
+    In 'upsert' mode records are matched to existing profiles on CONNECT_PROFILE_KEY_FIELD. Matches are found with
+    search_profiles once and then kept in PROFILE_INDEX, records whose content hash hasn't changed since we last
+    wrote them are skipped, and everything else is updated in place instead of creating a duplicate profile.
     """
-    def runner_logic(self, data):
-        address_dict = {
-            'address': 'Address1',
-            'city': 'City',
-            'state': 'State',
-            'postal': 'PostalCode',
-            'country': 'Country'
-        }
-
-        for record in data:
-            print(record)
-            address_val = {}
-            row_val = {}
-
-            for key, val in record.items():
-                # Connect doesn't support NoneTypes skip any missing values
-                if not val:
-                    continue
-
-                if key in address_dict:
-                    address_val[address_dict[key]] = val
-                else:
-                    row_val[key] = val
-
-            row_val['Address'] = address_val
-
-            CONNECT_CLIENT.create_profile(
+    def __init__(self, *args, max_workers=CONNECT_MAX_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        settings = self.settings or {}
+
+        self.max_workers = max_workers
+        self.concurrency = max_workers
+        self.write_mode = settings.get('write_mode', CONNECT_WRITE_MODE)
+        self.records_seen = 0
+        self.records_skipped = 0
+
+    def write_profile(self, profile):
+        if self.write_mode == 'upsert':
+            return self.upsert_profile(profile)
+
+        return self.boto_client.create_profile(
+            DomainName=CONNECT_DOMAIN,
+            PartyType='INDIVIDUAL',
+            **profile
+        )
+
+    def find_profile(self, key):
+        """
+        Look up an existing profile by key. Returns (ProfileId, stored content hash) or (None, None).
+        """
+        res = self.boto_client.search_profiles(
+            DomainName=CONNECT_DOMAIN,
+            KeyName=CONNECT_PROFILE_KEY_NAME,
+            Values=[key],
+            MaxResults=1
+        )
+
+        if not res.get('Items'):
+            return None, None
+
+        item = res['Items'][0]
+
+        return item['ProfileId'], item.get('Attributes', {}).get(CONTENT_HASH_ATTRIBUTE)
+
+    def upsert_profile(self, profile):
+        key = profile.get(CONNECT_PROFILE_KEY_FIELD)
+
+        if not key:
+            raise ValueError(f'Record is missing the profile key {CONNECT_PROFILE_KEY_FIELD}.')
+
+        profile_hash = content_hash(profile)
+        cached = index_get(key)
+        profile_id, stored_hash = cached if cached else self.find_profile(key)
+
+        if profile_id and stored_hash == profile_hash:
+            # Counted from worker threads, += on an int attribute isn't atomic.
+            with PROFILE_INDEX_LOCK:
+                self.records_skipped += 1
+
+            if not cached:
+                index_put(key, profile_id, profile_hash)
+
+            return None
+
+        attributes = dict(profile.get('Attributes', {}), **{CONTENT_HASH_ATTRIBUTE: profile_hash})
+
+        if profile_id:
+            self.boto_client.update_profile(
+                DomainName=CONNECT_DOMAIN,
+                ProfileId=profile_id,
+                PartyType='INDIVIDUAL',
+                **dict(profile, Attributes=attributes)
+            )
+        else:
+            res = self.boto_client.create_profile(
                 DomainName=CONNECT_DOMAIN,
                 PartyType='INDIVIDUAL',
-                **row_val
+                **dict(profile, Attributes=attributes)
             )
+            profile_id = res['ProfileId']
+
+        index_put(key, profile_id, profile_hash)
+
+        return profile_id
+
+    def collapse_by_key(self, profiles):
+        """
+        Keep the last profile of each key in a batch. Profiles of a window are written at once so two with the same
+        key would both miss the index and search and each create a profile. Profiles without a key are kept so
+        upsert_profile reports them.
+        """
+        latest = {}
+
+        for i, profile in enumerate(profiles):
+            key = profile.get(CONNECT_PROFILE_KEY_FIELD)
+            slot = ('key', key) if key else ('row', i)
+            # dicts keep insertion order, pop first so a later duplicate takes the position of its last occurrence.
+            latest.pop(slot, None)
+            latest[slot] = profile
+
+        if len(latest) < len(profiles):
+            logger.info(f'Collapsed {len(profiles) - len(latest)} profiles with a repeated {CONNECT_PROFILE_KEY_FIELD}.')
+
+        return list(latest.values())
+
+    def runner_logic(self, data):
+        profiles = [format_profile(record) for record in data]
+
+        if self.write_mode == 'upsert':
+            profiles = self.collapse_by_key(profiles)
+
+        pending = deque((0, profile) for profile in profiles)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending:
+                window = [pending.popleft() for _ in range(min(self.concurrency, len(pending)))]
+                futures = [(attempt, profile, pool.submit(self.write_profile, profile)) for attempt, profile in window]
+                throttled = []
+
+                for attempt, profile, future in futures:
+                    # Retries of a throttled profile aren't new records.
+                    if not attempt:
+                        self.records_seen += 1
+
+                        if CONNECT_LOG_SAMPLE_RATE and self.records_seen % CONNECT_LOG_SAMPLE_RATE == 0:
+                            logger.debug(f'Writing profile {self.records_seen}: {profile}')
+
+                    try:
+                        future.result()
+                    except ClientError as e:
+                        if e.response['Error']['Code'] != 'ThrottlingException':
+                            self.errors.append(e, kind=e.response['Error']['Code'])
+                        elif attempt >= CONNECT_MAX_THROTTLE_RETRIES:
+                            self.errors.append(f'Exceeded throttling retries for profile. {e}', kind='ThrottlingException')
+                        else:
+                            throttled.append((attempt + 1, profile))
+                    except Exception as e:
+                        self.errors.append(e)
+
+                if throttled:
+                    self.concurrency = max(1, self.concurrency // 2)
+                    logger.info(f'Throttled by Customer Profiles. Reducing concurrency to {self.concurrency}')
+
+                    # Retry before the rest of the batch and back off longer the more often a record was throttled.
+                    pending.extendleft(reversed(throttled))
+                    sleep(0.1 * 2 ** max(attempt for attempt, _ in throttled))
+                elif self.concurrency < self.max_workers:
+                    self.concurrency += 1
+
+        if self.write_mode == 'upsert':
+            logger.info(f'Skipped {self.records_skipped} unchanged profiles so far.')
 
 
+@accept_async
 def lambda_handler(event, context):
     payload = json.loads(event['body'])
 
@@ -0,0 +1,37 @@
+import json
+import logging
+import os
+
+import boto3
+
+from lambdas.aws_streams import AmperityFirehoseRunner, AmperityKinesisRunner, AmperitySQSRunner
+from lambdas.helpers import accept_async
+
+
+STREAM_SERVICE = os.getenv('AWS_STREAM_SERVICE', 'sqs')  # sqs, kinesis or firehose
+STREAM_TARGET = os.getenv('AWS_STREAM_TARGET')  # Queue url, stream name or delivery stream name
+STREAM_PARTITION_KEY = os.getenv('AWS_STREAM_PARTITION_KEY')  # Kinesis partition key or SQS FIFO message group field
+
+
+@accept_async
+def lambda_handler(event, context):
+    """
+    Send every record of the audience as one message to an SQS queue, Kinesis stream or Firehose delivery stream.
+    """
+    logging.info(event)
+    payload = json.loads(event['body']) if isinstance(event['body'], str) else event['body']
+    amperity_tenant_id = payload.get('tenant_id')
+
+    if STREAM_SERVICE == 'sqs':
+        amperity_runner = AmperitySQSRunner(payload, context, amperity_tenant_id, boto_client=boto3.client('sqs'),
+                                            queue_url=STREAM_TARGET, message_group_key=STREAM_PARTITION_KEY)
+    elif STREAM_SERVICE == 'kinesis':
+        amperity_runner = AmperityKinesisRunner(payload, context, amperity_tenant_id, boto_client=boto3.client('kinesis'),
+                                                stream_name=STREAM_TARGET, partition_key=STREAM_PARTITION_KEY)
+    elif STREAM_SERVICE == 'firehose':
+        amperity_runner = AmperityFirehoseRunner(payload, context, amperity_tenant_id, boto_client=boto3.client('firehose'),
+                                                 delivery_stream_name=STREAM_TARGET)
+    else:
+        raise ValueError(f'Unknown AWS_STREAM_SERVICE {STREAM_SERVICE}. Use sqs, kinesis or firehose.')
+
+    return amperity_runner.run()
@@ -1,77 +1,428 @@
+import io
 import json
 import logging
 import msal
 import os
+import re
 import requests
+import threading
+import time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import RetryError, Timeout
+
 from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.helpers import accept_async, http_response, rate_limit
+from lambdas.timeouts import CONNECT_TIMEOUT, READ_TIMEOUT
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    dumps = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
 
 PA_ENV_NAME = os.getenv("PA_ENV_NAME")
 PA_ENV_REGION = os.getenv("PA_ENV_REGION")
-AZ_TENANT_ID = os.getenv("AZ_TENANT_ID")
-AZ_CLIENT_ID = os.getenv("AZ_CLIENT_ID")
-AZ_CLIENT_SECRET = os.getenv("AZ_CLIENT_SECRET")
 
 SINGULAR_TABLE_NAME = os.getenv("SINGULAR_TABLE_NAME")
 PLURAL_TABLE_NAME = os.getenv("PLURAL_TABLE_NAME")
 
-AUTHORITY = "https://login.microsoftonline.com/" + AZ_TENANT_ID
-SCOPE = [f"https://{PA_ENV_NAME}.api.{PA_ENV_REGION}.dynamics.com/.default"]
+# Dataverse rejects $batch requests with more than 1000 operations.
+# https://learn.microsoft.com/en-us/power-apps/developer/data-platform/webapi/execute-batch-operations-using-web-api
+MAX_BATCH_OPERATIONS = 1000
 
+# 'batch' sends $batch changesets, 'create_multiple'/'upsert_multiple' call the bulk actions on PLURAL_TABLE_NAME.
+# https://learn.microsoft.com/en-us/power-apps/developer/data-platform/bulk-operations
+DATAVERSE_WRITE_MODE = os.getenv("DATAVERSE_WRITE_MODE", "batch")
+DATAVERSE_BULK_CHUNK_SIZE = int(os.getenv("DATAVERSE_BULK_CHUNK_SIZE", "100"))
+# Service protection allows 52 concurrent requests per user, we stay well below that by default.
+# https://learn.microsoft.com/en-us/power-apps/developer/data-platform/api-limits
+DATAVERSE_MAX_PARALLEL_REQUESTS = int(os.getenv("DATAVERSE_MAX_PARALLEL_REQUESTS", "4"))
+DATAVERSE_MAX_RETRIES = int(os.getenv("DATAVERSE_MAX_RETRIES", "5"))
 
-def authorize_msal():
+BULK_ACTIONS = {
+    "create_multiple": "CreateMultiple",
+    "upsert_multiple": "UpsertMultiple",
+}
+
+
+# Cached tokens with less than this many seconds left are refreshed before the run starts. Defaults to the max
+# Lambda runtime so a token handed to a run never expires before the run does.
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "900"))
+COLUMN_CACHE_TTL = int(os.getenv("COLUMN_CACHE_TTL", "3600"))
+
+# Module level state is kept between warm invocations of the same Lambda container.
+MSAL_APP = None
+TOKEN = {"access_token": None, "expires_at": 0}
+TOKEN_LOCK = threading.Lock()
+COLUMN_CACHE = {}
+
+
+def get_msal_app():
     # https://github.com/AzureAD/microsoft-authentication-library-for-python/blob/dev/sample/confidential_client_secret_sample.py
-    app = msal.ConfidentialClientApplication(AZ_CLIENT_ID, authority=AUTHORITY, client_credential=AZ_CLIENT_SECRET)
-    result = None
+    global MSAL_APP
+
+    # The Azure credentials are read here rather than at import so the module loads without them, ie in tests.
+    if MSAL_APP is None:
+        MSAL_APP = msal.ConfidentialClientApplication(
+            os.environ["AZ_CLIENT_ID"],
+            authority="https://login.microsoftonline.com/" + os.environ["AZ_TENANT_ID"],
+            client_credential=os.environ["AZ_CLIENT_SECRET"],
+        )
+
+    return MSAL_APP
+
+
+def get_scope():
+    return [f"https://{PA_ENV_NAME}.api.{PA_ENV_REGION}.dynamics.com/.default"]
 
-    result = app.acquire_token_silent(SCOPE, account=None)
+
+def refresh_token(force=False):
+    app = get_msal_app()
+
+    # MSAL keeps serving a cached token until 5 minutes before it expires, drop it to get a fresh one early.
+    if force:
+        app.remove_tokens_for_client()
+
+    result = app.acquire_token_silent(get_scope(), account=None)
 
     if not result:
         logging.info("No suitable token exists in cache. Let's get a new one from AAD.")
-        result = app.acquire_token_for_client(scopes=SCOPE)
+        result = app.acquire_token_for_client(scopes=get_scope())
 
     access_token = result.get("access_token")
 
+    if access_token:
+        with TOKEN_LOCK:
+            TOKEN["access_token"] = access_token
+            TOKEN["expires_at"] = time.time() + int(result.get("expires_in", 0))
+
+    return access_token
+
+
+def authorize_msal():
+    """
+    Return an access token, reusing the one cached by a previous warm invocation when it outlives the run. The
+    session headers are set once per run so a token close to expiring is refreshed now, a refresh in the background
+    could still be running (or frozen with the container) when the old token expires.
+    """
+    with TOKEN_LOCK:
+        access_token = TOKEN["access_token"]
+        expires_in = TOKEN["expires_at"] - time.time()
+
+    if not access_token or expires_in <= 0:
+        return refresh_token()
+
+    if expires_in < TOKEN_REFRESH_MARGIN:
+        return refresh_token(force=True)
+
     return access_token
 
 
 def fetch_columns(single_table_name, session):
+    cached = COLUMN_CACHE.get(single_table_name)
+
+    if cached and time.monotonic() - cached[0] < COLUMN_CACHE_TTL:
+        return cached[1]
 
     url = f"https://{PA_ENV_NAME}.api.{PA_ENV_REGION}.dynamics.com/api/data/v9.2/EntityDefinitions(LogicalName='{single_table_name}')/Attributes"
 
-    res = session.get(url)
+    res = session.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
 
     if res.status_code == 200:
         items = res.json()
         values = items["value"]
         columns = set(map(lambda i: i["LogicalName"], values))
+        COLUMN_CACHE[single_table_name] = (time.monotonic(), columns)
 
         return columns
 
 
 def format_bulk_creation(batch_id, changeset_id, destination_url, data, cols):
-    output = f"--batch_{batch_id}\n"
-    output += f"Content-Type: multipart/mixed;boundary=changeset_{changeset_id}\n\n"
+    """
+    Build the multipart body of a $batch request with every record as a POST in a single changeset. Written into a
+    buffer in one pass, the caller is responsible for keeping data under MAX_BATCH_OPERATIONS.
+    """
+    output = io.StringIO()
+    output.write(f"--batch_{batch_id}\r\n")
+    output.write(f"Content-Type: multipart/mixed;boundary=changeset_{changeset_id}\r\n\r\n")
 
     for i, item in enumerate(data):
         formatted_item = {k: item[k] for k in cols if k in item}
         if not formatted_item:
             continue
-        output += f"--changeset_{changeset_id}\n"
-        output += "Content-Type: application/http\n"
-        output += "Content-Transfer-Encoding: binary\n"
-        output += "Content-ID: " + str(i) + "\n\n"
-        output += f"POST {destination_url} HTTP/1.1\n"
-        output += "Content-Type: application/json\n\n"
-        output += str(formatted_item) + "\n\n"
+        output.write(f"--changeset_{changeset_id}\r\n")
+        output.write("Content-Type: application/http\r\n")
+        output.write("Content-Transfer-Encoding: binary\r\n")
+        output.write(f"Content-ID: {i}\r\n\r\n")
+        output.write(f"POST {destination_url} HTTP/1.1\r\n")
+        output.write("Content-Type: application/json\r\n\r\n")
+        output.write(dumps(formatted_item))
+        output.write("\r\n")
+
+    output.write(f"--changeset_{changeset_id}--\r\n")
+    output.write(f"--batch_{batch_id}--\r\n")
+
+    return output.getvalue()
+
+
+def split_headers(text):
+    """
+    Split a MIME part or HTTP message into (headers dict with lower cased names, body).
+    """
+    head, _, body = text.partition("\n\n")
+    headers = {}
+
+    for line in head.split("\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+
+    return headers, body
+
+
+def parse_batch_response(content_type, text):
+    """
+    Parse a multipart $batch response into a list of (content_id, status_code, body) per operation. Changeset
+    responses are nested multipart bodies so we recurse into them.
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+
+    if not match:
+        return []
+
+    boundary = "--" + match.group(1)
+    text = text.replace("\r\n", "\n")
+    results = []
+
+    for part in text.split(boundary)[1:]:
+        if part.startswith("--"):
+            break
+
+        headers, body = split_headers(part.strip("\n"))
+        part_type = headers.get("content-type", "")
+
+        if part_type.startswith("multipart/mixed"):
+            results.extend(parse_batch_response(part_type, body))
+            continue
+
+        status_line, _, message = body.partition("\n")
+        status_code = int(status_line.split(" ")[1]) if status_line.startswith("HTTP/") else 0
+        _, response_body = split_headers(message)
+
+        results.append((headers.get("content-id"), status_code, response_body.strip()))
+
+    return results
+
+
+class AmperityDataverseRunner(AmperityAPIRunner):
+    """
+    Sends each batch as one or more $batch requests of at most MAX_BATCH_OPERATIONS operations. Dataverse answers a
+    $batch with 200 even if operations inside it failed so we parse the multipart response and record the failed
+    operations instead of trusting the batch status code.
+
+    Dataverse runs the operations of a $batch one at a time. With write_mode 'create_multiple' or 'upsert_multiple'
+    (from settings or DATAVERSE_WRITE_MODE) batches are instead split into chunks for the bulk actions and up to
+    max_parallel_requests chunks are kept in flight at once, across batches, by a pool that lives for the run. A 429
+    pauses every worker for the Retry-After the service asked for.
+
+    Sending is done here rather than by AmperityAPIRunner so its max_concurrency, partition_key/lanes, stream_body
+    and hedge settings don't apply, a run with any of them fails before sending.
+    """
+    def __init__(self, *args, entity_url=None, entity_type=None, cols=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        unsupported = [name for name, value in (
+            ("max_concurrency", self.concurrency),
+            ("partition_key", self.partition_key),
+            ("stream_body", self.stream_body),
+            ("hedge", self.hedge),
+        ) if value]
+
+        self.config_error = None
+
+        if unsupported:
+            self.config_error = f"{', '.join(unsupported)} is not supported by the Dataverse runner, use max_parallel_requests."
+
+        settings = self.settings or {}
 
-    output += f"--changeset_{changeset_id}--\n"
-    output += f"--batch_{batch_id}--"
+        self.entity_url = entity_url
+        self.entity_type = entity_type
+        self.cols = cols
+        self.write_mode = settings.get("write_mode", DATAVERSE_WRITE_MODE)
+        self.bulk_chunk_size = int(settings.get("bulk_chunk_size", DATAVERSE_BULK_CHUNK_SIZE))
+        self.max_parallel_requests = int(settings.get("max_parallel_requests", DATAVERSE_MAX_PARALLEL_REQUESTS))
 
-    return output
+        self.retry_lock = threading.Lock()
+        self.retry_at = 0
 
+        self.bulk_pool = None
+        # Bulk requests submitted and not yet finished, reading the file waits while max_parallel_requests are.
+        self.bulk_slots = threading.Semaphore(self.max_parallel_requests)
 
+    def run(self):
+        if self.config_error:
+            logging.error(self.config_error)
+            self.report_status("failed", 0, reason=self.config_error)
+
+            return http_response(400, "failed", self.config_error)
+
+        return super().run()
+
+    def prepare(self, data):
+        """
+        Format the request bodies, this runs in worker processes with the map_workers setting.
+        """
+        if self.write_mode in BULK_ACTIONS:
+            chunks = [data[start:start + self.bulk_chunk_size] for start in range(0, len(data), self.bulk_chunk_size)]
+
+            return [body for body in map(self.format_bulk, chunks) if body]
+
+        return [self.format_batch(data[start:start + MAX_BATCH_OPERATIONS]) for start in range(0, len(data), MAX_BATCH_OPERATIONS)]
+
+    def sends_in_background(self):
+        return self.write_mode in BULK_ACTIONS
+
+    def process_stream(self, stream_resp):
+        if self.write_mode not in BULK_ACTIONS:
+            return super().process_stream(stream_resp)
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel_requests) as self.bulk_pool:
+            super().process_stream(stream_resp)
+
+        self.bulk_pool = None
+
+        if self.dispatch_error:
+            raise self.dispatch_error
+
+        # Commit the batches that were still in flight after the last one was read.
+        self.save_checkpoint()
+
+    def send_prepared(self, prepared):
+        if self.write_mode not in BULK_ACTIONS:
+            for batch_id, body in prepared:
+                self.send_batch(batch_id, body)
+            return
+
+        # Sinks of a fan-out runner are handed batches without reading the file so they have no run pool.
+        if not self.bulk_pool:
+            with ThreadPoolExecutor(max_workers=self.max_parallel_requests) as pool:
+                list(pool.map(self.send_bulk, prepared))
+            return
+
+        batch = self.in_flight.start(len(prepared))
+
+        for body in prepared:
+            self.bulk_slots.acquire()
+            self.bulk_pool.submit(self.dispatch_bulk, body, batch)
+
+        if self.dispatch_error:
+            raise self.dispatch_error
+
+    def dispatch_bulk(self, body, batch):
+        try:
+            self.send_bulk(body)
+        except Exception as e:
+            # Raised in the main thread on the next batch like it would have been without the pool.
+            self.dispatch_error = self.dispatch_error or e
+        finally:
+            self.bulk_slots.release()
+            self.in_flight.finish(batch)
+
+    def format_bulk(self, data):
+        targets = []
+
+        for item in data:
+            formatted_item = {k: item[k] for k in self.cols if k in item}
+            if formatted_item:
+                targets.append(dict(formatted_item, **{"@odata.type": f"Microsoft.Dynamics.CRM.{self.entity_type}"}))
+
+        return dumps({"Targets": targets}).encode("utf-8") if targets else None
+
+    def format_batch(self, data):
+        batch_id = str(uuid.uuid4())
+        changeset_id = str(uuid.uuid4())
+
+        return batch_id, format_bulk_creation(batch_id, changeset_id, self.entity_url, data, self.cols).encode("utf-8")
+
+    def wait_for_retry_window(self):
+        with self.retry_lock:
+            delay = self.retry_at - time.monotonic()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def defer_retries(self, resp, attempt):
+        """
+        Push back every worker until the Retry-After the service sent, or an exponential backoff without one.
+        """
+        try:
+            delay = float(resp.headers["Retry-After"])
+        except (KeyError, ValueError):
+            delay = 2 ** attempt
+
+        with self.retry_lock:
+            self.retry_at = max(self.retry_at, time.monotonic() + delay)
+
+        logging.info(f"Dataverse service protection limit hit. Retrying in {delay} seconds.")
+
+    @rate_limit
+    def send_bulk(self, body):
+        url = f"{self.entity_url}/Microsoft.Dynamics.CRM.{BULK_ACTIONS[self.write_mode]}"
+
+        for attempt in range(DATAVERSE_MAX_RETRIES + 1):
+            self.wait_for_retry_window()
+
+            try:
+                resp = self.call_with_timeout(lambda: self.destination_session.post(url=url, data=body, timeout=self.timeouts))
+            except RetryError as e:
+                logging.error(f"Exceeded retries trying to communicate with destination. {url}")
+                self.errors.append(e)
+                return
+            except Timeout as e:
+                logging.error(f"Timed out sending to destination. {url}")
+                self.errors.append(e, kind="Timeout")
+                return
+
+            if resp.status_code != 429 or attempt == DATAVERSE_MAX_RETRIES:
+                break
+
+            self.defer_retries(resp, attempt)
+
+        if not resp.ok:
+            self.errors.append(resp.text, status=resp.status_code)
+
+    @rate_limit
+    def send_batch(self, batch_id, body):
+        try:
+            resp = self.call_with_timeout(lambda: self.destination_session.post(
+                url=self.destination_url,
+                data=body,
+                headers={"Content-Type": f"multipart/mixed;boundary=batch_{batch_id}"},
+                timeout=self.timeouts,
+            ))
+        except RetryError as e:
+            logging.error(f"Exceeded retries trying to communicate with destination. {self.destination_url}")
+            self.errors.append(e)
+            return
+        except Timeout as e:
+            logging.error(f"Timed out sending to destination. {self.destination_url}")
+            self.errors.append(e, kind="Timeout")
+            return
+
+        if not resp.ok:
+            self.errors.append(resp.text, status=resp.status_code)
+            return
+
+        for content_id, status_code, response_body in parse_batch_response(resp.headers.get("Content-Type"), resp.text):
+            if status_code >= 400:
+                self.errors.append(f"Operation {content_id} failed: {response_body}", status=status_code)
+
+
+@accept_async
 def lambda_handler(event, context):
     print(event)
     payload = json.loads(event['body']) if type(event['body']) == str else event['body']
@@ -98,23 +449,18 @@ def lambda_handler(event, context):
     if not cols:
         return
 
-    batch_id = str(uuid.uuid4())
-    changeset_id = str(uuid.uuid4())
-    sess.headers.update({"Content-Type": f"multipart/mixed;boundary=batch_{batch_id}"})
-
     batch_url = f"https://{PA_ENV_NAME}.api.{PA_ENV_REGION}.dynamics.com/api/data/v9.2/$batch"
     destination_url = f"https://{PA_ENV_NAME}.api.{PA_ENV_REGION}.dynamics.com/api/data/v9.2/{PLURAL_TABLE_NAME}"
 
-    def dataverse_mapping(data):
-        return format_bulk_creation(batch_id, changeset_id, destination_url, data, cols)
-
-    amperity_runner = AmperityAPIRunner(
+    amperity_runner = AmperityDataverseRunner(
         payload,
         context,
         amperity_tenant_id,
         destination_url=batch_url,
         destination_session=sess,
-        custom_mapping=dataverse_mapping
+        entity_url=destination_url,
+        entity_type=SINGULAR_TABLE_NAME,
+        cols=cols
         )
 
     res = amperity_runner.run()
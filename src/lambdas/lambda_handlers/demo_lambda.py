@@ -2,10 +2,12 @@ import json
 import logging
 
 from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.helpers import accept_async
 
 import requests
 
 
+@accept_async
 def lambda_handler(event, context):
     """
     Bare bones lambda runner demo.
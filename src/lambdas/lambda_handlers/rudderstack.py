@@ -2,14 +2,18 @@ import json
 import os
 
 from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.helpers import accept_async
 
 import requests
 
 
 RS_APP_NAME = os.environ.get('RS_APP_NAME', 'fake_app')
 RS_WRITE_KEY = os.environ.get('RS_WRITE_KEY', 'fake_key')
+# Rudderstack rejects batch requests over 4MB, leave some headroom for the request line and headers.
+RS_MAX_PAYLOAD_BYTES = int(os.environ.get('RS_MAX_PAYLOAD_BYTES', 4000000))
 
 
+@accept_async
 def lambda_handler(event, context):
     """
     :param event: Event object containing information about the invoking service
@@ -28,24 +32,27 @@ def lambda_handler(event, context):
 
     payload = json.loads(event['body'])
 
-    def add_customer_id(d):
-        return dict(d, **{
+    def add_customer_id(data):
+        return [dict(d, **{
             'userId': d['cust_id'] if 'cust_id' in d else 1234,
             'audience_name': payload.get('audience_name'),
             'type': 'track',
             'event': 'Product Purchased'
-        })
+        }) for d in data]
 
+    # Batches are packed up to the payload limit and every event gets a stable messageId so Rudderstack can
+    # dedupe events from a retried request.
     runner = AmperityAPIRunner(
         payload,
         context,
         'test',
-        batch_size=5,
         batch_offset=0,
         destination_url=destination_url,
         destination_session=sess,
         custom_mapping=add_customer_id,
         data_key='batch',
+        max_payload_bytes=RS_MAX_PAYLOAD_BYTES,
+        message_id_key='messageId',
     )
 
     status = runner.run()
@@ -2,8 +2,10 @@ import json
 import logging
 
 from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.helpers import accept_async
 
 
+@accept_async
 def lambda_handler(event, context):
     """
     Bare bones lambda runner template.
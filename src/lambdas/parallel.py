@@ -0,0 +1,100 @@
+import collections
+import itertools
+import logging
+import multiprocessing
+import traceback
+
+
+"""
+Process based parallelism that works inside Lambda. Lambda has no /dev/shm so multiprocessing.Queue and Pool fail
+to start, Pipe only needs a socket pair. Larger lambdas get up to 6 vCPUs which threads can't use for CPU bound work
+like decoding and custom_mapping because of the GIL.
+"""
+
+
+STOP = 'stop'
+
+
+def worker(conn, func):
+    while True:
+        item = conn.recv()
+
+        if item == STOP:
+            break
+
+        try:
+            conn.send((True, func(item)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+    conn.close()
+
+
+class ProcessMapper:
+    """
+    Map func over items in forked worker processes and yield the results in the order of items.
+
+        with ProcessMapper(func, workers=4) as mapper:
+            for result in mapper.imap(items):
+                ...
+
+    Workers are forked so func can be any callable, ie a bound method, only items and results are pickled. Items
+    are dealt round robin with one in flight per worker. Results are read back in the same order, so the caller gets
+    them in order and a worker never blocks writing a result while we block writing it a new item.
+    """
+    def __init__(self, func, workers):
+        self.func = func
+        self.workers = workers
+        self.processes = []
+        self.connections = []
+
+    def __enter__(self):
+        context = multiprocessing.get_context('fork')
+
+        for _ in range(self.workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=worker, args=(child_conn, self.func), daemon=True)
+            process.start()
+            child_conn.close()
+
+            self.processes.append(process)
+            self.connections.append(parent_conn)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for conn, process in zip(self.connections, self.processes):
+            if exc_type:
+                process.kill()
+            else:
+                conn.send(STOP)
+
+            process.join()
+            conn.close()
+
+        self.processes = []
+        self.connections = []
+
+    def imap(self, items):
+        items = iter(items)
+        in_flight = collections.deque()
+
+        for conn in self.connections:
+            for item in itertools.islice(items, 1):
+                conn.send(item)
+                in_flight.append(conn)
+
+        while in_flight:
+            conn = in_flight.popleft()
+            ok, result = conn.recv()
+
+            if not ok:
+                logging.error(result)
+                raise RuntimeError(f'Worker process failed.\n{result}')
+
+            # Hand the worker its next item before returning so it works while the caller uses the result.
+            for item in itertools.islice(items, 1):
+                conn.send(item)
+                in_flight.append(conn)
+
+            yield result
@@ -0,0 +1,136 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+from urllib.parse import urlparse
+
+
+PROFILE_DIR = os.getenv('AMPERITY_PROFILE_DIR', '/tmp')
+PROFILE_TOP_N = int(os.getenv('AMPERITY_PROFILE_TOP_N', '20'))
+SAMPLE_INTERVAL = float(os.getenv('AMPERITY_PROFILE_INTERVAL', '0.005'))
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+class SamplingProfiler:
+    """
+    Low overhead statistical profiler. A background thread snapshots the stack of every other thread each
+    interval. Stacks are kept as collapsed strings ('outer;inner;leaf') so the output can be fed to flamegraph tools.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        own_ident = threading.get_ident()
+
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def summary(self, top_n=PROFILE_TOP_N):
+        """
+        The frames with the most samples at the top of the stack (self time) and anywhere in it (inclusive time).
+        """
+        total = sum(self.stacks.values()) or 1
+        leaf = Counter()
+        inclusive = Counter()
+
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            leaf[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        lines = [f'{total} samples every {self.interval * 1000:.1f}ms', 'self %  total %  frame']
+        for frame, count in leaf.most_common(top_n):
+            lines.append(f'{count / total:6.1%}  {inclusive[frame] / total:6.1%}  {frame}')
+
+        return '\n'.join(lines)
+
+
+def upload_profile(path, s3_uri):
+    # boto3 is always available in the lambda runtime but is not a dependency of the runner itself.
+    import boto3
+
+    parsed = urlparse(s3_uri)
+    key = '/'.join(part for part in (parsed.path.strip('/'), os.path.basename(path)) if part)
+
+    boto3.client('s3').upload_file(path, parsed.netloc, key)
+    logging.info(f'Uploaded profile to s3://{parsed.netloc}/{key}')
+
+
+def profile_call(f, mode, name, s3_uri=None):
+    """
+    Run f under a profiler, write the profile to PROFILE_DIR (and s3_uri if given) and log the hottest frames.
+
+    mode : str
+        'cprofile' for deterministic profiling (exact call counts, higher overhead) or 'sample' for the sampling
+        profiler (approximate, low overhead, includes time spent in every thread).
+    name : str
+        File name of the profile without extension, usually the webhook_id.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}, use one of {', '.join(PROFILE_MODES)}.")
+
+    start = time.perf_counter()
+
+    if mode == 'sample':
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            return f()
+        finally:
+            profiler.stop()
+            path = os.path.join(PROFILE_DIR, f'{name}.collapsed')
+            profiler.write(path)
+            summary = profiler.summary()
+            finish_profile(path, summary, time.perf_counter() - start, s3_uri)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(f)
+    finally:
+        path = os.path.join(PROFILE_DIR, f'{name}.prof')
+        profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        finish_profile(path, output.getvalue(), time.perf_counter() - start, s3_uri)
+
+
+def finish_profile(path, summary, elapsed, s3_uri):
+    logging.info(f'Profiled run in {elapsed:.2f}s, wrote {path}\n{summary}')
+
+    if s3_uri:
+        try:
+            upload_profile(path, s3_uri)
+        except Exception as e:
+            logging.error(f'Failed to upload profile to {s3_uri}. {e}')
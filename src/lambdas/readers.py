@@ -0,0 +1,310 @@
+import csv
+import io
+import json
+import os
+
+import requests
+
+from lambdas.records import RecordDecoder
+from lambdas.timeouts import get_timeouts
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+"""
+Input readers turn the data_url response into batches of records for runner_logic. Every reader has the same
+interface so handlers don't need to know what format Amperity exported:
+
+    reader.iter_batches(stream_resp, batch_size, offset) -> yields lists of at most batch_size records
+    reader.bytes_read -> bytes of the file consumed so far, used for progress
+
+Rows before offset are skipped without being decoded. To add a format subclass Reader and register it in READERS.
+With a schema rows are decoded into compact records instead of dicts, see lambdas.records.
+"""
+
+
+# Bytes read from the response at a time by the line readers, the 'read_chunk_size' setting overrides it.
+READ_CHUNK_SIZE = int(os.getenv('AMPERITY_READ_CHUNK_SIZE', 1024 * 1024))
+
+
+def iter_lines(stream_resp, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yield (line, end) for every line of the response where end is the byte offset just past the line's newline.
+    Replaces requests' iter_lines which reads 512 bytes at a time and splits \r\n pairs that straddle two reads
+    into an extra empty line. Lines are split on \n only and a trailing \r is dropped.
+    """
+    pending = b''
+    end = 0
+
+    for chunk in stream_resp.iter_content(chunk_size):
+        lines = (pending + chunk if pending else chunk).split(b'\n')
+        pending = lines.pop()
+
+        for line in lines:
+            end += len(line) + 1
+            yield (line[:-1] if line.endswith(b'\r') else line), end
+
+    if pending:
+        end += len(pending)
+        yield (pending[:-1] if pending.endswith(b'\r') else pending), end
+
+
+def batched(rows, batch_size):
+    data_batch = []
+
+    for row in rows:
+        data_batch.append(row)
+
+        if len(data_batch) == batch_size:
+            yield data_batch
+            data_batch = []
+
+    if data_batch:
+        yield data_batch
+
+
+class Reader:
+    # Whether a response opened part way through the file (a Range request from start_byte) can be read.
+    resumes_from_bytes = False
+
+    def __init__(self, settings=None, schema=None, start_byte=0):
+        self.settings = settings or {}
+        self.decoder = RecordDecoder(schema) if schema else None
+        self.start_byte = start_byte
+        self.bytes_read = start_byte
+        self.chunk_size = int(self.settings.get('read_chunk_size', READ_CHUNK_SIZE))
+
+    def rows(self, stream_resp, offset):
+        """
+        Yield decoded records starting at row offset. Line based readers only need to implement this.
+        """
+        raise NotImplementedError('Please implement rows or iter_batches for your reader.')
+
+    def iter_batches(self, stream_resp, batch_size, offset=0):
+        return batched(self.rows(stream_resp, offset), batch_size)
+
+    def raw_batches(self, stream_resp, batch_size, offset=0):
+        """
+        Batches before decoding, turned into records with decode_batch. Lets decoding run in worker processes,
+        see lambdas.parallel. Readers that decode while reading return decoded batches and decode_batch is a no-op.
+        """
+        return self.iter_batches(stream_resp, batch_size, offset)
+
+    def decode_batch(self, raw_batch):
+        return raw_batch
+
+
+class NDJSONReader(Reader):
+    resumes_from_bytes = True
+
+    def lines(self, stream_resp, offset):
+        row_num = 0
+
+        for line, end in iter_lines(stream_resp, self.chunk_size):
+            self.bytes_read = self.start_byte + end
+
+            if not line:
+                continue
+
+            row_num += 1
+
+            # We cannot stream to an offset so skip iterations while we are catching up.
+            if row_num <= offset:
+                continue
+
+            yield line
+
+    def decode(self, line):
+        return self.decoder.decode(line) if self.decoder else json.loads(line)
+
+    def rows(self, stream_resp, offset):
+        return map(self.decode, self.lines(stream_resp, offset))
+
+    def raw_batches(self, stream_resp, batch_size, offset=0):
+        return batched(self.lines(stream_resp, offset), batch_size)
+
+    def decode_batch(self, raw_batch):
+        return [self.decode(line) for line in raw_batch]
+
+
+class CSVReader(Reader):
+    """
+    Streams a CSV with a header row. Values are strings unless typed with the 'csv_types' setting,
+    ie {"csv_types": {"age": "int", "revenue": "float", "opted_in": "bool", "attributes": "json"}}.
+    Empty values become None.
+    """
+    CONVERTERS = {
+        'str': str,
+        'int': int,
+        'float': float,
+        'bool': lambda val: val.strip().lower() in ('true', 't', '1', 'yes', 'y'),
+        'json': json.loads,
+    }
+
+    def lines(self, stream_resp):
+        for i, (line, self.bytes_read) in enumerate(iter_lines(stream_resp, self.chunk_size)):
+            # csv.reader needs the newline back to keep it inside a quoted value that spans lines. Excel writes a
+            # byte order mark before the header.
+            yield line.decode('utf-8-sig' if i == 0 else 'utf-8') + '\n'
+
+    def rows(self, stream_resp, offset):
+        types = self.settings.get('csv_types', {})
+        reader = csv.reader(self.lines(stream_resp), delimiter=self.settings.get('csv_delimiter', ','))
+        header = next(reader, None)
+
+        if not header:
+            return
+
+        converters = [self.CONVERTERS[types.get(col, 'str')] for col in header]
+
+        for row_num, values in enumerate(reader):
+            if row_num < offset or not values:
+                continue
+
+            row = {col: (convert(val) if val != '' else None) for col, convert, val in zip(header, converters, values)}
+
+            yield self.decoder.from_dict(row) if self.decoder else row
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file over HTTP Range requests. Parquet keeps its metadata at the end of the file so we
+    need random access, this fetches only the footer and the row groups we read instead of the whole file.
+    """
+    def __init__(self, url, size, session=None, timeout=None):
+        self.url = url
+        self.size = size
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+
+        if size == 0 or self.position >= self.size:
+            return b''
+
+        end = min(self.position + size, self.size) - 1
+        resp = self.session.get(self.url, headers={'Range': f'bytes={self.position}-{end}'}, timeout=self.timeout)
+        resp.raise_for_status()
+
+        self.position = end + 1
+
+        return resp.content
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+
+class ParquetReader(Reader):
+    """
+    Streams a Parquet file one row group at a time with pyarrow (add it to your lambda as a layer). Batches come
+    straight from pyarrow's record batches and row groups before the offset are never downloaded.
+    """
+    def iter_batches(self, stream_resp, batch_size, offset=0):
+        if pq is None:
+            raise NotImplementedError('Reading parquet requires pyarrow. Please add it to your lambda.')
+
+        size = int(stream_resp.headers.get('Content-Length'))
+        # The streaming response was opened for line readers, parquet reads with range requests instead.
+        stream_resp.close()
+
+        connect_timeout, read_timeout, _ = get_timeouts(self.settings)
+        parquet_file = pq.ParquetFile(HTTPRangeFile(stream_resp.url, size, timeout=(connect_timeout, read_timeout)))
+        total_rows = parquet_file.metadata.num_rows or 1
+        row_groups = []
+        rows_read = 0
+
+        for i in range(parquet_file.num_row_groups):
+            num_rows = parquet_file.metadata.row_group(i).num_rows
+
+            if not row_groups and rows_read + num_rows <= offset:
+                rows_read += num_rows
+            else:
+                row_groups.append(i)
+
+        skip = offset - rows_read
+
+        if not row_groups:
+            self.bytes_read = size
+            return
+
+        # With a schema only the declared columns are downloaded and decoded.
+        columns = None
+        if self.decoder:
+            columns = [col for col in self.decoder.schema if col in parquet_file.schema_arrow.names]
+
+        for record_batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+            rows_read += record_batch.num_rows
+
+            if skip:
+                dropped = min(skip, record_batch.num_rows)
+                record_batch = record_batch.slice(dropped)
+                skip -= dropped
+
+            # Parquet has no row to byte mapping so progress is the share of rows read.
+            self.bytes_read = size * rows_read // total_rows
+
+            if record_batch.num_rows and self.decoder:
+                yield [self.decoder.from_dict(row) for row in record_batch.to_pylist()]
+            elif record_batch.num_rows:
+                yield record_batch.to_pylist()
+
+
+READERS = {
+    'ndjson': NDJSONReader,
+    'csv': CSVReader,
+    'parquet': ParquetReader,
+}
+
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/vnd.apache.parquet': 'parquet',
+    'application/x-parquet': 'parquet',
+    'application/parquet': 'parquet',
+}
+
+
+def get_reader(settings, content_type=None, url=None, schema=None, start_byte=0):
+    """
+    Pick the reader from the 'input_format' setting, then the response Content-Type, then the data_url file
+    extension. Defaults to NDJSON which is what Amperity exports for webhooks.
+    """
+    settings = settings or {}
+    input_format = settings.get('input_format')
+
+    if not input_format and content_type:
+        input_format = CONTENT_TYPES.get(content_type.split(';')[0].strip().lower())
+
+    if not input_format and url:
+        path = url.split('?')[0].lower()
+        input_format = next((fmt for fmt in READERS if path.endswith(f'.{fmt}')), None)
+
+    return READERS[input_format or 'ndjson'](settings, schema, start_byte)
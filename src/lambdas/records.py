@@ -0,0 +1,168 @@
+import functools
+import json
+
+from typing import Any, Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+"""
+Compact typed records decoded straight from the export. A schema maps field names to types:
+
+    {'phone_number': 'str', 'message': 'str', 'lifetime_orders': 'int'}
+
+Fields not in the schema are dropped at decode time and missing fields are None. Records are slotted objects (msgspec
+Structs when msgspec is installed, which also skips undeclared fields while parsing) so a batch of wide rows holds
+only the columns a handler reads. They support the parts of the dict API handlers already use: record['key'],
+record.get('key'), keys(), items() and dict(record). Only declared fields can be set.
+"""
+
+
+TYPES = {
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': bool,
+    'any': Any,
+}
+
+
+def coerce(value, field_type):
+    if value is None or field_type is Any or isinstance(value, field_type):
+        return value
+
+    if field_type is bool and isinstance(value, str):
+        return value.strip().lower() in ('true', 't', '1', 'yes', 'y')
+
+    return field_type(value)
+
+
+def getitem(self, key):
+    if key not in self.fields:
+        raise KeyError(key)
+
+    return getattr(self, key)
+
+
+def setitem(self, key, value):
+    if key not in self.fields:
+        raise KeyError(f'{key} is not in the record schema.')
+
+    setattr(self, key, value)
+
+
+def get(self, key, default=None):
+    return getattr(self, key) if key in self.fields else default
+
+
+def keys(self):
+    return self.fields
+
+
+def items(self):
+    return [(field, getattr(self, field)) for field in self.fields]
+
+
+def to_dict(self):
+    return {field: getattr(self, field) for field in self.fields}
+
+
+def contains(self, key):
+    return key in self.fields
+
+
+def reduce(self):
+    # Record types are built at runtime so pickle can't import them by name, rebuild them from the schema instead.
+    # Needed to send records to worker processes, see lambdas.parallel.
+    return rebuild_record, (type(self).__name__, tuple(self.schema.items()), self.accelerated,
+                            tuple(getattr(self, field) for field in self.fields))
+
+
+MAPPING_METHODS = {
+    '__getitem__': getitem,
+    '__setitem__': setitem,
+    '__contains__': contains,
+    '__reduce__': reduce,
+    'get': get,
+    'keys': keys,
+    'items': items,
+    'to_dict': to_dict,
+}
+
+
+def make_slotted_record(name, schema):
+    fields = tuple(schema)
+
+    def __init__(self, **kwargs):
+        for field in fields:
+            setattr(self, field, kwargs.get(field))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.items() == other.items()
+
+    def __repr__(self):
+        return f'{name}({", ".join(f"{k}={v!r}" for k, v in self.items())})'
+
+    return type(name, (), dict(MAPPING_METHODS, __slots__=fields, __init__=__init__, __eq__=__eq__, __repr__=__repr__,
+                               fields=fields, schema=schema, accelerated=False))
+
+
+def make_struct_record(name, schema):
+    fields = tuple(schema)
+
+    return msgspec.defstruct(
+        name,
+        [(field, Optional[field_type], None) for field, field_type in schema.items()],
+        namespace=dict(MAPPING_METHODS, fields=fields, schema=schema, accelerated=True),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def record_type(name, schema_items, accelerated):
+    """
+    One record type per schema so records decoded in different places (or rebuilt after pickling) compare equal.
+    """
+    schema = dict(schema_items)
+
+    return make_struct_record(name, schema) if accelerated else make_slotted_record(name, schema)
+
+
+def rebuild_record(name, schema_items, accelerated, values):
+    return record_type(name, schema_items, accelerated)(**dict(zip((field for field, _ in schema_items), values)))
+
+
+class RecordDecoder:
+    """
+    Decodes NDJSON lines or dicts into records of the given schema.
+    """
+    def __init__(self, schema, name='Record'):
+        self.schema = {field: TYPES[t] if isinstance(t, str) else t for field, t in schema.items()}
+
+        self.record_type = record_type(name, tuple(self.schema.items()), msgspec is not None)
+        self.json_decoder = msgspec.json.Decoder(self.record_type, strict=False) if msgspec else None
+
+    def from_dict(self, data):
+        return self.record_type(**{field: coerce(data.get(field), t) for field, t in self.schema.items()})
+
+    def decode(self, line):
+        if self.json_decoder:
+            try:
+                return self.json_decoder.decode(line)
+            except msgspec.ValidationError:
+                # Lax about types the way the stdlib path is, ie a numeric phone number for a 'str' field.
+                pass
+
+        return self.from_dict(json.loads(line))
+
+
+def to_builtins(obj):
+    """
+    json.dumps default for records, ie json.dumps(batch, default=to_builtins).
+    """
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
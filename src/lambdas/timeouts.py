@@ -0,0 +1,135 @@
+import collections
+import os
+import queue
+import threading
+import time
+
+import requests
+
+
+"""
+Timeouts for every outbound call so one stalled connection can't hang a lambda until it is killed.
+
+requests only has connect and read timeouts, the read timeout applies to each read from the socket so a server
+trickling bytes, or retries with backoff, can still take far longer. call_with_timeout adds an overall deadline by
+running the call in a daemon thread, the abandoned call finishes on its own once its read timeout fires.
+
+An abandoned call is not cancelled. A POST that already reached the destination may still be processed, and the
+timeout is counted as an error, so the records can be delivered twice if the run or batch is retried. Turn
+request_timeout off (0) for destinations that can't take the same body twice.
+
+It can also hedge: when a call has taken longer than most (the p95 of recent calls) a duplicate is sent and
+whichever answers first wins. Only hedge calls the destination can safely receive twice, ie upserts or endpoints
+that drop repeated message ids.
+"""
+
+
+CONNECT_TIMEOUT = float(os.getenv('AMPERITY_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('AMPERITY_READ_TIMEOUT', 30))
+# Deadline for a whole status update or destination request including retries, 0 turns it off. The request past
+# the deadline is abandoned, not cancelled, and may still be delivered.
+REQUEST_TIMEOUT = float(os.getenv('AMPERITY_REQUEST_TIMEOUT', 60))
+
+HEDGE_PERCENTILE = 0.95
+# Latencies kept to estimate the hedge delay, and how many are needed before hedging starts.
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+class OverallTimeout(requests.exceptions.Timeout):
+    pass
+
+
+def get_timeouts(settings):
+    """
+    (connect, read, overall) timeouts in seconds from the 'connect_timeout', 'read_timeout' and 'request_timeout'
+    settings, falling back to the environment.
+    """
+    settings = settings or {}
+
+    return (
+        float(settings.get('connect_timeout', CONNECT_TIMEOUT)),
+        float(settings.get('read_timeout', READ_TIMEOUT)),
+        float(settings.get('request_timeout', REQUEST_TIMEOUT)),
+    )
+
+
+def is_timeout(error):
+    """
+    requests raises a ConnectionError, not a Timeout, when the read timeout fires while streaming a response body.
+    """
+    return isinstance(error, requests.exceptions.Timeout) or (
+        isinstance(error, requests.exceptions.ConnectionError) and 'timed out' in str(error).lower())
+
+
+class LatencyWindow:
+    def __init__(self, size=HEDGE_WINDOW, min_samples=HEDGE_MIN_SAMPLES):
+        self.latencies = collections.deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, q):
+        """
+        The q quantile of recent latencies, None until there are min_samples of them.
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+
+            ordered = sorted(self.latencies)
+
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def call_with_timeout(call, timeout, hedge_after=None):
+    """
+    Run call() with an overall deadline of timeout seconds (none if 0), raising OverallTimeout past it. The call
+    keeps running in its thread after that and can still succeed.
+
+    With hedge_after a second call() is started if the first hasn't returned after that many seconds. The first
+    to return wins, an exception is only raised once every call failed. Returns (result, attempts, hedged) where
+    hedged is True if the duplicate won.
+    """
+    results = queue.Queue()
+    start = time.monotonic()
+
+    def attempt(index):
+        try:
+            results.put((index, True, call()))
+        except Exception as e:
+            results.put((index, False, e))
+
+    threading.Thread(target=attempt, args=(0,), daemon=True).start()
+    attempts = 1
+    failures = []
+
+    while True:
+        now = time.monotonic()
+        waits = []
+
+        if timeout:
+            waits.append(start + timeout - now)
+        if hedge_after is not None and attempts == 1:
+            waits.append(start + hedge_after - now)
+
+        try:
+            index, ok, value = results.get(timeout=max(min(waits), 0) if waits else None)
+        except queue.Empty:
+            if attempts > 1 or (timeout and time.monotonic() - start >= timeout):
+                raise OverallTimeout(f'No response within {timeout:g} seconds.')
+
+            threading.Thread(target=attempt, args=(1,), daemon=True).start()
+            attempts += 1
+            continue
+
+        if ok:
+            return value, attempts, index == 1
+
+        failures.append(value)
+
+        if len(failures) == attempts:
+            raise failures[0]
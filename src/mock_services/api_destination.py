@@ -1,19 +1,197 @@
+import json
+import math
+import os
+import random
+import threading
+import time
+
+from collections import Counter, deque
+
 from flask import Flask, request, jsonify
 
 app = Flask(__name__)
 
 
+# Destination profiles for /mock/profile/<name>. Every key is optional:
+#   latency_ms     - {"median": ms, "p99": ms} sampled from a lognormal distribution
+#   error_rates    - {"<status code>": probability} checked on every request
+#   retry_after    - seconds sent in the Retry-After header of 429 and 503 responses
+#   quota          - {"rate": requests per second, "burst": bucket size} token bucket per API key
+#   max_body_bytes - bodies larger than this are rejected with a 413
+# Add or override profiles with a json file at MOCK_PROFILES_FILE or by PUTing to /mock/profiles/<name>.
+PROFILES = {
+    'fast': {},
+    'realistic': {
+        'latency_ms': {'median': 80, 'p99': 1500},
+        'error_rates': {'429': 0.01, '502': 0.005},
+        'retry_after': 1,
+    },
+    'flaky': {
+        'latency_ms': {'median': 50, 'p99': 400},
+        'error_rates': {'502': 0.1, '503': 0.05},
+        'retry_after': 2,
+    },
+    'throttled': {
+        'latency_ms': {'median': 30, 'p99': 200},
+        'quota': {'rate': 5, 'burst': 10},
+        'retry_after': 1,
+    },
+    'rudderstack': {
+        'latency_ms': {'median': 40, 'p99': 600},
+        'max_body_bytes': 4 * 1024 * 1024,
+    },
+}
+
+if os.environ.get('MOCK_PROFILES_FILE'):
+    with open(os.environ['MOCK_PROFILES_FILE']) as f:
+        PROFILES.update(json.load(f))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token if one is available. Returns the seconds until the next token otherwise 0.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+
+class Stats:
+    """
+    Thread safe counters for /stats. The Flask dev server handles every request on its own thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.requests = 0
+            self.records = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.status_codes = Counter()
+            # (timestamp, records) of recent requests for the records per second over the last 10 seconds.
+            self.recent = deque()
+
+    def start_request(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def end_request(self, status_code):
+        with self.lock:
+            self.in_flight -= 1
+            self.status_codes[status_code] += 1
+
+    def add_records(self, count):
+        now = time.time()
+
+        with self.lock:
+            self.records += count
+            self.recent.append((now, count))
+
+            while self.recent and self.recent[0][0] < now - 10:
+                self.recent.popleft()
+
+    def summary(self):
+        now = time.time()
+
+        with self.lock:
+            elapsed = max(now - self.started, 1e-6)
+            recent = sum(count for ts, count in self.recent if ts >= now - 10)
+
+            return {
+                'requests': self.requests,
+                'records': self.records,
+                'records_per_second': round(self.records / elapsed, 2),
+                'recent_records_per_second': round(recent / min(elapsed, 10), 2),
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'status_codes': dict(self.status_codes),
+                'elapsed_seconds': round(elapsed, 2),
+            }
+
+
+stats = Stats()
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+def count_records(req):
+    """
+    Records are either the body itself or the single list stored under a data key (ie {"batch": [...]}).
+    """
+    if isinstance(req, list):
+        return len(req)
+
+    if isinstance(req, dict):
+        lists = [val for val in req.values() if isinstance(val, list)]
+        return len(lists[0]) if len(lists) == 1 else 1
+
+    return 0
+
+
+def sample_latency(latency_ms):
+    median = latency_ms['median']
+    p99 = latency_ms.get('p99', median)
+    # 2.326 is the z score of the 99th percentile.
+    sigma = (math.log(p99) - math.log(median)) / 2.326 if p99 > median else 0
+
+    return random.lognormvariate(math.log(median), sigma) / 1000
+
+
+@app.before_request
+def track_request_start():
+    if request.endpoint != 'get_stats':
+        stats.start_request()
+
+
+@app.after_request
+def track_request_end(response):
+    if request.endpoint != 'get_stats':
+        stats.end_request(response.status_code)
+
+    return response
+
+
 @app.route('/health')
 def health_check():
     print('Checking Health')
     return jsonify(message="up", status=200), 200
 
 
+@app.route('/stats', methods=['GET', 'DELETE'])
+def get_stats():
+    if request.method == 'DELETE':
+        stats.reset()
+
+    return jsonify(stats.summary()), 200
+
+
 @app.route('/mock/destination', methods=['POST'])
 def mock_destination():
     req = request.json
     print(req)
     print(f"Recieved request with {len(req)} records.")
+    stats.add_records(count_records(req))
 
     return jsonify(message=f"Recieved request with {len(req)} records.", status=200), 200
 
@@ -34,9 +212,71 @@ def mock_rudderstack():
             print(f"Invalid request. Data must be under the 'userId' key: {rec}")
             return jsonify(message="Invalid request. Every record must have a 'userId' field", status=400), 400
 
+    stats.add_records(len(req.get('batch')))
+
     return jsonify(message="Check api_destination logs", status=200), 200
 
 
+@app.route('/mock/profiles', methods=['GET'])
+def list_profiles():
+    return jsonify(PROFILES), 200
+
+
+@app.route('/mock/profiles/<name>', methods=['PUT'])
+def put_profile(name):
+    PROFILES[name] = request.json
+
+    with buckets_lock:
+        for key in [key for key in buckets if key[0] == name]:
+            del buckets[key]
+
+    return jsonify(message=f"Updated profile {name}", status=200), 200
+
+
+@app.route('/mock/profile/<name>', methods=['POST', 'PUT'])
+def mock_profile(name):
+    """
+    A destination that behaves like the named profile. Failures are decided before the latency is applied, the
+    same way a real API rejects throttled or oversized requests before doing any work.
+    """
+    profile = PROFILES.get(name)
+
+    if profile is None:
+        return jsonify(message=f"Unknown profile {name}", status=404), 404
+
+    retry_after = str(profile.get('retry_after', 1))
+    max_body_bytes = profile.get('max_body_bytes')
+
+    if max_body_bytes and (request.content_length or len(request.get_data())) > max_body_bytes:
+        return jsonify(message=f"Request body exceeds {max_body_bytes} bytes", status=413), 413
+
+    quota = profile.get('quota')
+
+    if quota:
+        api_key = request.headers.get('Authorization') or request.headers.get('X-Api-Key') or 'anonymous'
+
+        with buckets_lock:
+            bucket = buckets.setdefault((name, api_key), TokenBucket(quota['rate'], quota['burst']))
+
+        wait = bucket.take()
+
+        if wait:
+            return jsonify(message="Quota exceeded", status=429), 429, {'Retry-After': str(math.ceil(wait))}
+
+    for code, rate in profile.get('error_rates', {}).items():
+        if random.random() < rate:
+            headers = {'Retry-After': retry_after} if int(code) in (429, 503) else {}
+            return jsonify(message="Mock error", status=int(code)), int(code), headers
+
+    if profile.get('latency_ms'):
+        time.sleep(sample_latency(profile['latency_ms']))
+
+    records = count_records(request.get_json(silent=True))
+    stats.add_records(records)
+
+    return jsonify(message=f"Recieved request with {records} records.", status=200), 200
+
+
 @app.route('/mock/poll/<id>', methods=['PUT'])
 def poll_for_status(id):
     req = request.json
@@ -55,4 +295,4 @@ def return_error(code):
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5005)
+    app.run(debug=True, host='0.0.0.0', port=5005, threaded=True)
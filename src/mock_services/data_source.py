@@ -0,0 +1,183 @@
+import functools
+import json
+import random
+import re
+import uuid
+import zlib
+
+from flask import Flask, Response, request, jsonify
+
+app = Flask(__name__)
+
+
+"""
+A stand in for the pre-signed data_url Amperity hands the Lambda. Files are generated on the fly from the query string
+so any size can be served without storing it:
+
+    /data/<name>.ndjson?rows=1000000&seed=7&columns=amperity_id:uuid,email:email,revenue:float&gzip=true
+
+Every row is padded with spaces to the same width (trailing whitespace is still valid JSON). That lets us compute the
+Content-Length up front and generate any byte range without generating the rows before it.
+"""
+
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+               'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin']
+CITIES = ['Seattle', 'Portland', 'Spokane', 'Tacoma', 'Boise', 'Eugene', 'Salem', 'Bellevue', 'Olympia', 'Yakima']
+STATES = ['WA', 'OR', 'ID', 'CA', 'NV', 'MT', 'UT', 'AZ', 'CO', 'NM']
+
+# type -> (generator, max length of its JSON representation)
+COLUMN_TYPES = {
+    'uuid': (lambda rng: str(uuid.UUID(int=rng.getrandbits(128), version=4)), 38),
+    'first_name': (lambda rng: rng.choice(FIRST_NAMES), max(map(len, FIRST_NAMES)) + 2),
+    'last_name': (lambda rng: rng.choice(LAST_NAMES), max(map(len, LAST_NAMES)) + 2),
+    'email': (lambda rng: f'{rng.choice(FIRST_NAMES)[0]}{rng.choice(LAST_NAMES)}{rng.randrange(10000)}@example.com'.lower(),
+              1 + max(map(len, LAST_NAMES)) + 4 + 12 + 2),
+    'phone': (lambda rng: f'+1206{rng.randrange(10 ** 7):07d}', 14),
+    'city': (lambda rng: rng.choice(CITIES), max(map(len, CITIES)) + 2),
+    'state': (lambda rng: rng.choice(STATES), 4),
+    'postal': (lambda rng: f'{rng.randrange(10 ** 5):05d}', 7),
+    'int': (lambda rng: rng.randrange(10 ** 6), 6),
+    'float': (lambda rng: round(rng.uniform(0, 10000), 2), 8),
+    'bool': (lambda rng: rng.random() < 0.5, 5),
+    'date': (lambda rng: f'20{rng.randrange(10, 25)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}', 12),
+    'nullable': (lambda rng: None, 4),
+}
+
+DEFAULT_COLUMNS = ('amperity_id:uuid,given_name:first_name,surname:last_name,email:email,phone:phone,city:city,'
+                   'state:state,postal:postal,lifetime_order_frequency:int,lifetime_order_revenue:float,'
+                   'one_and_done:bool,first_order_date:date,second_order_id:nullable')
+
+# Rows generated per chunk of the response body.
+CHUNK_ROWS = 1000
+
+
+class Dataset:
+    def __init__(self, rows, seed, columns):
+        self.rows = rows
+        self.seed = seed
+        self.columns = []
+
+        for column in columns.split(','):
+            name, _, column_type = column.partition(':')
+            if column_type not in COLUMN_TYPES:
+                raise ValueError(f'Unknown column type {column_type}. Use one of {", ".join(COLUMN_TYPES)}.')
+            self.columns.append((json.dumps(name), COLUMN_TYPES[column_type]))
+
+        # {} + the keys and colons + max value lengths + commas + newline
+        self.width = 2 + sum(len(name) + 1 + max_len for name, (_, max_len) in self.columns) + len(self.columns) - 1 + 1
+        self.size = self.rows * self.width
+
+    def row(self, i):
+        rng = random.Random(self.seed * 1000003 + i)
+        values = ','.join(f'{name}:{json.dumps(gen(rng))}' for name, (gen, _) in self.columns)
+
+        return f'{{{values}}}'.ljust(self.width - 1).encode('utf-8') + b'\n'
+
+    def iter_bytes(self, start=0, end=None):
+        """
+        Yield the bytes from start to end inclusive in chunks of CHUNK_ROWS rows.
+        """
+        end = self.size - 1 if end is None else end
+        first_row = start // self.width
+        last_row = end // self.width
+
+        for chunk_start in range(first_row, last_row + 1, CHUNK_ROWS):
+            chunk_end = min(chunk_start + CHUNK_ROWS, last_row + 1)
+            chunk = b''.join(self.row(i) for i in range(chunk_start, chunk_end))
+
+            offset = chunk_start * self.width
+            yield chunk[max(start - offset, 0):end - offset + 1]
+
+    def iter_gzip(self):
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        for chunk in self.iter_bytes():
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+
+        yield compressor.flush()
+
+
+@functools.lru_cache(maxsize=32)
+def gzip_size(rows, seed, columns):
+    """
+    The compressed size is only known after compressing, so compress once without keeping the output. The output
+    is deterministic so the real response has exactly this length.
+    """
+    return sum(len(chunk) for chunk in Dataset(rows, seed, columns).iter_gzip())
+
+
+def parse_range(range_header, size):
+    """
+    Parse a single 'bytes=start-end' range. Returns (start, end) or None when it can't be satisfied.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+
+    if start >= size or start > end:
+        return None
+
+    return start, end
+
+
+@app.route('/health')
+def health_check():
+    print('Checking Health')
+    return jsonify(message="up", status=200), 200
+
+
+@app.route('/data/<name>.ndjson', methods=['GET'])
+def generate_ndjson(name):
+    try:
+        dataset = Dataset(
+            rows=int(request.args.get('rows', 1000)),
+            seed=int(request.args.get('seed', 0)),
+            columns=request.args.get('columns', DEFAULT_COLUMNS)
+        )
+    except ValueError as e:
+        return jsonify(message=str(e), status=400), 400
+
+    headers = {'Content-Type': 'application/x-ndjson', 'Accept-Ranges': 'bytes'}
+    use_gzip = request.args.get('gzip') == 'true' and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+    if use_gzip:
+        # Ranges apply to the encoded bytes, we only serve them for the identity encoding.
+        headers.update({
+            'Content-Encoding': 'gzip',
+            'Content-Length': str(gzip_size(dataset.rows, dataset.seed, request.args.get('columns', DEFAULT_COLUMNS))),
+            'Accept-Ranges': 'none',
+        })
+
+        return Response(dataset.iter_gzip(), status=200, headers=headers)
+
+    if request.headers.get('Range'):
+        byte_range = parse_range(request.headers['Range'], dataset.size)
+
+        if not byte_range:
+            return Response(status=416, headers={'Content-Range': f'bytes */{dataset.size}'})
+
+        start, end = byte_range
+        headers.update({'Content-Length': str(end - start + 1), 'Content-Range': f'bytes {start}-{end}/{dataset.size}'})
+
+        return Response(dataset.iter_bytes(start, end), status=206, headers=headers)
+
+    headers['Content-Length'] = str(dataset.size)
+
+    return Response(dataset.iter_bytes(), status=200, headers=headers)
+
+
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0', port=5006, threaded=True)
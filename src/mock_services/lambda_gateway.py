@@ -1,5 +1,12 @@
 import json
+import logging
+import multiprocessing
 import os
+import resource
+import threading
+import time
+import traceback
+import uuid
 
 from datetime import datetime
 from importlib import import_module
@@ -15,6 +22,15 @@ app = Flask(__name__)
 
 
 TIMEOUT = os.environ.get('LAMBDA_TIMEOUT')
+MEMORY_SIZE = os.environ.get('LAMBDA_MEMORY_SIZE')
+CONCURRENCY = int(os.environ.get('LAMBDA_CONCURRENCY', 4))
+
+# Every invocation runs in a fresh process, like a cold start. Spawn instead of fork since Flask serves requests
+# on threads and forking a threaded process can copy locks held by other threads.
+mp_context = multiprocessing.get_context('spawn')
+concurrency_slots = threading.BoundedSemaphore(CONCURRENCY)
+# Results of asynchronous invocations by request id, see /invocations/<request_id>.
+invocations = {}
 
 
 class LambdaContext:
@@ -22,14 +38,130 @@ class LambdaContext:
     A mock lambda context instance. See link for full capabilities in a lambda.
     https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
     """
-    def __init__(self):
-        print(os.environ.get('LAMBDA_TIMEOUT'))
+    def __init__(self, timeout=None, memory_limit_in_mb=None, function_name='fake_function_name', aws_request_id=None):
         self.start = datetime.now()
-        self.timeout = int(TIMEOUT) if TIMEOUT else (1 * 60 * 1000)
-        self.function_name = 'fake_function_name'
+        self.timeout = timeout or (int(TIMEOUT) if TIMEOUT else (1 * 60 * 1000))
+        self.function_name = function_name
+        self.memory_limit_in_mb = memory_limit_in_mb or (int(MEMORY_SIZE) if MEMORY_SIZE else 128)
+        self.aws_request_id = aws_request_id or str(uuid.uuid4())
 
     def get_remaining_time_in_millis(self):
-        return self.timeout - ((datetime.now() - self.start).seconds * 1000)
+        return self.timeout - int((datetime.now() - self.start).total_seconds() * 1000)
+
+
+def run_handler(conn, name, event, timeout, memory_limit_in_mb, request_id):
+    """
+    Entry point of the invocation subprocess. Sends the handler result and resource usage back over the pipe.
+    """
+    context = LambdaContext(timeout, memory_limit_in_mb, name, request_id)
+    result = {'status': None, 'error': None}
+
+    try:
+        lambda_module = import_module(f'lambdas.lambda_handlers.{name}')
+        result['status'] = lambda_module.lambda_handler(event, context)
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result['cpu_time_ms'] = round((usage.ru_utime + usage.ru_stime) * 1000, 2)
+    # ru_maxrss is in kilobytes on linux
+    result['max_memory_used_mb'] = round(usage.ru_maxrss / 1024, 2)
+
+    conn.send(result)
+    conn.close()
+
+
+def read_rss_mb(pid):
+    """
+    Current and peak resident set size of a process from /proc. Returns (0, 0) once the process is gone.
+    """
+    values = {}
+
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, val = line.split(':')
+                    values[key] = int(val.split()[0]) / 1024
+    except OSError:
+        pass
+
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+
+def invoke(name, event, timeout, memory_limit_in_mb, request_id):
+    """
+    Run a handler in a subprocess and enforce the timeout and memory limit from outside of it the way Lambda does.
+    The memory limit is checked against the resident set size every 50ms.
+    """
+    parent_conn, child_conn = mp_context.Pipe(duplex=False)
+    process = mp_context.Process(target=run_handler, args=(child_conn, name, event, timeout, memory_limit_in_mb, request_id))
+
+    start = time.monotonic()
+    process.start()
+    child_conn.close()
+
+    result = None
+    peak_rss = 0
+    deadline = start + timeout / 1000
+
+    while result is None:
+        if parent_conn.poll(0.05):
+            try:
+                result = parent_conn.recv()
+            except EOFError:
+                process.join()
+                result = {'status': None, 'error': f'Process exited with code {process.exitcode} before returning.'}
+            break
+
+        rss, hwm = read_rss_mb(process.pid)
+        peak_rss = max(peak_rss, hwm)
+
+        if rss > memory_limit_in_mb:
+            process.kill()
+            result = {'status': None, 'error': f'Runtime exited with error: memory limit of {memory_limit_in_mb} MB exceeded.'}
+        elif time.monotonic() > deadline:
+            process.kill()
+            result = {'status': None, 'error': f'Task timed out after {timeout / 1000:.2f} seconds'}
+        elif not process.is_alive() and not parent_conn.poll():
+            process.join()
+            result = {'status': None, 'error': f'Process exited with code {process.exitcode} before returning.'}
+
+    duration = (time.monotonic() - start) * 1000
+    process.join()
+
+    report = {
+        'request_id': request_id,
+        'duration_ms': round(duration, 2),
+        'billed_duration_ms': int(-(-duration // 1)),
+        'memory_size_mb': memory_limit_in_mb,
+        'max_memory_used_mb': result.get('max_memory_used_mb', round(peak_rss, 2)),
+        'cpu_time_ms': result.get('cpu_time_ms'),
+    }
+
+    print(f"REPORT RequestId: {request_id} Duration: {report['duration_ms']} ms Billed Duration: {report['billed_duration_ms']} ms "
+          f"Memory Size: {memory_limit_in_mb} MB Max Memory Used: {report['max_memory_used_mb']} MB CPU Time: {report['cpu_time_ms']} ms")
+
+    if result['error']:
+        logging.error(result['error'])
+
+    return result, report
+
+
+def format_result(result, report):
+    lambda_status = result['status'] if isinstance(result['status'], dict) else {}
+
+    return {
+        'status': lambda_status.get('statusCode'),
+        'message': lambda_status.get('body', result['error']),
+        'report': report,
+    }
+
+
+def invoke_async(name, event, timeout, memory_limit_in_mb, request_id):
+    # Lambda queues async events instead of throttling them, so wait for a free slot.
+    with concurrency_slots:
+        invocations[request_id] = format_result(*invoke(name, event, timeout, memory_limit_in_mb, request_id))
 
 
 @app.route('/health')
@@ -40,17 +172,84 @@ def health_check():
 
 @app.route("/lambda/<name>", methods=["POST"])
 def mock_lambda(name):
+    """
+    Invoke a handler the way API Gateway does. Send 'X-Amz-Invocation-Type: Event' to invoke it asynchronously, the
+    gateway returns a 202 right away and the result can be fetched from /invocations/<request_id>. The
+    'X-Lambda-Timeout' (ms) and 'X-Lambda-Memory-Size' (MB) headers override LAMBDA_TIMEOUT and LAMBDA_MEMORY_SIZE
+    for a single invocation.
+    """
     print(f'Testing lambda: {name}')
     # NOTE - actual lambda gateway does NOT parse json body for us
     req = request.json
-    context = LambdaContext()
     event = {'body': json.dumps(req)}
 
-    lambda_module = import_module(f'lambdas.lambda_handlers.{name}')
-    lambda_status = lambda_module.lambda_handler(event, context)
+    response, status_code = dispatch(name, event)
+
+    if status_code == 202:
+        return jsonify(request_id=response, status=202), 202
+    if status_code == 429:
+        return jsonify(Type='TooManyRequestsException', message='Rate Exceeded.', status=429), 429
+
+    return jsonify(**format_result(*response)), 200
+
+
+@app.route("/2015-03-31/functions/<name>/invocations", methods=["POST"])
+def invoke_api(name):
+    """
+    The Lambda Invoke API so boto3 can call the gateway, ie a handler invoking itself asynchronously with
+    boto3.client('lambda', endpoint_url='http://localhost:5555'). The body is the event as is.
+    """
+    print(f'Invoking lambda: {name}')
+    event = json.loads(request.get_data() or b'{}')
+
+    response, status_code = dispatch(name, event)
+
+    if status_code == 202:
+        return '', 202, {'X-Amzn-RequestId': response}
+    if status_code == 429:
+        return jsonify(Type='User', message='Rate Exceeded.'), 429, {'X-Amzn-ErrorType': 'TooManyRequestsException'}
+
+    result, report = response
+    headers = {'X-Amzn-RequestId': report['request_id']}
+
+    if result['error']:
+        headers['X-Amz-Function-Error'] = 'Unhandled'
+        return jsonify(errorMessage=result['error']), 200, headers
+
+    return json.dumps(result['status']), 200, dict(headers, **{'Content-Type': 'application/json'})
+
+
+def dispatch(name, event):
+    """
+    Run an invocation with the limits from the request headers. Returns (request id, 202) for an asynchronous
+    invocation, (None, 429) when every concurrency slot is taken or ((result, report), 200).
+    """
+    request_id = str(uuid.uuid4())
+    timeout = int(request.headers.get('X-Lambda-Timeout', TIMEOUT or 1 * 60 * 1000))
+    memory_limit_in_mb = int(request.headers.get('X-Lambda-Memory-Size', MEMORY_SIZE or 128))
+
+    if request.headers.get('X-Amz-Invocation-Type') == 'Event':
+        invocations[request_id] = {'status': None, 'message': 'Invocation is running', 'report': None}
+        threading.Thread(target=invoke_async, args=(name, event, timeout, memory_limit_in_mb, request_id), daemon=True).start()
+
+        return request_id, 202
+
+    if not concurrency_slots.acquire(blocking=False):
+        return None, 429
+
+    try:
+        return invoke(name, event, timeout, memory_limit_in_mb, request_id), 200
+    finally:
+        concurrency_slots.release()
+
+
+@app.route("/invocations/<request_id>", methods=["GET"])
+def get_invocation(request_id):
+    if request_id not in invocations:
+        return jsonify(message=f"Unknown request id {request_id}", status=404), 404
 
-    return jsonify(status=lambda_status.get('statusCode'), message=lambda_status['body']), 200
+    return jsonify(invocations[request_id]), 200
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5555)
+    app.run(debug=True, host='0.0.0.0', port=5555, threaded=True)
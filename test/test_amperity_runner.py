@@ -1,10 +1,12 @@
 import json
+import time
 import unittest.mock
 
 import pytest
 import requests
 
-from lambdas.amperity_runner import AmperityRunner, AmperityAPIRunner, AmperityBotoRunner
+from lambdas.amperity_runner import AmperityRunner, AmperityAPIRunner, AmperityBotoRunner, AmperityFanOutRunner
+from lambdas.checkpoints import LocalCheckpointStore, make_checkpoint
 from mock_services.lambda_gateway import LambdaContext
 
 
@@ -85,6 +87,17 @@ class TestAmperityRunner:
         assert mock_callback.last_request.text == expected_poll_status
         assert result == expected_result
 
+    def test_reports_download_timeout(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', exc=requests.exceptions.ConnectTimeout('Connect timed out.'))
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+
+        test_runner = AmperityRunner(mock_event, mock_context, 'test-tenant')
+        result = test_runner.run()
+
+        assert result['statusCode'] == 500
+        assert mock_callback.last_request.json()['state'] == 'failed'
+        assert mock_callback.last_request.json()['errors'] == ['Connect timed out.']
+
     def test_report_status_retries(self, requests_mock):
         requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
         mock_callback = requests_mock.put('https://fake-callback.example/fake123', status_code=502)
@@ -142,6 +155,67 @@ class TestAmperityRunner:
     def test_lambda_timeout(self):
         pass
 
+    def test_unknown_profile_mode_runs_unprofiled(self, tmp_path, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            dict(mock_event, settings={'profile': 'cprofiel'}),
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+        )
+
+        with unittest.mock.patch('lambdas.profiling.PROFILE_DIR', str(tmp_path)):
+            result = test_runner.run()
+
+        assert result['statusCode'] == 200
+        assert test_runner.profile_mode is None
+        assert list(tmp_path.iterdir()) == []
+
+    def test_profile_named_after_request_without_webhook_id(self, tmp_path, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/')
+        requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            dict(mock_event, webhook_id='', settings={'profile': 'cprofile'}),
+            LambdaContext(aws_request_id='req-1'),
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+        )
+
+        with unittest.mock.patch('lambdas.profiling.PROFILE_DIR', str(tmp_path)):
+            test_runner.run()
+
+        assert [path.name for path in tmp_path.iterdir()] == ['req-1.prof']
+
+    @pytest.mark.parametrize('mode, extension', [('cprofile', 'prof'), ('sample', 'collapsed')])
+    def test_profiles_run_when_enabled(self, mode, extension, tmp_path, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            dict(mock_event, settings={'profile': mode}),
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+        )
+
+        expected_result = {"statusCode": 200, "body": json.dumps({"status": "succeeded", "message": []})}
+
+        with unittest.mock.patch('lambdas.profiling.PROFILE_DIR', str(tmp_path)):
+            result = test_runner.run()
+
+        assert mock_destination.call_count == 1
+        assert result == expected_result
+        assert (tmp_path / f'fake123.{extension}').exists()
+
 
 class TestAmperityAPIRunner:
     @unittest.mock.patch('lambdas.helpers.sleep')
@@ -169,6 +243,29 @@ class TestAmperityAPIRunner:
         assert sleep_mock.call_count == 1
         assert result == expected_result
 
+    @unittest.mock.patch('lambdas.helpers.sleep')
+    def test_rate_limit_shared_by_concurrent_requests(self, sleep_mock, requests_mock):
+        rows = ''.join(json.dumps({'col1': f'val{i}'}) + '\n' for i in range(10))
+        requests_mock.get('https://fake-data.example/', text=rows, headers={'Content-Length': str(len(rows))})
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            batch_size=1,
+            req_per_min=3,
+            max_concurrency=4,
+        )
+        test_runner.run()
+
+        # One sleep per 3 requests whichever thread sends them.
+        assert mock_destination.call_count == 10
+        assert sleep_mock.call_count == 3
+
     def test_custom_mapping(self, requests_mock):
         mock_data = requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
         mock_callback = requests_mock.put('https://fake-callback.example/fake123')
@@ -275,7 +372,7 @@ class TestAmperityAPIRunner:
 
         expected_result = {
             'statusCode': 200,
-            'body': '{"status": "succeeded", "message": []}'}
+            'body': '{"status": "succeeded", "message": ["{\\"status\\":400, \\"message\\":\\"error message\\"}"]}'}
         result = test_runner.run()
 
         assert mock_data.call_count == 1
@@ -285,6 +382,289 @@ class TestAmperityAPIRunner:
         assert mock_destination.last_request.text == expected_request
         assert result == expected_result
 
+    def test_aggregates_repeated_errors(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        requests_mock.post(destination_url, text='{"message":"bad request"}', status_code=400)
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            batch_size=1,
+            destination_url=destination_url,
+            destination_session=destination_sess,
+        )
+        test_runner.run()
+
+        assert [r.json()['errors'] for r in mock_callback.request_history] == [
+            [],
+            ['{"message":"bad request"}'],
+            ['2x HTTP 400: {"message":"bad request"}'],
+        ]
+        assert test_runner.metrics['errors'] == {'total': 2, 'groups': [
+            {'kind': 'HTTP', 'status': 400, 'count': 2, 'examples': ['{"message":"bad request"}', '{"message":"bad request"}']},
+        ]}
+
+    def test_packs_requests_under_max_payload_bytes(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        single_request = json.dumps({"batch": [{"col1": "val1", "col2": "val2"}]})
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            data_key='batch',
+            max_payload_bytes=len(single_request),
+        )
+
+        test_runner.run()
+
+        assert mock_destination.call_count == 2
+        assert [r.text for r in mock_destination.request_history] == [
+            single_request,
+            json.dumps({"batch": [{"col1": "val3", "col2": "val4"}]})
+        ]
+
+    def test_packed_requests_match_unpacked_body(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            data_key='batch',
+            max_payload_bytes=4000000,
+        )
+
+        expected_request = json.dumps({"batch": [{
+            "col1": "val1",
+            "col2": "val2"
+        }, {
+            "col1": "val3",
+            "col2": "val4"
+        }]})
+
+        test_runner.run()
+
+        assert mock_destination.call_count == 1
+        assert mock_destination.last_request.text == expected_request
+
+    def test_oversized_record_is_reported(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            data_key='batch',
+            max_payload_bytes=10,
+        )
+
+        test_runner.run()
+
+        assert mock_destination.call_count == 0
+        assert 'exceeds the 10 byte request limit' in json.loads(mock_callback.last_request.text)['errors'][0]
+
+    def test_stable_message_ids(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        def sent_message_ids(**kwargs):
+            AmperityAPIRunner(
+                mock_event,
+                mock_context,
+                'test-tenant',
+                destination_url=destination_url,
+                destination_session=destination_sess,
+                data_key='batch',
+                message_id_key='messageId',
+                **kwargs
+            ).run()
+
+            return [rec['messageId'] for r in mock_destination.request_history for rec in r.json()['batch']]
+
+        first_run = sent_message_ids()
+        mock_destination.reset()
+        retried_run = sent_message_ids(batch_size=1, batch_offset=1)
+
+        assert len(set(first_run)) == 2
+        assert retried_run == first_run[1:]
+
+    def test_concurrent_requests(self, tmp_path, requests_mock):
+        rows = [{'row': i} for i in range(40)]
+        ndjson = '\n'.join(json.dumps(row) for row in rows)
+        store = LocalCheckpointStore(str(tmp_path))
+        requests_mock.get('https://fake-data.example/', text=ndjson, headers={'Content-Length': str(len(ndjson))})
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            batch_size=2,
+            checkpoint_store=store,
+            max_concurrency=4,
+        )
+        result = test_runner.run()
+
+        sent = sorted((row for r in mock_destination.request_history for row in r.json()), key=lambda row: row['row'])
+        assert sent == rows
+        assert json.loads(result['body'])['status'] == 'succeeded'
+        assert store.load('fake123')['rows'] == 40
+        assert 1 <= test_runner.metrics['concurrency']['peak'] <= 4
+
+    def test_concurrency_backs_off_on_throttling(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        requests_mock.post(destination_url, status_code=429, text='Too Many Requests')
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            batch_size=1,
+            max_concurrency=4,
+        )
+        test_runner.concurrency.limit = 4.0
+        test_runner.run()
+
+        assert test_runner.metrics['concurrency']['decreases'] >= 1
+        assert test_runner.metrics['concurrency']['decisions'][0]['reason'] == 'status 429'
+        assert len(test_runner.errors) == 2
+
+    def test_destination_timeouts_are_reported(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        requests_mock.post(destination_url, exc=requests.exceptions.ReadTimeout('Read timed out.'))
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            batch_size=1,
+        )
+        test_runner.run()
+
+        assert mock_callback.last_request.json()['errors'] == ['2x Timeout: Read timed out.']
+
+    def test_hedges_slow_requests(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        calls = []
+
+        def respond(request, context):
+            calls.append(request.body)
+            # The first request stalls past the p95 so a duplicate is sent.
+            if len(calls) == 1:
+                time.sleep(0.5)
+            return '{"status":200}'
+
+        requests_mock.post(destination_url, text=respond)
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            batch_size=2,
+            hedge=True,
+        )
+        for _ in range(20):
+            test_runner.latencies.add(0.01)
+        test_runner.run()
+
+        assert len(calls) == 2 and calls[0] == calls[1]
+        assert test_runner.metrics['hedging']['sent'] == 1
+        # Status updates are never hedged.
+        assert [r.json()['state'] for r in mock_callback.request_history] == ['running', 'succeeded']
+        assert len(test_runner.latencies.latencies) == 21
+        assert test_runner.metrics['hedging']['p95_ms'] == 10.0
+
+    @pytest.mark.parametrize('stream_body', ['chunked', 'sized'])
+    def test_streamed_body_matches_in_memory_body(self, stream_body, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            {**mock_event, 'settings': {'stream_body': stream_body}},
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            data_key='data',
+        )
+        test_runner.run()
+
+        assert b''.join(mock_destination.last_request.body) == json.dumps({'data': [
+            {'col1': 'val1', 'col2': 'val2'}, {'col1': 'val3', 'col2': 'val4'},
+        ]}).encode('utf-8')
+
+    def test_partitioned_lanes_keep_order_per_key(self, tmp_path, requests_mock):
+        rows = [{'user': f'u{i % 5}', 'seq': i} for i in range(60)]
+        ndjson = '\n'.join(json.dumps(row) for row in rows)
+        store = LocalCheckpointStore(str(tmp_path))
+        requests_mock.get('https://fake-data.example/', text=ndjson, headers={'Content-Length': str(len(ndjson))})
+        requests_mock.put('https://fake-callback.example/fake123')
+        received = []
+
+        def respond(request, context):
+            time.sleep(0.005)
+            received.extend(request.json())
+            return '{"status":200}'
+
+        requests_mock.post(destination_url, text=respond)
+
+        test_runner = AmperityAPIRunner(
+            {**mock_event, 'settings': {'partition_key': 'user', 'lanes': 3}},
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            batch_size=10,
+            checkpoint_store=store,
+        )
+        test_runner.run()
+
+        assert sorted(received, key=lambda row: row['seq']) == rows
+        for user in {row['user'] for row in rows}:
+            seqs = [row['seq'] for row in received if row['user'] == user]
+            assert seqs == sorted(seqs)
+        assert store.load('fake123')['rows'] == 60
+
+    def test_hedge_is_rejected_with_lanes(self):
+        with pytest.raises(ValueError, match='partition_key'):
+            AmperityAPIRunner(
+                {**mock_event, 'settings': {'partition_key': 'user', 'hedge': True}},
+                mock_context,
+                'test-tenant',
+                destination_url=destination_url,
+                destination_session=destination_sess,
+            )
+
 
 class TestAmperityBotoRunner:
     def test_boto_runner_raises_init_exception(self):
@@ -312,3 +692,85 @@ class TestAmperityBotoRunner:
             boto_runner.run()
 
         assert e.type is NotImplementedError
+
+
+class TestAmperityFanOutRunner:
+    def make_sink(self, url, **kwargs):
+        return AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            destination_url=url,
+            destination_session=requests.Session(),
+            **kwargs
+        )
+
+    def test_sends_every_batch_to_every_sink(self, requests_mock):
+        mock_data = requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        mock_first = requests_mock.post('https://first.example/', text='{"status":200}')
+        mock_second = requests_mock.post('https://second.example/', text='{"status":200}')
+
+        test_runner = AmperityFanOutRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            sinks={
+                'first': self.make_sink('https://first.example/'),
+                'second': self.make_sink('https://second.example/', batch_size=1, data_key='data'),
+            },
+        )
+        result = test_runner.run()
+
+        assert result['statusCode'] == 200
+        assert mock_data.call_count == 1
+        assert mock_callback.last_request.json()['state'] == 'succeeded'
+        assert [r.json() for r in mock_first.request_history] == [[{'col1': 'val1', 'col2': 'val2'}, {'col1': 'val3', 'col2': 'val4'}]]
+        assert [r.json() for r in mock_second.request_history] == [
+            {'data': [{'col1': 'val1', 'col2': 'val2'}]},
+            {'data': [{'col1': 'val3', 'col2': 'val4'}]},
+        ]
+        assert test_runner.sink_offsets == {'first': 2, 'second': 2}
+
+    def test_failed_sink_does_not_stop_others(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        mock_first = requests_mock.post('https://first.example/', text='{"status":200}')
+
+        test_runner = AmperityFanOutRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            sinks={
+                'first': self.make_sink('https://first.example/', batch_size=1),
+                'boto': AmperityBotoRunner(mock_event, mock_context, 'test-tenant', boto_client='fake-boto-client'),
+            },
+        )
+        result = test_runner.run()
+
+        assert result['statusCode'] == 500
+        assert mock_first.call_count == 2
+        assert mock_callback.last_request.json()['state'] == 'failed'
+        assert mock_callback.last_request.json()['reason'].startswith('boto failed')
+
+    def test_resumes_each_sink_from_its_offset(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        store.save('fake123', make_checkpoint(0, sinks={'first': 1, 'second': 0}))
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_first = requests_mock.post('https://first.example/', text='{"status":200}')
+        mock_second = requests_mock.post('https://second.example/', text='{"status":200}')
+
+        test_runner = AmperityFanOutRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            checkpoint_store=store,
+            sinks={'first': self.make_sink('https://first.example/'), 'second': self.make_sink('https://second.example/')},
+        )
+        test_runner.run()
+
+        assert [r.json() for r in mock_first.request_history] == [[{'col1': 'val3', 'col2': 'val4'}]]
+        assert len(mock_second.last_request.json()) == 2
+        assert store.load('fake123')['sinks'] == {'first': 2, 'second': 2}
+        assert store.load('fake123')['state'] == 'succeeded'
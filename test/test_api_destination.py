@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from mock_services import api_destination
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(api_destination, 'PROFILES', dict(api_destination.PROFILES))
+    monkeypatch.setattr(api_destination, 'buckets', {})
+    api_destination.stats.reset()
+
+    return api_destination.app.test_client()
+
+
+def put_profile(client, name, profile):
+    assert client.put(f'/mock/profiles/{name}', json=profile).status_code == 200
+
+
+class TestProfiles:
+    def test_fast_profile_counts_records(self, client):
+        resp = client.post('/mock/profile/fast', json={'batch': [{'id': 1}, {'id': 2}]})
+
+        assert resp.status_code == 200
+        assert resp.get_json()['message'] == 'Recieved request with 2 records.'
+
+    def test_unknown_profile(self, client):
+        assert client.post('/mock/profile/missing', json=[]).status_code == 404
+
+    def test_rejects_large_bodies(self, client):
+        put_profile(client, 'small', {'max_body_bytes': 20})
+
+        assert client.post('/mock/profile/small', json=[{'id': 1}]).status_code == 200
+        assert client.post('/mock/profile/small', json=[{'id': i} for i in range(10)]).status_code == 413
+
+    def test_quota_throttles_past_the_burst(self, client):
+        put_profile(client, 'quota', {'quota': {'rate': 0.1, 'burst': 2}})
+        headers = {'Authorization': 'Bearer key-1'}
+
+        statuses = [client.post('/mock/profile/quota', json=[], headers=headers).status_code for _ in range(3)]
+        throttled = client.post('/mock/profile/quota', json=[], headers=headers)
+
+        assert statuses == [200, 200, 429]
+        assert int(throttled.headers['Retry-After']) >= 1
+        # Every api key has its own bucket.
+        assert client.post('/mock/profile/quota', json=[], headers={'Authorization': 'Bearer key-2'}).status_code == 200
+
+    def test_updating_a_profile_resets_its_quota(self, client):
+        put_profile(client, 'quota', {'quota': {'rate': 0.1, 'burst': 1}})
+        client.post('/mock/profile/quota', json=[])
+        assert client.post('/mock/profile/quota', json=[]).status_code == 429
+
+        put_profile(client, 'quota', {'quota': {'rate': 0.1, 'burst': 1}})
+
+        assert client.post('/mock/profile/quota', json=[]).status_code == 200
+
+    def test_error_rates(self, client):
+        put_profile(client, 'down', {'error_rates': {'503': 1.0}, 'retry_after': 3})
+
+        resp = client.post('/mock/profile/down', json=[])
+
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '3'
+
+    def test_latency(self, client, monkeypatch):
+        slept = []
+        monkeypatch.setattr(api_destination.time, 'sleep', slept.append)
+        put_profile(client, 'slow', {'latency_ms': {'median': 100, 'p99': 100}})
+
+        client.post('/mock/profile/slow', json=[])
+
+        assert slept == [pytest.approx(0.1)]
+
+
+class TestStats:
+    def test_counts_requests_records_and_status_codes(self, client):
+        put_profile(client, 'small', {'max_body_bytes': 20})
+        client.post('/mock/profile/fast', json={'batch': [{'id': 1}, {'id': 2}, {'id': 3}]})
+        client.post('/mock/destination', json=[{'id': 1}])
+        client.post('/mock/profile/small', json=[{'id': i} for i in range(10)])
+
+        summary = client.get('/stats').get_json()
+
+        # The PUT of the profile counts as a request, /stats itself doesn't.
+        assert summary['requests'] == 4
+        assert summary['records'] == 4
+        assert summary['status_codes'] == {'200': 3, '413': 1}
+        assert summary['in_flight'] == 0
+        assert summary['max_in_flight'] == 1
+
+    def test_delete_resets(self, client):
+        client.post('/mock/destination', data=json.dumps([{'id': 1}]), content_type='application/json')
+
+        assert client.delete('/stats').get_json()['requests'] == 0
+        assert client.get('/stats').get_json()['records'] == 0
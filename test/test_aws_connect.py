@@ -0,0 +1,179 @@
+import threading
+
+from collections import OrderedDict
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from lambdas.lambda_handlers import aws_connect
+from lambdas.lambda_handlers.aws_connect import CONTENT_HASH_ATTRIBUTE, AmperityConnectRunner
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+upsert_event = dict(mock_event, settings={'write_mode': 'upsert'})
+mock_context = LambdaContext()
+mock_rows = [{'AccountNumber': f'acct{i}', 'FirstName': f'name{i}', 'city': 'Seattle'} for i in range(10)]
+
+
+@pytest.fixture(autouse=True)
+def profile_index(monkeypatch):
+    monkeypatch.setattr(aws_connect, 'PROFILE_INDEX', OrderedDict())
+    monkeypatch.setattr(aws_connect, 'sleep', lambda seconds: None)
+
+
+class FakeCustomerProfiles:
+    """
+    Stands in for the customer-profiles client, profiles are kept by ProfileId. The first `throttle` create calls
+    raise a ThrottlingException. With a runner each call records the concurrency of the window it was sent in.
+    """
+    def __init__(self, throttle=0):
+        self.throttle = throttle
+        self.runner = None
+        self.profiles = {}
+        self.calls = []
+        self.concurrency = []
+        self.lock = threading.Lock()
+
+    def call(self, name):
+        with self.lock:
+            self.calls.append(name)
+
+            if self.runner:
+                self.concurrency.append(self.runner.concurrency)
+
+            return len(self.calls)
+
+    def create_profile(self, DomainName, PartyType, **profile):
+        if self.call('create') <= self.throttle:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'CreateProfile')
+
+        with self.lock:
+            profile_id = f'profile{len(self.profiles)}'
+            self.profiles[profile_id] = profile
+
+        return {'ProfileId': profile_id}
+
+    def update_profile(self, DomainName, ProfileId, PartyType, **profile):
+        self.call('update')
+        self.profiles[ProfileId] = profile
+
+    def search_profiles(self, DomainName, KeyName, Values, MaxResults):
+        self.call('search')
+        items = [
+            {'ProfileId': profile_id, 'Attributes': profile.get('Attributes', {})}
+            for profile_id, profile in self.profiles.items() if profile.get('AccountNumber') == Values[0]
+        ]
+
+        return {'Items': items[:MaxResults]}
+
+
+class TestConnectRunner:
+    def test_throttling_halves_concurrency_and_recovers_by_one(self):
+        client = FakeCustomerProfiles(throttle=4)
+        runner = AmperityConnectRunner(mock_event, mock_context, 'test-tenant', boto_client=client, max_workers=4)
+        client.runner = runner
+
+        runner.runner_logic(mock_rows)
+
+        # The first window of 4 is throttled, the retries go out 2 at a time and each clean window adds one.
+        assert client.concurrency == [4] * 4 + [2] * 2 + [3] * 3 + [4] * 5
+        assert sorted(profile['AccountNumber'] for profile in client.profiles.values()) == sorted(row['AccountNumber'] for row in mock_rows)
+        assert runner.records_seen == 10
+        assert len(runner.errors) == 0
+
+    def test_gives_up_after_max_throttle_retries(self, monkeypatch):
+        monkeypatch.setattr(aws_connect, 'CONNECT_MAX_THROTTLE_RETRIES', 2)
+        client = FakeCustomerProfiles(throttle=100)
+        runner = AmperityConnectRunner(mock_event, mock_context, 'test-tenant', boto_client=client, max_workers=1)
+
+        runner.runner_logic(mock_rows[:1])
+
+        assert client.calls == ['create'] * 3
+        assert runner.records_seen == 1
+        assert 'ThrottlingException' in runner.errors.report()[0]
+
+    def test_upsert_skips_unchanged_profiles(self):
+        client = FakeCustomerProfiles()
+        runner = AmperityConnectRunner(upsert_event, mock_context, 'test-tenant', boto_client=client)
+
+        runner.runner_logic(mock_rows)
+        assert client.calls.count('create') == 10
+
+        # Same records again: every one is found in the index with the same hash.
+        client.calls = []
+        runner.runner_logic(mock_rows)
+
+        assert client.calls == []
+        assert runner.records_skipped == 10
+
+    def test_upsert_updates_changed_profiles_found_by_search(self, monkeypatch):
+        client = FakeCustomerProfiles()
+        runner = AmperityConnectRunner(upsert_event, mock_context, 'test-tenant', boto_client=client, max_workers=1)
+        runner.runner_logic(mock_rows)
+
+        # A cold container has to search, the stored hash still tells unchanged profiles apart.
+        monkeypatch.setattr(aws_connect, 'PROFILE_INDEX', OrderedDict())
+        client.calls = []
+        changed = [dict(row, FirstName='changed') if i == 3 else row for i, row in enumerate(mock_rows)]
+        runner.runner_logic(changed)
+
+        assert client.calls.count('search') == 10
+        assert client.calls.count('update') == 1
+        assert client.calls.count('create') == 0
+        assert runner.records_skipped == 9
+        assert client.profiles['profile3']['FirstName'] == 'changed'
+        assert client.profiles['profile3']['Attributes'][CONTENT_HASH_ATTRIBUTE] == aws_connect.content_hash(
+            aws_connect.format_profile(changed[3]))
+
+    def test_upsert_collapses_repeated_keys(self):
+        client = FakeCustomerProfiles()
+        runner = AmperityConnectRunner(upsert_event, mock_context, 'test-tenant', boto_client=client)
+        rows = [
+            {'AccountNumber': 'acct1', 'FirstName': 'first'},
+            {'AccountNumber': 'acct2', 'FirstName': 'other'},
+            {'AccountNumber': 'acct1', 'FirstName': 'last'},
+            {'FirstName': 'no key'},
+        ]
+
+        runner.runner_logic(rows)
+
+        assert sorted((p['AccountNumber'], p['FirstName']) for p in client.profiles.values()) == [('acct1', 'last'), ('acct2', 'other')]
+        # The profile without a key is reported instead of dropped.
+        assert len(runner.errors) == 1
+
+
+class TestProfileIndex:
+    def test_evicts_least_recently_used(self, monkeypatch):
+        monkeypatch.setattr(aws_connect, 'CONNECT_PROFILE_INDEX_SIZE', 2)
+
+        aws_connect.index_put('a', 'profile-a', 'hash-a')
+        aws_connect.index_put('b', 'profile-b', 'hash-b')
+        assert aws_connect.index_get('a') == ('profile-a', 'hash-a')
+
+        aws_connect.index_put('c', 'profile-c', 'hash-c')
+
+        assert aws_connect.index_get('b') is None
+        assert list(aws_connect.PROFILE_INDEX) == ['a', 'c']
+
+    def test_evicted_profiles_are_searched_again(self, monkeypatch):
+        monkeypatch.setattr(aws_connect, 'CONNECT_PROFILE_INDEX_SIZE', 5)
+        client = FakeCustomerProfiles()
+        runner = AmperityConnectRunner(upsert_event, mock_context, 'test-tenant', boto_client=client, max_workers=1)
+
+        runner.runner_logic(mock_rows)
+        client.calls = []
+
+        # Only the last 5 keys are still indexed, the others are found by search and skipped as unchanged.
+        runner.runner_logic(mock_rows[5:])
+        assert client.calls == []
+
+        runner.runner_logic(mock_rows[:5])
+        assert client.calls == ['search'] * 5
+        assert runner.records_skipped == 10
+        assert len(aws_connect.PROFILE_INDEX) == 5
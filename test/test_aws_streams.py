@@ -0,0 +1,222 @@
+import json
+
+import boto3
+import pytest
+
+from moto import mock_aws
+
+from lambdas import aws_streams
+from lambdas.aws_streams import AmperityFirehoseRunner, AmperityKinesisRunner, AmperitySQSRunner
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+mock_context = LambdaContext()
+mock_rows = [{'amperity_id': f'id{i % 3}', 'email': f'user{i}@example.com'} for i in range(25)]
+mock_ndjson = ''.join(json.dumps(row) + '\n' for row in mock_rows)
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(aws_streams, 'STREAM_BACKOFF_SECONDS', 0)
+
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def data(requests_mock):
+    requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers={'Content-Length': str(len(mock_ndjson))})
+    return requests_mock.put('https://fake-callback.example/fake123')
+
+
+class FlakyClient:
+    """
+    Wraps a moto client and counts the entries of each batch call. With a failure every other entry of the first
+    call fails the way it does on a throttled service.
+    """
+    def __init__(self, client, method, failure, response_key, count_key=None):
+        self.client = client
+        self.method = method
+        self.failure = failure
+        self.response_key = response_key
+        self.count_key = count_key
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name != self.method:
+            return getattr(self.client, name)
+
+        def call(**kwargs):
+            entries = kwargs.get('Records') or kwargs.get('Entries')
+            self.calls.append(len(entries))
+
+            if len(self.calls) > 1 or not self.failure:
+                return getattr(self.client, name)(**kwargs)
+
+            kept = dict(kwargs, **{'Records' if 'Records' in kwargs else 'Entries': entries[::2]})
+            getattr(self.client, name)(**kept)
+            results = [self.failure if i % 2 else {} for i in range(len(entries))]
+
+            if self.count_key:
+                return {self.count_key: len(entries) // 2, self.response_key: results}
+
+            return {self.response_key: [dict(f, Id=str(i)) for i, f in enumerate(results) if f]}
+
+        return call
+
+
+class TestSQSRunner:
+    def receive_all(self, sqs, queue_url):
+        bodies = []
+        while True:
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+            if not messages:
+                return bodies
+            for message in messages:
+                bodies.append(json.loads(message['Body']))
+                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+    def test_sends_in_batches_of_ten(self, aws, data):
+        sqs = boto3.client('sqs')
+        queue_url = sqs.create_queue(QueueName='amperity')['QueueUrl']
+        client = FlakyClient(sqs, 'send_message_batch', None, 'Failed')
+
+        runner = AmperitySQSRunner(mock_event, mock_context, 'test-tenant', boto_client=client, queue_url=queue_url, max_workers=1)
+        runner.run()
+
+        assert client.calls == [10, 10, 5]
+        assert sorted(self.receive_all(sqs, queue_url), key=lambda row: row['email']) == sorted(mock_rows, key=lambda row: row['email'])
+
+    def test_retries_only_failed_entries(self, aws, data):
+        sqs = boto3.client('sqs')
+        queue_url = sqs.create_queue(QueueName='amperity')['QueueUrl']
+        failure = {'SenderFault': False, 'Code': 'InternalError', 'Message': 'try again'}
+        client = FlakyClient(sqs, 'send_message_batch', failure, 'Failed')
+
+        runner = AmperitySQSRunner(mock_event, mock_context, 'test-tenant', batch_size=4, boto_client=client, queue_url=queue_url)
+        runner.runner_logic(mock_rows[:4])
+
+        assert client.calls == [4, 2]
+        assert sorted(row['email'] for row in self.receive_all(sqs, queue_url)) == sorted(row['email'] for row in mock_rows[:4])
+        assert len(runner.errors) == 0
+
+    def test_sender_faults_are_not_retried(self, aws, data):
+        sqs = boto3.client('sqs')
+        queue_url = sqs.create_queue(QueueName='amperity')['QueueUrl']
+        failure = {'SenderFault': True, 'Code': 'InvalidMessageContents', 'Message': 'bad message'}
+        client = FlakyClient(sqs, 'send_message_batch', failure, 'Failed')
+
+        runner = AmperitySQSRunner(mock_event, mock_context, 'test-tenant', boto_client=client, queue_url=queue_url)
+        runner.runner_logic(mock_rows[:4])
+
+        assert client.calls == [4]
+        assert runner.errors.report() == ['2x InvalidMessageContents: bad message']
+
+    def test_messages_of_a_group_arrive_in_order(self, aws, data):
+        sqs = boto3.client('sqs')
+        queue_url = sqs.create_queue(QueueName='amperity.fifo', Attributes={'FifoQueue': 'true'})['QueueUrl']
+        failure = {'SenderFault': False, 'Code': 'InternalError', 'Message': 'try again'}
+        client = FlakyClient(sqs, 'send_message_batch', failure, 'Failed')
+
+        runner = AmperitySQSRunner(mock_event, mock_context, 'test-tenant', boto_client=client, queue_url=queue_url,
+                                   message_group_key='amperity_id')
+        runner.run()
+
+        received = self.receive_all(sqs, queue_url)
+
+        assert len(received) == 25
+        for key in ('id0', 'id1', 'id2'):
+            assert [row for row in received if row['amperity_id'] == key] == [row for row in mock_rows if row['amperity_id'] == key]
+
+
+class TestKinesisRunner:
+    def test_retries_only_failed_entries(self, aws, data):
+        kinesis = boto3.client('kinesis')
+        kinesis.create_stream(StreamName='amperity', ShardCount=1)
+        failure = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'}
+        client = FlakyClient(kinesis, 'put_records', failure, 'Records', 'FailedRecordCount')
+
+        runner = AmperityKinesisRunner(mock_event, mock_context, 'test-tenant', boto_client=client, stream_name='amperity',
+                                       partition_key='email', max_workers=1)
+        runner.run()
+
+        records = self.get_records(kinesis)
+
+        assert client.calls == [25, 12]
+        assert sorted(json.loads(r['Data'])['email'] for r in records) == sorted(row['email'] for row in mock_rows)
+        assert {r['PartitionKey'] for r in records} == {row['email'] for row in mock_rows}
+
+    @pytest.mark.parametrize('max_workers', [1, 4])
+    def test_records_of_a_key_arrive_in_order(self, aws, data, max_workers):
+        kinesis = boto3.client('kinesis')
+        kinesis.create_stream(StreamName='amperity', ShardCount=1)
+        failure = {'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'}
+        client = FlakyClient(kinesis, 'put_records', failure, 'Records', 'FailedRecordCount')
+
+        runner = AmperityKinesisRunner(mock_event, mock_context, 'test-tenant', boto_client=client, stream_name='amperity',
+                                       partition_key='amperity_id', max_workers=max_workers)
+        runner.run()
+
+        received = [json.loads(r['Data']) for r in self.get_records(kinesis)]
+
+        assert len(received) == 25
+        for key in ('id0', 'id1', 'id2'):
+            assert [row for row in received if row['amperity_id'] == key] == [row for row in mock_rows if row['amperity_id'] == key]
+
+    def test_packs_one_record_per_key(self, aws):
+        runner = AmperityKinesisRunner(mock_event, mock_context, 'test-tenant', boto_client='fake-boto-client',
+                                       partition_key='amperity_id')
+
+        chunks = runner.pack(mock_rows[:7])
+
+        # A key's next record goes in a later chunk, never ahead of its previous one.
+        assert [[e['PartitionKey'] for e in chunk] for chunk in chunks] == [['id0', 'id1', 'id2'], ['id0', 'id1', 'id2'], ['id0']]
+        assert [json.loads(e['Data'])['email'] for chunk in chunks for e in chunk] == [row['email'] for row in mock_rows[:7]]
+
+    def get_records(self, kinesis):
+        shard_id = kinesis.describe_stream(StreamName='amperity')['StreamDescription']['Shards'][0]['ShardId']
+        iterator = kinesis.get_shard_iterator(StreamName='amperity', ShardId=shard_id, ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+
+        return kinesis.get_records(ShardIterator=iterator)['Records']
+
+    def test_packs_under_byte_limit(self, aws, monkeypatch):
+        monkeypatch.setattr(AmperityKinesisRunner, 'max_batch_bytes', 200)
+        runner = AmperityKinesisRunner(mock_event, mock_context, 'test-tenant', boto_client='fake-boto-client')
+
+        chunks = runner.pack(mock_rows[:10])
+
+        assert [len(chunk) for chunk in chunks] == [2, 2, 2, 2, 2]
+        assert all(sum(len(e['Data']) + len(e['PartitionKey']) for e in chunk) <= 200 for chunk in chunks)
+
+
+class TestFirehoseRunner:
+    def test_writes_newline_delimited_records(self, aws, data):
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket='amperity-firehose')
+        firehose = boto3.client('firehose')
+        firehose.create_delivery_stream(
+            DeliveryStreamName='amperity',
+            ExtendedS3DestinationConfiguration={
+                'RoleARN': 'arn:aws:iam::123456789012:role/firehose',
+                'BucketARN': 'arn:aws:s3:::amperity-firehose',
+            },
+        )
+        failure = {'ErrorCode': 'ServiceUnavailableException', 'ErrorMessage': 'slow down'}
+        client = FlakyClient(firehose, 'put_record_batch', failure, 'RequestResponses', 'FailedPutCount')
+
+        runner = AmperityFirehoseRunner(mock_event, mock_context, 'test-tenant', boto_client=client, delivery_stream_name='amperity')
+        runner.run()
+
+        objects = s3.list_objects_v2(Bucket='amperity-firehose')['Contents']
+        lines = b''.join(s3.get_object(Bucket='amperity-firehose', Key=o['Key'])['Body'].read() for o in objects).splitlines()
+
+        assert client.calls == [25, 12]
+        assert sorted(json.loads(line)['email'] for line in lines) == sorted(row['email'] for row in mock_rows)
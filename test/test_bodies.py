@@ -0,0 +1,33 @@
+import json
+
+import requests
+
+from lambdas.bodies import JSONArrayBody, SizedJSONArrayBody
+
+
+records = [{'email': f'user{i}@example.com', 'name': 'Zoë'} for i in range(100)]
+
+
+class TestJSONArrayBody:
+    def test_matches_json_dumps(self):
+        assert b''.join(JSONArrayBody(records)) == json.dumps(records).encode('utf-8')
+        assert b''.join(JSONArrayBody(records, 'data')) == json.dumps({'data': records}).encode('utf-8')
+        assert b''.join(JSONArrayBody([])) == b'[]'
+
+    def test_chunks_are_bounded(self):
+        chunks = list(JSONArrayBody(records, chunk_size=200))
+
+        assert len(chunks) > 10
+        assert max(len(chunk) for chunk in chunks) < 200 + len(json.dumps(records[0])) + 2
+
+    def test_iterates_again(self):
+        body = JSONArrayBody(records)
+
+        assert b''.join(body) == b''.join(body)
+
+    def test_request_headers(self):
+        chunked = requests.Request('POST', 'https://example.com/', data=JSONArrayBody(records)).prepare()
+        sized = requests.Request('POST', 'https://example.com/', data=SizedJSONArrayBody(records)).prepare()
+
+        assert chunked.headers['Transfer-Encoding'] == 'chunked'
+        assert sized.headers['Content-Length'] == str(len(json.dumps(records)))
@@ -0,0 +1,187 @@
+import gzip
+import json
+
+import pytest
+import requests
+
+from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.checkpoints import LocalCheckpointStore, get_checkpoint_store, make_checkpoint
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+mock_context = LambdaContext()
+mock_rows = [{'col1': f'val{i}'} for i in range(3)]
+mock_ndjson = ''.join(json.dumps(row) + '\n' for row in mock_rows).encode('utf-8')
+row_bytes = len(mock_ndjson) // 3
+destination_url = 'https://fake-destination.example/'
+destination_sess = requests.Session()
+
+
+def register_data(requests_mock):
+    def respond(request, context):
+        byte_range = request.headers.get('Range')
+
+        if not byte_range:
+            context.headers['Content-Length'] = str(len(mock_ndjson))
+            return mock_ndjson
+
+        start = int(byte_range.split('=')[1].rstrip('-'))
+        context.status_code = 206
+        context.headers['Content-Length'] = str(len(mock_ndjson) - start)
+
+        return mock_ndjson[start:]
+
+    return requests_mock.get('https://fake-data.example/', content=respond)
+
+
+def run_api_runner(requests_mock, store, **kwargs):
+    requests_mock.put('https://fake-callback.example/fake123')
+    mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+    test_runner = AmperityAPIRunner(
+        mock_event,
+        mock_context,
+        'test-tenant',
+        destination_url=destination_url,
+        destination_session=destination_sess,
+        checkpoint_store=store,
+        **kwargs
+    )
+    result = test_runner.run()
+
+    return result, [r.json() for r in mock_destination.request_history]
+
+
+class TestLocalCheckpointStore:
+    def test_save_and_load(self, tmp_path):
+        store = LocalCheckpointStore(str(tmp_path))
+
+        assert store.load('fake123') is None
+
+        store.save('fake123', make_checkpoint(10, 512))
+
+        assert store.load('fake123')['rows'] == 10
+        assert store.load('fake123')['bytes'] == 512
+
+    def test_get_checkpoint_store(self, tmp_path):
+        assert get_checkpoint_store(None) is None
+        assert isinstance(get_checkpoint_store(f'file://{tmp_path}'), LocalCheckpointStore)
+
+        with pytest.raises(ValueError):
+            get_checkpoint_store('ftp://somewhere/checkpoints')
+
+
+class TestRunnerCheckpoints:
+    def test_commits_each_batch(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        register_data(requests_mock)
+
+        run_api_runner(requests_mock, store, batch_size=2)
+
+        assert store.load('fake123')['rows'] == 3
+        assert store.load('fake123')['bytes'] == len(mock_ndjson)
+        assert store.load('fake123')['state'] == 'succeeded'
+
+    def test_resumes_from_byte_offset(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        store.save('fake123', make_checkpoint(1, row_bytes))
+        mock_data = register_data(requests_mock)
+
+        result, requests_sent = run_api_runner(requests_mock, store)
+
+        assert result['statusCode'] == 200
+        assert mock_data.last_request.headers['Range'] == f'bytes={row_bytes}-'
+        assert requests_sent == [mock_rows[1:]]
+        assert store.load('fake123')['rows'] == 3
+
+    def test_skips_rows_when_range_is_ignored(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        store.save('fake123', make_checkpoint(2, row_bytes * 2))
+        requests_mock.get('https://fake-data.example/', content=mock_ndjson, headers={'Content-Length': str(len(mock_ndjson))})
+
+        _, requests_sent = run_api_runner(requests_mock, store)
+
+        assert requests_sent == [mock_rows[2:]]
+
+    def test_succeeded_run_is_not_resent(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        store.save('fake123', make_checkpoint(3, len(mock_ndjson), 'succeeded'))
+        mock_data = register_data(requests_mock)
+
+        result, requests_sent = run_api_runner(requests_mock, store)
+
+        assert result['statusCode'] == 200
+        assert mock_data.call_count == 0
+        assert requests_sent == []
+
+    def test_bad_store_uri_runs_without_checkpoints(self, requests_mock):
+        register_data(requests_mock)
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            dict(mock_event, settings={'checkpoint_store': 'ftp://somewhere/checkpoints'}),
+            mock_context,
+            'test-tenant',
+            destination_url=destination_url,
+            destination_session=destination_sess,
+        )
+
+        assert test_runner.checkpoint_store is None
+        assert test_runner.run()['statusCode'] == 200
+        assert mock_destination.call_count == 1
+
+    def test_no_byte_offsets_for_gzip_responses(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        rows = [{'col1': f'val{i}'} for i in range(300)]
+        body = gzip.compress(''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8'))
+        headers = {'Content-Encoding': 'gzip', 'Content-Length': str(len(body))}
+        requests_mock.get('https://fake-data.example/', content=body, headers=headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        requests_mock.post(destination_url, text='{"status":200}')
+
+        AmperityAPIRunner(
+            dict(mock_event, settings={'read_chunk_size': 64}),
+            mock_context,
+            'test-tenant',
+            batch_size=50,
+            destination_url=destination_url,
+            destination_session=destination_sess,
+            checkpoint_store=store,
+        ).run()
+
+        progress = [r.json()['progress'] for r in mock_callback.request_history]
+
+        # Progress is measured on the encoded bytes so it stays comparable to the Content-Length.
+        assert progress == sorted(progress)
+        assert len(progress) > 3 and all(0 <= value <= 1 for value in progress)
+        assert store.load('fake123')['rows'] == 300
+        assert store.load('fake123')['bytes'] is None
+
+    def test_gzip_resume_skips_rows(self, tmp_path, requests_mock):
+        store = LocalCheckpointStore(str(tmp_path))
+        store.save('fake123', make_checkpoint(1, row_bytes))
+        body = gzip.compress(mock_ndjson)
+
+        def respond(request, context):
+            context.headers['Content-Encoding'] = 'gzip'
+
+            # A server that honours the Range on the encoded file, the rest of it isn't valid gzip.
+            if request.headers.get('Range'):
+                context.status_code = 206
+                return body[row_bytes:]
+
+            return body
+
+        mock_data = requests_mock.get('https://fake-data.example/', content=respond, headers={'Content-Length': str(len(body))})
+
+        result, requests_sent = run_api_runner(requests_mock, store)
+
+        assert result['statusCode'] == 200
+        assert 'Range' not in mock_data.last_request.headers
+        assert requests_sent == [mock_rows[1:]]
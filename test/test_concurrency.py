@@ -0,0 +1,131 @@
+import threading
+
+import pytest
+
+from lambdas import concurrency
+from lambdas.concurrency import AIMDController, OffsetTracker, partition
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(concurrency, 'time', clock)
+
+    return clock
+
+
+class TestAIMDController:
+    def test_grows_while_saturated_and_healthy(self, clock):
+        controller = AIMDController(max_limit=3)
+
+        for _ in range(10):
+            sent = [controller.acquire() for _ in range(int(controller.limit))]
+            clock.now += 0.1
+
+            for sent_at in sent:
+                controller.release(sent_at, 200)
+
+        assert controller.limit == 3
+        assert [d['to'] for d in controller.summary()['decisions']] == [2, 3]
+
+    def test_does_not_grow_when_not_saturated(self, clock):
+        controller = AIMDController(max_limit=4)
+        controller.limit = 2.0
+
+        for _ in range(10):
+            controller.release(controller.acquire(), 200)
+
+        assert controller.limit == 2
+
+    def test_cuts_once_per_round_on_throttle(self, clock):
+        controller = AIMDController(max_limit=8)
+        controller.limit = 8.0
+        sent = [controller.acquire() for _ in range(8)]
+        clock.now += 0.1
+
+        for sent_at in sent:
+            controller.release(sent_at, 429)
+
+        assert controller.limit == 4
+        assert controller.summary()['decreases'] == 1
+        assert controller.summary()['decisions'][-1]['reason'] == 'status 429'
+
+    def test_never_below_min_limit(self):
+        controller = AIMDController(max_limit=4, min_limit=2)
+
+        for status in (503, None, 429):
+            controller.release(controller.acquire(), status)
+
+        assert controller.limit == 2
+
+    def test_cuts_on_rising_latency(self, clock):
+        controller = AIMDController(max_limit=8)
+        controller.limit = 8.0
+        sent_at = controller.acquire()
+        clock.now += 0.05
+        controller.release(sent_at, 200)
+
+        # A response far slower than the fastest one seen.
+        sent_at = controller.acquire()
+        clock.now += 1
+        controller.release(sent_at, 200)
+
+        assert controller.limit == 4
+        assert controller.summary()['decisions'][-1]['reason'].startswith('latency')
+
+    def test_acquire_blocks_at_limit(self):
+        controller = AIMDController(max_limit=1)
+        sent_at = controller.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: controller.acquire() and acquired.set())
+        thread.start()
+
+        assert not acquired.wait(0.05)
+        controller.release(sent_at, 200)
+        assert acquired.wait(1)
+        thread.join()
+
+
+class TestOffsetTracker:
+    def test_commits_in_order(self):
+        tracker = OffsetTracker()
+        first = tracker.start(2)
+        tracker.end((2, 20))
+        second = tracker.start(1)
+        tracker.end((4, 40))
+
+        tracker.finish(second)
+        assert tracker.commit() is None
+
+        tracker.finish(first)
+        assert tracker.commit() is None
+        tracker.finish(first)
+        assert tracker.commit() == (4, 40)
+
+    def test_batches_without_requests(self):
+        tracker = OffsetTracker()
+        tracker.end((2, 20))
+
+        assert tracker.commit() == (2, 20)
+
+
+def test_partition_keeps_order_per_key():
+    data = [{'user': i % 3, 'seq': i} for i in range(30)] + [{'seq': 30}, {'seq': 31}]
+    lanes = dict(partition(data, 'user', 4))
+
+    for records in lanes.values():
+        assert [r['seq'] for r in records] == sorted(r['seq'] for r in records)
+
+    for user in range(3):
+        assert len({lane for lane, records in lanes.items() for r in records if r.get('user') == user}) == 1
+
+    assert sum(len(records) for records in lanes.values()) == 32
+    assert dict(partition(data, 'user', 4)) == lanes
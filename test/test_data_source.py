@@ -0,0 +1,96 @@
+import gzip
+import json
+
+import pytest
+
+from mock_services import data_source
+from mock_services.data_source import parse_range
+
+
+url = '/data/customers.ndjson?rows=2500&seed=7'
+
+
+@pytest.fixture
+def client():
+    return data_source.app.test_client()
+
+
+class TestGenerateNDJSON:
+    def test_full_file(self, client):
+        resp = client.get(url)
+        lines = resp.data.splitlines()
+
+        assert resp.status_code == 200
+        assert int(resp.headers['Content-Length']) == len(resp.data)
+        assert len(lines) == 2500
+        assert len({len(line) for line in lines}) == 1
+        assert set(json.loads(lines[0])) == {name.split(':')[0] for name in data_source.DEFAULT_COLUMNS.split(',')}
+
+    def test_same_seed_same_file(self, client):
+        assert client.get(url).data == client.get(url).data
+        assert client.get(url).data != client.get(url.replace('seed=7', 'seed=8')).data
+
+    @pytest.mark.parametrize('header, start, end', [
+        ('bytes=0-99', 0, 99),
+        # Crosses a CHUNK_ROWS boundary in the middle of a row.
+        ('bytes=1000-500000', 1000, 500000),
+        ('bytes=123456-', 123456, None),
+        ('bytes=-300', -300, None),
+    ])
+    def test_ranges(self, client, header, start, end):
+        full = client.get(url).data
+        resp = client.get(url, headers={'Range': header})
+        expected = full[start:end + 1] if end is not None else full[start:]
+
+        assert resp.status_code == 206
+        assert resp.data == expected
+        assert int(resp.headers['Content-Length']) == len(expected)
+        assert resp.headers['Content-Range'].endswith(f'/{len(full)}')
+
+    def test_unsatisfiable_range(self, client):
+        size = len(client.get(url).data)
+        resp = client.get(url, headers={'Range': f'bytes={size}-'})
+
+        assert resp.status_code == 416
+        assert resp.headers['Content-Range'] == f'bytes */{size}'
+
+    def test_gzip(self, client):
+        full = client.get(url).data
+        resp = client.get(f'{url}&gzip=true', headers={'Accept-Encoding': 'gzip'})
+
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Accept-Ranges'] == 'none'
+        assert int(resp.headers['Content-Length']) == len(resp.data)
+        assert gzip.decompress(resp.data) == full
+
+    def test_gzip_ignores_ranges(self, client):
+        resp = client.get(f'{url}&gzip=true', headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=100-'})
+
+        assert resp.status_code == 200
+        assert len(gzip.decompress(resp.data)) == len(client.get(url).data)
+
+    def test_gzip_needs_accept_encoding(self, client):
+        resp = client.get(f'{url}&gzip=true')
+
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.data == client.get(url).data
+
+    def test_unknown_column_type(self, client):
+        assert client.get('/data/x.ndjson?columns=id:nope').status_code == 400
+
+
+class TestParseRange:
+    @pytest.mark.parametrize('header, expected', [
+        ('bytes=0-9', (0, 9)),
+        ('bytes=5-', (5, 99)),
+        ('bytes=-10', (90, 99)),
+        ('bytes=-500', (0, 99)),
+        ('bytes=50-500', (50, 99)),
+        ('bytes=100-', None),
+        ('bytes=9-5', None),
+        ('bytes=-', None),
+        ('bytes=0-5,10-15', None),
+        ('items=0-5', None),
+    ])
+    def test_parse_range(self, header, expected):
+        assert parse_range(header, 100) == expected
@@ -0,0 +1,217 @@
+import importlib
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from lambdas.lambda_handlers import dataverse
+from lambdas.lambda_handlers.dataverse import AmperityDataverseRunner, format_bulk_creation, parse_batch_response
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+mock_context = LambdaContext()
+batch_url = 'https://org.api.crm.dynamics.com/api/data/v9.2/$batch'
+entity_url = 'https://org.api.crm.dynamics.com/api/data/v9.2/contacts'
+
+# Responses recorded from the Dataverse Web API. A changeset that succeeded answers every operation, one that
+# failed is rolled back and only answers the operation that failed.
+batch_boundary = 'batchresponse_c1bd45c1-dd81-470d-b897-e965846aad2f'
+succeeded_response = (
+    f'--{batch_boundary}\r\n'
+    'Content-Type: multipart/mixed; boundary=changesetresponse_ff83b4f1-ab48-430c-b81c-926a2c596abc\r\n'
+    '\r\n'
+    '--changesetresponse_ff83b4f1-ab48-430c-b81c-926a2c596abc\r\n'
+    'Content-Type: application/http\r\n'
+    'Content-Transfer-Encoding: binary\r\n'
+    'Content-ID: 0\r\n'
+    '\r\n'
+    'HTTP/1.1 204 No Content\r\n'
+    'OData-Version: 4.0\r\n'
+    'Location: https://org.api.crm.dynamics.com/api/data/v9.2/contacts(a59c24e0-e2c1-ec11-983e-002248085d3c)\r\n'
+    'OData-EntityId: https://org.api.crm.dynamics.com/api/data/v9.2/contacts(a59c24e0-e2c1-ec11-983e-002248085d3c)\r\n'
+    '\r\n'
+    '\r\n'
+    '--changesetresponse_ff83b4f1-ab48-430c-b81c-926a2c596abc\r\n'
+    'Content-Type: application/http\r\n'
+    'Content-Transfer-Encoding: binary\r\n'
+    'Content-ID: 1\r\n'
+    '\r\n'
+    'HTTP/1.1 204 No Content\r\n'
+    'OData-Version: 4.0\r\n'
+    'Location: https://org.api.crm.dynamics.com/api/data/v9.2/contacts(a69c24e0-e2c1-ec11-983e-002248085d3c)\r\n'
+    'OData-EntityId: https://org.api.crm.dynamics.com/api/data/v9.2/contacts(a69c24e0-e2c1-ec11-983e-002248085d3c)\r\n'
+    '\r\n'
+    '\r\n'
+    '--changesetresponse_ff83b4f1-ab48-430c-b81c-926a2c596abc--\r\n'
+    f'--{batch_boundary}\r\n'
+    'Content-Type: application/http\r\n'
+    'Content-Transfer-Encoding: binary\r\n'
+    '\r\n'
+    'HTTP/1.1 200 OK\r\n'
+    'Content-Type: application/json; odata.metadata=minimal; odata.streaming=true\r\n'
+    'OData-Version: 4.0\r\n'
+    '\r\n'
+    '{"@odata.context":"https://org.api.crm.dynamics.com/api/data/v9.2/$metadata#contacts(fullname)","value":[]}\r\n'
+    f'--{batch_boundary}--\r\n'
+)
+failed_response = (
+    f'--{batch_boundary}\r\n'
+    'Content-Type: multipart/mixed; boundary=changesetresponse_2a5b8e0b-b0e4-4c6c-8d8e-1b6f3e6d9f21\r\n'
+    '\r\n'
+    '--changesetresponse_2a5b8e0b-b0e4-4c6c-8d8e-1b6f3e6d9f21\r\n'
+    'Content-Type: application/http\r\n'
+    'Content-Transfer-Encoding: binary\r\n'
+    'Content-ID: 1\r\n'
+    '\r\n'
+    'HTTP/1.1 400 Bad Request\r\n'
+    'REQ_ID: 5ecd1cb3-1730-4ffc-909c-d44c22270026\r\n'
+    'Content-Type: application/json; odata.metadata=minimal\r\n'
+    'OData-Version: 4.0\r\n'
+    '\r\n'
+    '{"error":{"code":"0x80060888","message":"A record with matching key values already exists."}}\r\n'
+    '--changesetresponse_2a5b8e0b-b0e4-4c6c-8d8e-1b6f3e6d9f21--\r\n'
+    f'--{batch_boundary}--\r\n'
+)
+response_type = f'multipart/mixed; boundary={batch_boundary}'
+
+
+class TestBatchBody:
+    def test_format_bulk_creation(self):
+        data = [
+            {'firstname': 'Ada', 'lastname': 'Lovelace', 'not_a_column': 1},
+            {'not_a_column': 2},
+            {'firstname': 'Grace'},
+        ]
+
+        body = format_bulk_creation('b1', 'c1', entity_url, data, ['firstname', 'lastname'])
+
+        assert body == (
+            '--batch_b1\r\n'
+            'Content-Type: multipart/mixed;boundary=changeset_c1\r\n\r\n'
+            '--changeset_c1\r\n'
+            'Content-Type: application/http\r\n'
+            'Content-Transfer-Encoding: binary\r\n'
+            'Content-ID: 0\r\n\r\n'
+            f'POST {entity_url} HTTP/1.1\r\n'
+            'Content-Type: application/json\r\n\r\n'
+            '{"firstname":"Ada","lastname":"Lovelace"}\r\n'
+            '--changeset_c1\r\n'
+            'Content-Type: application/http\r\n'
+            'Content-Transfer-Encoding: binary\r\n'
+            'Content-ID: 2\r\n\r\n'
+            f'POST {entity_url} HTTP/1.1\r\n'
+            'Content-Type: application/json\r\n\r\n'
+            '{"firstname":"Grace"}\r\n'
+            '--changeset_c1--\r\n'
+            '--batch_b1--\r\n'
+        )
+
+    def test_prepare_caps_operations_per_batch(self):
+        runner = AmperityDataverseRunner(mock_event, mock_context, 'test-tenant', destination_url=batch_url,
+                                         destination_session=requests.Session(), entity_url=entity_url, cols=['firstname'])
+
+        prepared = runner.prepare([{'firstname': str(i)} for i in range(2500)])
+
+        assert [body.decode('utf-8').count('Content-ID:') for _, body in prepared] == [1000, 1000, 500]
+
+
+class TestBatchResponse:
+    def test_parses_changeset_and_top_level_operations(self):
+        results = parse_batch_response(response_type, succeeded_response)
+
+        assert [(content_id, status) for content_id, status, _ in results] == [('0', 204), ('1', 204), (None, 200)]
+        assert results[2][2].startswith('{"@odata.context"')
+
+    def test_parses_failed_changeset(self):
+        assert parse_batch_response(response_type, failed_response) == [
+            ('1', 400, '{"error":{"code":"0x80060888","message":"A record with matching key values already exists."}}'),
+        ]
+
+    def test_without_boundary(self):
+        assert parse_batch_response('application/json', '{}') == []
+
+    def test_failed_operations_are_reported(self, requests_mock):
+        requests_mock.post(batch_url, text=failed_response, headers={'Content-Type': response_type})
+        runner = AmperityDataverseRunner(mock_event, mock_context, 'test-tenant', destination_url=batch_url,
+                                         destination_session=requests.Session(), entity_url=entity_url, cols=['firstname'])
+
+        runner.runner_logic([{'firstname': 'Ada'}, {'firstname': 'Ada'}])
+
+        assert len(runner.errors) == 1
+        assert 'Operation 1 failed' in runner.errors.report()[0]
+
+
+class TestBulkWrites:
+    def runner(self, event=mock_event, **kwargs):
+        return AmperityDataverseRunner(event, mock_context, 'test-tenant', destination_url=batch_url,
+                                       destination_session=requests.Session(), entity_url=entity_url, entity_type='contact',
+                                       cols=['firstname'], **kwargs)
+
+    def test_requests_stay_in_flight_across_batches(self, requests_mock, monkeypatch):
+        rows = ''.join(json.dumps({'firstname': f'name{i}'}) + '\n' for i in range(24))
+        requests_mock.get('https://fake-data.example/', text=rows, headers={'Content-Length': str(len(rows))})
+        requests_mock.put('https://fake-callback.example/fake123')
+        event = dict(mock_event, settings={'write_mode': 'create_multiple', 'bulk_chunk_size': 1, 'max_parallel_requests': 4})
+        runner = self.runner(event, batch_size=2)
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        sent = []
+
+        # requests_mock answers one request at a time so the send itself is replaced.
+        def slow_send(body):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+                sent.append(body)
+
+        monkeypatch.setattr(runner, 'send_bulk', slow_send)
+
+        result = runner.run()
+
+        # Batches of 2 records only make 2 requests each, the run wide pool keeps 4 in flight.
+        assert result['statusCode'] == 200
+        assert len(sent) == 24
+        assert in_flight[1] == 4
+
+    def test_no_backoff_after_the_last_attempt(self, requests_mock, monkeypatch):
+        monkeypatch.setattr(dataverse, 'DATAVERSE_MAX_RETRIES', 1)
+        requests_mock.post(f'{entity_url}/Microsoft.Dynamics.CRM.CreateMultiple', status_code=429, headers={'Retry-After': '0'})
+        runner = self.runner(dict(mock_event, settings={'write_mode': 'create_multiple'}))
+        deferred = []
+        monkeypatch.setattr(runner, 'defer_retries', lambda resp, attempt: deferred.append(attempt))
+
+        runner.runner_logic([{'firstname': 'Ada'}])
+
+        assert deferred == [0]
+        assert len(runner.errors) == 1
+
+    @pytest.mark.parametrize('settings', [
+        {'max_concurrency': 4},
+        {'partition_key': 'firstname'},
+        {'stream_body': 'chunked'},
+        {'hedge': True},
+    ])
+    def test_rejects_api_runner_dispatch_settings(self, settings, requests_mock):
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+
+        result = self.runner(dict(mock_event, settings=settings)).run()
+
+        assert result['statusCode'] == 400
+        assert 'max_parallel_requests' in mock_callback.last_request.json()['reason']
+
+
+def test_imports_without_azure_credentials(monkeypatch):
+    for name in ('AZ_TENANT_ID', 'AZ_CLIENT_ID', 'AZ_CLIENT_SECRET'):
+        monkeypatch.delenv(name, raising=False)
+
+    assert importlib.reload(dataverse).MSAL_APP is None
@@ -0,0 +1,127 @@
+import hashlib
+import json
+
+import pytest
+import requests
+
+from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.dedup import BloomFilter, Deduplicator, SeenKeys
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+mock_context = LambdaContext()
+destination_url = 'https://fake-destination.example/'
+
+
+def digest(value):
+    return hashlib.blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+
+
+class TestBloomFilter:
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(digest(i))
+
+        assert all(digest(i) in bloom for i in range(1000))
+        assert all(bloom.add(digest(i)) for i in range(1000))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(digest(i))
+
+        false_positives = sum(digest(f'new{i}') in bloom for i in range(10000))
+
+        assert false_positives < 200
+
+
+class TestSeenKeys:
+    def test_moves_to_bloom_filter_past_exact_limit(self):
+        seen = SeenKeys(exact_limit=10, capacity=1000, error_rate=0.001)
+
+        assert not any(seen.add(digest(i)) for i in range(20))
+        assert seen.bloom is not None
+        assert not seen.exact
+        assert all(seen.add(digest(i)) for i in range(20))
+
+
+class TestDeduplicator:
+    def test_filters_across_batches(self):
+        dedup = Deduplicator(['cust_id'])
+
+        assert dedup.filter([{'cust_id': 1}, {'cust_id': 2}, {'cust_id': 1}]) == [{'cust_id': 1}, {'cust_id': 2}]
+        assert dedup.filter([{'cust_id': 2}, {'cust_id': 3}]) == [{'cust_id': 3}]
+        assert dedup.suppressed == 2
+
+    def test_rows_without_keys_are_kept(self):
+        dedup = Deduplicator(['cust_id', 'email'])
+
+        assert dedup.filter([{'cust_id': None}, {}, {'email': 'a@example.com'}]) == [{'cust_id': None}, {}, {'email': 'a@example.com'}]
+
+    def test_single_key_as_string(self):
+        dedup = Deduplicator('cust_id')
+
+        assert dedup.keys == ['cust_id']
+        assert dedup.filter([{'cust_id': 1}, {'cust_id': 2}, {'cust_id': 1}]) == [{'cust_id': 1}, {'cust_id': 2}]
+
+    def test_runner_setting(self, requests_mock):
+        rows = [{'cust_id': 1, 'order': 1}, {'cust_id': 1, 'order': 2}, {'cust_id': 2, 'order': 3}, {'cust_id': 1, 'order': 4}]
+        mock_ndjson = ''.join(json.dumps(row) + '\n' for row in rows)
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers={'Content-Length': str(len(mock_ndjson))})
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            dict(mock_event, settings={'dedup_keys': ['cust_id']}),
+            mock_context,
+            'test-tenant',
+            batch_size=2,
+            destination_url=destination_url,
+            destination_session=requests.Session(),
+        )
+        test_runner.run()
+
+        assert [r.json() for r in mock_destination.request_history] == [[rows[0]], [rows[2]]]
+        assert mock_callback.last_request.json()['errors'] == []
+        assert test_runner.metrics['dedup'] == {'keys': ['cust_id'], 'suppressed': 2}
+        assert test_runner.batch_offset == 4
+
+    @pytest.mark.parametrize('map_workers', [0, 2])
+    def test_message_ids_survive_a_resumed_run(self, requests_mock, map_workers):
+        rows = [{'cust_id': 1}, {'cust_id': 2}, {'cust_id': 1}, {'cust_id': 3}]
+        mock_ndjson = ''.join(json.dumps(row) + '\n' for row in rows)
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers={'Content-Length': str(len(mock_ndjson))})
+        requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        def sent(**kwargs):
+            mock_destination.reset()
+            AmperityAPIRunner(
+                dict(mock_event, settings={'dedup_keys': 'cust_id'}),
+                mock_context,
+                'test-tenant',
+                batch_size=2,
+                map_workers=map_workers,
+                destination_url=destination_url,
+                destination_session=requests.Session(),
+                message_id_key='messageId',
+                **kwargs
+            ).run()
+
+            return [(record['cust_id'], record['messageId']) for r in mock_destination.request_history for record in r.json()]
+
+        first_run = dict(sent())
+        # The retry resumes at row 2 without the keys the first run saw so it sends the duplicate at row 2 as well.
+        # Ids come from the row in the file so cust_id 3 is sent with the same id as before.
+        resumed_run = sent(batch_offset=2)
+
+        assert sorted(first_run) == [1, 2, 3]
+        assert [cust_id for cust_id, _ in resumed_run] == [1, 3]
+        assert resumed_run[0][1] != first_run[1]
+        assert resumed_run[1][1] == first_run[3]
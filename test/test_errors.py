@@ -0,0 +1,59 @@
+import pickle
+
+import requests
+
+from lambdas import errors
+from lambdas.errors import ErrorAggregator
+
+
+class TestErrorAggregator:
+    def test_groups_by_kind_and_status(self):
+        aggregator = ErrorAggregator()
+        aggregator.append('bad request', status=400)
+        aggregator.append('still bad', status=400)
+        aggregator.append('server error', status=500)
+        aggregator.append(ValueError('oops'))
+
+        assert len(aggregator) == 4
+        assert aggregator.report() == ['2x HTTP 400: bad request', 'server error', 'oops']
+        assert aggregator.summary()['groups'][0] == {'kind': 'HTTP', 'status': 400, 'count': 2, 'examples': ['bad request', 'still bad']}
+
+    def test_status_from_exception_response(self):
+        response = requests.Response()
+        response.status_code = 503
+        aggregator = ErrorAggregator()
+        aggregator.append(requests.exceptions.HTTPError('unavailable', response=response))
+
+        assert aggregator.summary()['groups'][0]['kind'] == 'HTTPError'
+        assert aggregator.summary()['groups'][0]['status'] == 503
+
+    def test_free_text_grouped_with_numbers_masked(self):
+        aggregator = ErrorAggregator()
+        aggregator.append("Couldn't send message to 5555550100")
+        aggregator.append("Couldn't send message to 5555550101")
+
+        assert aggregator.report() == ["2x Error: Couldn't send message to 5555550100"]
+
+    def test_memory_is_bounded(self, monkeypatch):
+        monkeypatch.setattr(errors, 'MAX_GROUPS', 5)
+        aggregator = ErrorAggregator()
+
+        for i in range(10000):
+            aggregator.append('x' * 1000, status=400 + i % 50)
+
+        assert len(aggregator) == 10000
+        assert len(aggregator.groups) == 6
+        assert all(len(group.examples) <= errors.EXAMPLES_PER_GROUP for group in aggregator.groups.values())
+        assert all(len(example) < 600 for group in aggregator.groups.values() for example in group.examples)
+
+    def test_extend_merges_with_prefix(self):
+        sink = ErrorAggregator()
+        for _ in range(5):
+            sink.append('bad request', status=400)
+
+        aggregator = pickle.loads(pickle.dumps(ErrorAggregator()))
+        aggregator.extend(pickle.loads(pickle.dumps(sink)), prefix='rudderstack: ')
+        aggregator.extend(['plain message'])
+
+        assert len(aggregator) == 6
+        assert aggregator.report() == ['5x HTTP 400: rudderstack: bad request', 'plain message']
@@ -0,0 +1,105 @@
+import json
+
+import boto3
+import pytest
+
+from lambdas import helpers
+from lambdas.helpers import ASYNC_EVENT_KEY, accept_async
+from mock_services import lambda_gateway
+from mock_services.lambda_gateway import LambdaContext
+
+
+PAYLOAD = {'data_url': 'http://localhost/data.ndjson', 'callback_url': 'http://localhost/callback/', 'webhook_id': 'wh-1'}
+
+
+class FakeLambdaClient:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+
+@pytest.fixture
+def lambda_client(monkeypatch):
+    client = FakeLambdaClient()
+    monkeypatch.setattr(boto3, 'client', lambda *args, **kwargs: client)
+    monkeypatch.setattr(helpers, 'ASYNC_INVOKE', True)
+
+    return client
+
+
+@accept_async
+def handler(event, context):
+    return {'statusCode': 200, 'body': event['body']}
+
+
+class TestAcceptAsync:
+    def test_runs_handler_when_off(self):
+        assert handler({'body': json.dumps(PAYLOAD)}, LambdaContext())['statusCode'] == 200
+
+    def test_accepts_and_invokes_itself(self, lambda_client):
+        event = {'body': json.dumps(PAYLOAD)}
+        resp = handler(event, LambdaContext(function_name='demo_lambda'))
+
+        assert resp['statusCode'] == 202
+        assert lambda_client.invocations == [{
+            'FunctionName': 'demo_lambda',
+            'InvocationType': 'Event',
+            'Payload': json.dumps({ASYNC_EVENT_KEY: event}),
+        }]
+
+    def test_rejects_missing_keys(self, lambda_client):
+        resp = handler({'body': json.dumps({'webhook_id': 'wh-1'})}, LambdaContext())
+
+        assert resp['statusCode'] == 400
+        assert 'data_url, callback_url' in json.loads(resp['body'])['message']
+        assert not lambda_client.invocations
+
+    def test_rejects_invalid_json(self, lambda_client):
+        assert handler({'body': '{not json'}, LambdaContext())['statusCode'] == 400
+
+    def test_async_invocation_runs_handler(self, lambda_client):
+        event = {'body': json.dumps(PAYLOAD)}
+        resp = handler({ASYNC_EVENT_KEY: event}, LambdaContext())
+
+        assert resp == {'statusCode': 200, 'body': event['body']}
+        assert not lambda_client.invocations
+
+
+class TestInvokeAPI:
+    @pytest.fixture
+    def client(self, monkeypatch):
+        calls = []
+        report = {'request_id': 'req-1'}
+
+        def invoke(name, event, *args):
+            calls.append((name, event))
+            return {'status': {'statusCode': 200}, 'error': None}, report
+
+        monkeypatch.setattr(lambda_gateway, 'invoke', invoke)
+        monkeypatch.setattr(lambda_gateway, 'invoke_async', invoke)
+
+        client = lambda_gateway.app.test_client()
+        client.calls = calls
+
+        return client
+
+    def test_request_response(self, client):
+        event = {ASYNC_EVENT_KEY: {'body': json.dumps(PAYLOAD)}}
+        resp = client.post('/2015-03-31/functions/demo_lambda/invocations', data=json.dumps(event))
+
+        assert resp.status_code == 200
+        assert resp.get_json() == {'statusCode': 200}
+        assert client.calls == [('demo_lambda', event)]
+
+    def test_event_invocation(self, client):
+        resp = client.post(
+            '/2015-03-31/functions/demo_lambda/invocations',
+            data=json.dumps({}),
+            headers={'X-Amz-Invocation-Type': 'Event'},
+        )
+
+        assert resp.status_code == 202
+        assert resp.headers['X-Amzn-RequestId'] in lambda_gateway.invocations
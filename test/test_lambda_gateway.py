@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+
+import pytest
+
+from mock_services import lambda_gateway
+
+
+def fake_run_handler(conn, name, event, timeout, memory_limit_in_mb, request_id):
+    """
+    Stands in for run_handler in the invocation subprocess, the handler name picks what it does.
+    """
+    if name == 'sleep':
+        time.sleep(30)
+    elif name == 'memory':
+        hog = bytearray(256 * 1024 * 1024)
+        hog[::4096] = b'x' * len(hog[::4096])
+        time.sleep(30)
+    elif name == 'crash':
+        raise SystemExit(3)
+
+    conn.send({'status': {'statusCode': 200, 'body': json.dumps(event)}, 'error': None, 'cpu_time_ms': 1, 'max_memory_used_mb': 1})
+    conn.close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(lambda_gateway, 'run_handler', fake_run_handler)
+    monkeypatch.setattr(lambda_gateway, 'concurrency_slots', threading.BoundedSemaphore(2))
+    monkeypatch.setattr(lambda_gateway, 'invocations', {})
+
+    return lambda_gateway.app.test_client()
+
+
+class TestInvocationLimits:
+    def test_returns_the_handler_result_and_report(self, client):
+        resp = client.post('/lambda/ok', json={'webhook_id': 'wh-1'})
+        body = resp.get_json()
+
+        assert resp.status_code == 200
+        assert body['status'] == 200
+        assert json.loads(body['message']) == {'body': json.dumps({'webhook_id': 'wh-1'})}
+        assert body['report']['memory_size_mb'] == 128
+
+    def test_kills_past_the_timeout(self, client):
+        start = time.monotonic()
+        resp = client.post('/lambda/sleep', json={}, headers={'X-Lambda-Timeout': '1500'})
+
+        assert resp.get_json()['message'] == 'Task timed out after 1.50 seconds'
+        assert time.monotonic() - start < 10
+
+    def test_kills_past_the_memory_limit(self, client):
+        resp = client.post('/lambda/memory', json={}, headers={'X-Lambda-Memory-Size': '128', 'X-Lambda-Timeout': '20000'})
+        body = resp.get_json()
+
+        assert body['message'] == 'Runtime exited with error: memory limit of 128 MB exceeded.'
+        assert body['report']['duration_ms'] < 20000
+
+    def test_process_exiting_without_a_result(self, client):
+        resp = client.post('/lambda/crash', json={})
+
+        assert resp.get_json()['message'] == 'Process exited with code 3 before returning.'
+
+    def test_throttles_when_every_slot_is_taken(self, client):
+        lambda_gateway.concurrency_slots.acquire()
+        lambda_gateway.concurrency_slots.acquire()
+
+        try:
+            resp = client.post('/lambda/ok', json={})
+        finally:
+            lambda_gateway.concurrency_slots.release()
+            lambda_gateway.concurrency_slots.release()
+
+        assert resp.status_code == 429
+        assert resp.get_json()['Type'] == 'TooManyRequestsException'
+
+
+class TestAsyncInvocations:
+    def test_result_is_polled_by_request_id(self, client):
+        resp = client.post('/lambda/ok', json={'webhook_id': 'wh-1'}, headers={'X-Amz-Invocation-Type': 'Event'})
+        request_id = resp.get_json()['request_id']
+
+        assert resp.status_code == 202
+        assert client.get(f'/invocations/{request_id}').status_code == 200
+
+        for _ in range(200):
+            result = client.get(f'/invocations/{request_id}').get_json()
+            if result['status'] is not None:
+                break
+            time.sleep(0.05)
+
+        assert result['status'] == 200
+        assert result['report']['request_id'] == request_id
+
+    def test_async_invocations_wait_for_a_slot(self, client):
+        lambda_gateway.concurrency_slots.acquire()
+        lambda_gateway.concurrency_slots.acquire()
+
+        resp = client.post('/lambda/ok', json={}, headers={'X-Amz-Invocation-Type': 'Event'})
+        request_id = resp.get_json()['request_id']
+        time.sleep(0.2)
+
+        # Queued instead of throttled, it runs once a slot frees up.
+        assert resp.status_code == 202
+        assert client.get(f'/invocations/{request_id}').get_json()['message'] == 'Invocation is running'
+
+        lambda_gateway.concurrency_slots.release()
+        lambda_gateway.concurrency_slots.release()
+
+        for _ in range(200):
+            if client.get(f'/invocations/{request_id}').get_json()['status'] is not None:
+                break
+            time.sleep(0.05)
+
+        assert client.get(f'/invocations/{request_id}').get_json()['status'] == 200
+
+    def test_unknown_request_id(self, client):
+        assert client.get('/invocations/nope').status_code == 404
@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+import requests
+
+from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.parallel import ProcessMapper
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+mock_context = LambdaContext()
+mock_ndjson = ''.join(json.dumps({'col1': f'val{i}', 'col2': 'x' * (i % 3) * 40}) + '\n' for i in range(20))
+mock_headers = {'Content-Length': str(len(mock_ndjson))}
+destination_url = 'https://fake-destination.example/'
+
+
+def add_pid(data):
+    return [dict(record, pid=os.getpid()) for record in data]
+
+
+def fail_on_three(item):
+    if item == 3:
+        raise ValueError('bad item')
+
+    return item
+
+
+class TestProcessMapper:
+    def test_results_in_order(self):
+        with ProcessMapper(lambda item: item * 2, workers=3) as mapper:
+            assert list(mapper.imap(range(10))) == [item * 2 for item in range(10)]
+
+    def test_runs_in_worker_processes(self):
+        with ProcessMapper(add_pid, workers=2) as mapper:
+            pids = {record['pid'] for data in mapper.imap([[{}]] * 4) for record in data}
+
+        assert os.getpid() not in pids
+
+    def test_worker_errors_are_raised(self):
+        with pytest.raises(RuntimeError, match='bad item'):
+            with ProcessMapper(fail_on_three, workers=2) as mapper:
+                list(mapper.imap(range(5)))
+
+
+class TestMapWorkers:
+    def run_api_runner(self, requests_mock, map_workers):
+        requests_mock.get('https://fake-data.example/', text=mock_ndjson, headers=mock_headers)
+        mock_callback = requests_mock.put('https://fake-callback.example/fake123')
+        mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+        test_runner = AmperityAPIRunner(
+            mock_event,
+            mock_context,
+            'test-tenant',
+            batch_size=4,
+            map_workers=map_workers,
+            destination_url=destination_url,
+            destination_session=requests.Session(),
+            max_payload_bytes=250,
+            message_id_key='messageId',
+        )
+        test_runner.run()
+
+        return [r.text for r in mock_destination.request_history], [r.json() for r in mock_callback.request_history]
+
+    def test_matches_serial_run(self, requests_mock):
+        serial = self.run_api_runner(requests_mock, 0)
+        parallel = self.run_api_runner(requests_mock, 3)
+
+        assert parallel == serial
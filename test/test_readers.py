@@ -0,0 +1,167 @@
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+
+from lambdas.amperity_runner import AmperityAPIRunner
+from lambdas.readers import CSVReader, NDJSONReader, ParquetReader, get_reader, iter_lines
+from mock_services.lambda_gateway import LambdaContext
+
+
+mock_event = {
+    'callback_url': 'https://fake-callback.example/',
+    'webhook_id': 'fake123',
+    'data_url': 'https://fake-data.example/',
+}
+mock_context = LambdaContext()
+destination_url = 'https://fake-destination.example/'
+destination_sess = requests.Session()
+
+mock_csv = 'col1,col2,col3\nval1,1,true\n"val,3",,false\n'
+mock_rows = [{'col1': 'val1', 'col2': 1}, {'col1': 'val3', 'col2': 2}, {'col1': 'val5', 'col2': 3}]
+
+
+def mock_parquet():
+    output = io.BytesIO()
+    pq.write_table(pa.Table.from_pylist(mock_rows), output, row_group_size=2)
+
+    return output.getvalue()
+
+
+def register_range_file(requests_mock, url, content, headers=None):
+    """
+    Serve content at url, answering Range requests with the requested slice like S3 does.
+    """
+    def respond(request, context):
+        byte_range = request.headers.get('Range')
+
+        if not byte_range:
+            return content
+
+        start, end = byte_range.split('=')[1].split('-')
+        context.status_code = 206
+
+        return content[int(start):int(end) + 1]
+
+    requests_mock.get(url, content=respond, headers=dict(headers or {}, **{'Content-Length': str(len(content))}))
+
+
+def run_api_runner(requests_mock, **kwargs):
+    requests_mock.put('https://fake-callback.example/fake123')
+    mock_destination = requests_mock.post(destination_url, text='{"status":200}')
+
+    test_runner = AmperityAPIRunner(
+        dict(mock_event, **kwargs.pop('event', {})),
+        mock_context,
+        'test-tenant',
+        destination_url=destination_url,
+        destination_session=destination_sess,
+        **kwargs
+    )
+    result = test_runner.run()
+
+    return result, [r.json() for r in mock_destination.request_history]
+
+
+class TestGetReader:
+    def test_defaults_to_ndjson(self):
+        assert isinstance(get_reader(None, 'application/octet-stream', 'https://bucket.example/file'), NDJSONReader)
+
+    def test_setting_wins(self):
+        assert isinstance(get_reader({'input_format': 'csv'}, 'application/vnd.apache.parquet'), CSVReader)
+
+    def test_content_type(self):
+        assert isinstance(get_reader({}, 'text/csv; charset=utf-8'), CSVReader)
+
+    def test_url_extension(self):
+        assert isinstance(get_reader({}, None, 'https://bucket.example/export.parquet?X-Amz-Signature=abc'), ParquetReader)
+
+
+class TestIterLines:
+    def test_offsets_and_carriage_returns(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text='a\r\nbc\n\nd')
+
+        # A chunk size of 2 splits the \r\n pair across reads.
+        lines = list(iter_lines(requests.get('https://fake-data.example/', stream=True), chunk_size=2))
+
+        assert lines == [(b'a', 3), (b'bc', 6), (b'', 7), (b'd', 8)]
+
+
+class TestCSVReader:
+    def test_typed_columns(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_csv, headers={'Content-Length': str(len(mock_csv))})
+
+        result, requests_sent = run_api_runner(
+            requests_mock,
+            event={'settings': {'input_format': 'csv', 'csv_types': {'col2': 'int', 'col3': 'bool'}}},
+        )
+
+        assert result['statusCode'] == 200
+        assert requests_sent == [[
+            {'col1': 'val1', 'col2': 1, 'col3': True},
+            {'col1': 'val,3', 'col2': None, 'col3': False},
+        ]]
+
+    def test_catch_up_to_offset(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_csv, headers={'Content-Length': str(len(mock_csv))})
+
+        _, requests_sent = run_api_runner(requests_mock, event={'settings': {'input_format': 'csv'}}, batch_offset=1)
+
+        assert requests_sent == [[{'col1': 'val,3', 'col2': None, 'col3': 'false'}]]
+
+    def test_quoted_newlines_and_byte_order_mark(self, requests_mock):
+        content = '\ufeffcol1,col2\r\na,"line1\nline2"\r\nb,"x"\r\n'.encode('utf-8')
+        requests_mock.get('https://fake-data.example/', content=content, headers={'Content-Length': str(len(content))})
+
+        _, requests_sent = run_api_runner(requests_mock, event={'settings': {'input_format': 'csv'}})
+
+        assert requests_sent == [[{'col1': 'a', 'col2': 'line1\nline2'}, {'col1': 'b', 'col2': 'x'}]]
+
+
+class TestParquetReader:
+    def test_batches(self, requests_mock):
+        register_range_file(requests_mock, 'https://fake-data.example/', mock_parquet(),
+                            headers={'Content-Type': 'application/vnd.apache.parquet'})
+
+        result, requests_sent = run_api_runner(requests_mock, batch_size=2)
+
+        assert result['statusCode'] == 200
+        assert requests_sent == [mock_rows[:2], mock_rows[2:]]
+
+    def test_skips_row_groups_before_offset(self, requests_mock):
+        register_range_file(requests_mock, 'https://fake-data.example/', mock_parquet(),
+                            headers={'Content-Type': 'application/vnd.apache.parquet'})
+
+        _, requests_sent = run_api_runner(requests_mock, batch_size=2, batch_offset=1)
+
+        assert requests_sent == [mock_rows[1:2], mock_rows[2:]]
+
+
+class TestSchema:
+    def test_ndjson_schema_setting(self, requests_mock):
+        mock_data = '{"col1": "val1", "col2": 1, "col3": "unused"}\n'
+        requests_mock.get('https://fake-data.example/', text=mock_data, headers={'Content-Length': str(len(mock_data))})
+
+        _, requests_sent = run_api_runner(requests_mock, event={'settings': {'schema': {'col1': 'str', 'col2': 'str'}}})
+
+        assert requests_sent == [[{'col1': 'val1', 'col2': '1'}]]
+
+    def test_csv_schema_types_columns(self, requests_mock):
+        requests_mock.get('https://fake-data.example/', text=mock_csv, headers={'Content-Length': str(len(mock_csv))})
+
+        _, requests_sent = run_api_runner(
+            requests_mock,
+            event={'settings': {'input_format': 'csv', 'schema': {'col2': 'int', 'col3': 'bool'}}},
+        )
+
+        assert requests_sent == [[{'col2': 1, 'col3': True}, {'col2': None, 'col3': False}]]
+
+    def test_parquet_reads_only_schema_columns(self, requests_mock):
+        register_range_file(requests_mock, 'https://fake-data.example/', mock_parquet(),
+                            headers={'Content-Type': 'application/vnd.apache.parquet'})
+
+        _, requests_sent = run_api_runner(requests_mock, event={'settings': {'schema': {'col2': 'int', 'missing': 'str'}}})
+
+        assert requests_sent == [[{'col2': 1, 'missing': None}, {'col2': 2, 'missing': None}, {'col2': 3, 'missing': None}]]
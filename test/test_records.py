@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from lambdas import records
+from lambdas.records import RecordDecoder, make_slotted_record, to_builtins
+
+
+schema = {'phone_number': 'str', 'message': 'str', 'orders': 'int'}
+mock_line = b'{"phone_number": 5555550100, "message": "hi", "orders": "3", "unused": {"a": 1}}'
+
+
+@pytest.fixture(params=['msgspec', 'slotted'])
+def decoder(request, monkeypatch):
+    if request.param == 'slotted':
+        monkeypatch.setattr(records, 'msgspec', None)
+
+    return RecordDecoder(schema)
+
+
+class TestRecordDecoder:
+    def test_decode_drops_unused_fields(self, decoder):
+        record = decoder.decode(mock_line)
+
+        assert dict(record.items()) == {'phone_number': '5555550100', 'message': 'hi', 'orders': 3}
+        assert 'unused' not in record
+        assert record.get('unused') is None
+        with pytest.raises(KeyError):
+            record['unused']
+
+    def test_missing_fields_are_none(self, decoder):
+        record = decoder.decode(b'{"message": "hi"}')
+
+        assert record['phone_number'] is None
+        assert record['orders'] is None
+
+    def test_dict_compatible(self, decoder):
+        record = decoder.from_dict({'phone_number': '5555550100', 'message': 'hi', 'orders': 1})
+
+        assert dict(record) == {'phone_number': '5555550100', 'message': 'hi', 'orders': 1}
+        assert json.loads(json.dumps([record], default=to_builtins)) == [dict(record)]
+
+    def test_only_declared_fields_can_be_set(self, decoder):
+        record = decoder.from_dict({})
+        record['message'] = 'hello'
+
+        assert record['message'] == 'hello'
+        with pytest.raises(KeyError):
+            record['unused'] = 1
+
+
+def test_slotted_records_have_no_dict():
+    record = make_slotted_record('Record', {'message': str})(message='hi')
+
+    assert not hasattr(record, '__dict__')
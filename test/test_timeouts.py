@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from lambdas.timeouts import LatencyWindow, OverallTimeout, call_with_timeout, get_timeouts, is_timeout
+
+
+class TestCallWithTimeout:
+    def test_returns_result(self):
+        assert call_with_timeout(lambda: 'ok', 1) == ('ok', 1, False)
+
+    def test_raises_past_deadline(self):
+        release = threading.Event()
+
+        with pytest.raises(OverallTimeout):
+            call_with_timeout(lambda: release.wait(5), 0.05)
+
+        release.set()
+
+    def test_raises_call_error(self):
+        def fail():
+            raise requests.exceptions.ConnectTimeout('no route')
+
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            call_with_timeout(fail, 1)
+
+    def test_hedge_wins_when_first_call_stalls(self):
+        calls = []
+        release = threading.Event()
+
+        def call():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(5)
+                return 'slow'
+            return 'fast'
+
+        assert call_with_timeout(call, 1, hedge_after=0.01) == ('fast', 2, True)
+        release.set()
+
+    def test_no_hedge_when_fast(self):
+        assert call_with_timeout(lambda: 'ok', 0, hedge_after=1) == ('ok', 1, False)
+
+
+class TestLatencyWindow:
+    def test_percentile_needs_samples(self):
+        window = LatencyWindow(size=100, min_samples=10)
+
+        for latency in range(9):
+            window.add(latency)
+        assert window.percentile(0.95) is None
+
+        for latency in range(9, 100):
+            window.add(latency)
+        assert window.percentile(0.95) == 95
+
+
+def test_get_timeouts_from_settings():
+    assert get_timeouts({'connect_timeout': 1, 'read_timeout': '2', 'request_timeout': 0}) == (1, 2, 0)
+
+
+def test_is_timeout():
+    assert is_timeout(requests.exceptions.ReadTimeout())
+    assert is_timeout(requests.exceptions.ConnectionError('Read timed out.'))
+    assert not is_timeout(requests.exceptions.ConnectionError('Connection refused'))
@@ -0,0 +1,84 @@
+"""
+Compare rows per second of an AmperityAPIRunner with a CPU heavy custom_mapping at different map_workers.
+Nothing is sent over the network, the file is served from memory and requests are dropped.
+
+    PYTHONPATH=src python util/benchmark_map_workers.py --rows 200000 --workers 0 2 4
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+
+import requests
+
+from urllib3.response import HTTPResponse
+
+from lambdas.amperity_runner import AmperityAPIRunner
+from mock_services.lambda_gateway import LambdaContext
+
+
+def expensive_mapping(data):
+    # Stand in for heavy reshaping, ie building Dataverse multipart bodies or Connect profiles.
+    return [
+        dict(record, email_hash=hashlib.pbkdf2_hmac('sha256', record['email'].encode('utf-8'), b'salt', 200).hex())
+        for record in data
+    ]
+
+
+class BenchmarkRunner(AmperityAPIRunner):
+    def report_status(self, state, progress=0.0, reason=''):
+        # Nothing to report to, errors are left in the runner's ErrorAggregator like in a real run.
+        pass
+
+    def send_request(self, output_data):
+        self.bytes_sent += len(output_data)
+
+
+def make_file(rows):
+    return b''.join(
+        json.dumps({'email': f'user{i}@example.com', 'given_name': 'Some', 'surname': 'One', 'orders': i % 50}).encode('utf-8') + b'\n'
+        for i in range(rows)
+    )
+
+
+def run(data, workers, batch_size):
+    stream_resp = requests.Response()
+    stream_resp.raw = HTTPResponse(body=io.BytesIO(data), preload_content=False)
+    stream_resp.status_code = 200
+
+    runner = BenchmarkRunner(
+        {'callback_url': 'http://localhost/', 'webhook_id': 'benchmark', 'data_url': 'http://localhost/data.ndjson'},
+        LambdaContext(),
+        'benchmark',
+        batch_size=batch_size,
+        map_workers=workers,
+        destination_url='http://localhost/',
+        destination_session=requests.Session(),
+        custom_mapping=expensive_mapping,
+    )
+    runner.bytes_sent = 0
+    runner.file_bytes = len(data)
+
+    start = time.perf_counter()
+    runner.process_stream(stream_resp)
+
+    return time.perf_counter() - start, runner.batch_offset, len(runner.errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, os.cpu_count()])
+    args = parser.parse_args()
+
+    data = make_file(args.rows)
+    print(f'{args.rows} rows, {len(data) / 1e6:.1f} MB, {os.cpu_count()} CPUs')
+
+    baseline = None
+    for workers in args.workers:
+        elapsed, rows, errors = run(data, workers, args.batch_size)
+        baseline = baseline or elapsed
+        print(f'map_workers={workers}: {rows / elapsed:,.0f} rows/s ({baseline / elapsed:.2f}x), {errors} errors')
@@ -10,8 +10,7 @@ pip install requests -t build/
 
 echo "Copying lambda runner"
 mkdir build/lambdas
-cp src/lambdas/amperity_runner.py build/lambdas/
-cp src/lambdas/helpers.py build/lambdas/
+cp src/lambdas/*.py build/lambdas/
 cp src/lambdas/lambda_handlers/$filename build/app.py
 
 echo "Zipping contents"
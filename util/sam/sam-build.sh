@@ -22,8 +22,7 @@ pip install requests -t build/
 
 echo "Copying lambda runner"
 mkdir build/lambdas
-cp src/lambdas/amperity_runner.py build/lambdas/
-cp src/lambdas/helpers.py build/lambdas/
+cp src/lambdas/*.py build/lambdas/
 cp "src/lambdas/lambda_handlers/$filename" build/app.py
 
 cp "docs/apps/$app_name.md" build/README.md